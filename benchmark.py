@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+Micro benchmarks for the simdial database. Run from the directory that contains db.json, e.g.
+
+    python benchmark.py advice
+"""
+from simdial.database import Database, slot_vocab
+from simdial.cube import DataCube, AdviceIndex
+from simdial.sketch import SketchAdvice
+from simdial.backend import SQLiteBackend
+from simdial.domain import Domain
+from simdial.synthetic import SyntheticKB
+from simdial.generator import Generator
+from simdial.complexity import Complexity, CleanSpec, EnvSpec, InteractSpec
+from simdial.writer import WRITERS, get_writer, ActCorpus
+from simdial.batch import BatchSimulator
+from simdial.env import VecDialogEnv
+from simdial.server import UserServer, load_test
+from simdial.agent.core import Action
+from simdial.agent.system import System
+from simdial.agent.nlg import SysNlg
+from multiple_domains import RestSpec
+import numpy as np
+import multiprocessing
+import tempfile
+import tracemalloc
+import asyncio
+import shutil
+import gc
+import time
+import sys
+import os
+
+
+def load_table():
+    slot_voc = slot_vocab(RestSpec.usr_slots)
+    usr_table, _ = Database.load_kb(slot_voc)
+    return np.array(usr_table).transpose()
+
+
+def time_per_call(func, args_list):
+    start = time.time()
+    for args in args_list:
+        func(*args)
+    return (time.time() - start) / len(args_list)
+
+
+def sample_stat_queries(table, num_queries, given_prob=0.5):
+    queries = []
+    for _ in range(num_queries):
+        row = table[np.random.randint(0, len(table))].tolist()
+        queries.append([v if np.random.rand() < given_prob else None for v in row])
+    return queries
+
+
+def bench_advice(num_calls=2000):
+    """
+    Per-call latency of Database.get_advice: DataFrame filter+sort vs AdviceIndex lookup.
+    """
+    table = load_table()
+    db_stat = Database._get_stat(table, [slot for slot, _, _ in RestSpec.usr_slots])
+
+    start = time.time()
+    index = AdviceIndex(DataCube.from_columns(table.transpose()))
+    build_time = time.time() - start
+
+    queries = sample_stat_queries(table, num_calls)
+    frame_time = time_per_call(lambda q: Database._frame_advice(db_stat, q), [(q,) for q in queries])
+    index_time = time_per_call(index.lookup, [(q,) for q in queries])
+
+    mismatch = 0
+    for q in queries:
+        frame = [[v if v == '' else int(v) for v in row] for row in Database._frame_advice(db_stat, q)]
+        if frame != index.lookup(q):
+            mismatch += 1
+
+    print("advice: %d rows, %d stat rows, index build %.2f ms" % (len(table), len(db_stat), build_time * 1e3))
+    print("  DataFrame  %.1f us/call" % (frame_time * 1e6))
+    print("  AdviceIndex %.2f us/call (%.0fx), %d mismatches" % (index_time * 1e6, frame_time / index_time, mismatch))
+
+
+def bench_backend(num_calls=2000):
+    """
+    Per-call latency of select, count, sample_entry, get_advice and sample_unique_row: in-memory
+    tables vs SQLiteBackend.
+    """
+    memory_db = Domain(RestSpec()).db
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'kb.sqlite')
+        start = time.time()
+        SQLiteBackend.from_database(path, memory_db)
+        build_time = time.time() - start
+        backend = SQLiteBackend(path)
+        sqlite_db = Database.from_backend(backend)
+
+        table = np.asarray(memory_db.table)
+        queries = sample_stat_queries(table, num_calls)
+        print("backend: %d rows, SQLite build %.1f ms" % (memory_db.num_rows, build_time * 1e3))
+        for name, db in [('memory', memory_db), ('sqlite', sqlite_db)]:
+            select_time = time_per_call(db.select, [(q,) for q in queries])
+            count_time = time_per_call(db.count, [(q,) for q in queries])
+            entry_time = time_per_call(db.sample_entry, [(q,) for q in queries])
+            advice_time = time_per_call(db.get_advice, [(q,) for q in queries])
+            goal_time = time_per_call(db.sample_unique_row, [()] * num_calls)
+            print("  %-7s select %.1f us, count %.1f us, sample_entry %.1f us, get_advice %.1f us, "
+                  "sample_unique_row %.1f us" % (name, select_time * 1e6, count_time * 1e6, entry_time * 1e6,
+                                                 advice_time * 1e6, goal_time * 1e6))
+
+        mismatch = 0
+        for q in queries:
+            _, memory_idx = memory_db.select(q, return_index=True)
+            _, sqlite_idx = sqlite_db.select(q, return_index=True)
+            if memory_idx.tolist() != sqlite_idx.tolist() or memory_db.count(q) != sqlite_db.count(q) \
+                    or memory_db.get_advice(q) != sqlite_db.get_advice(q):
+                mismatch += 1
+        print("  %d mismatches" % mismatch)
+        backend.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_cube(num_rows=200000, num_slots=8, modality=12, num_calls=2000):
+    """
+    Advice on a KB with many searchable slots: lazy DataCube vs all the 2^num_slots cuboids up front.
+    """
+    pdf = np.random.dirichlet(np.ones(modality) * 0.3)
+    table = np.random.choice(modality, p=pdf, size=(num_rows, num_slots))
+    queries = sample_stat_queries(table, num_calls, given_prob=0.3)
+
+    start = time.time()
+    index = AdviceIndex(DataCube.from_columns(table.transpose()))
+    build_time = time.time() - start
+    start = time.time()
+    for q in queries:
+        index.lookup(q)
+    first_time = time.time() - start
+    repeat_time = time_per_call(index.lookup, [(q,) for q in queries])
+
+    start = time.time()
+    db_stat = Database._get_stat(table, ["slot%d" % i for i in range(num_slots)])
+    eager_time = time.time() - start
+
+    print("cube: %d rows, %d slots, %d full cells" % (num_rows, num_slots, len(index.cube.full.counts)))
+    print("  lazy   build %.1f ms, %d queries %.1f ms (%d cuboids materialized), repeat %.2f us/call"
+          % (build_time * 1e3, num_calls, first_time * 1e3, len(index.cube.cuboids), repeat_time * 1e6))
+    print("  eager  %d cuboids, %d stat rows in %.1f ms" % (2 ** num_slots - 1, len(db_stat), eager_time * 1e3))
+
+
+def bench_sketch(num_rows=4000000, chunk_size=1000000, num_calls=1000):
+    """
+    Exact DataCube advice vs SketchAdvice built in chunks, on a skewed synthetic KB.
+    """
+    modalities = [91, 5, 3, 20, 40]
+    table = np.stack([np.random.choice(m, p=np.random.dirichlet(np.ones(m) * 0.3), size=num_rows)
+                      for m in modalities], axis=1)
+    queries = sample_stat_queries(table, num_calls, given_prob=0.4)
+
+    start = time.time()
+    exact = AdviceIndex(DataCube.from_columns(table.transpose()))
+    exact_time = time.time() - start
+    full = exact.cube.full
+    print("sketch: %d rows, %d slots, exact cube build %.1f ms, %.1f MB"
+          % (num_rows, len(modalities), exact_time * 1e3, (full.rows.nbytes + full.counts.nbytes) / 1e6))
+    for eps in [0.01, 0.001]:
+        start = time.time()
+        chunks = (table[i:i + chunk_size] for i in range(0, num_rows, chunk_size))
+        approx = SketchAdvice.build(chunks, len(modalities), eps, 0.01)
+        build_time = time.time() - start
+
+        identical, max_error = 0, 0
+        for q in queries:
+            exact_advice, approx_advice = exact.lookup(q), approx.lookup(q)
+            identical += exact_advice == approx_advice
+            exact_counts = dict((tuple(row[:-1]), row[-1]) for row in exact_advice)
+            for row in approx_advice:
+                if tuple(row[:-1]) in exact_counts:
+                    max_error = max(max_error, row[-1] - exact_counts[tuple(row[:-1])])
+        print("  eps %-6g build %.1f ms, %.2f MB, %.1f%% identical advice, max overcount %.2g * num_rows"
+              % (eps, build_time * 1e3, approx.nbytes / 1e6, 100.0 * identical / num_calls, float(max_error) / num_rows))
+
+
+def bench_select_many(num_queries=100000, num_loop=5000):
+    """
+    Per-query latency of a loop of Database.select vs one Database.select_many call.
+    """
+    db = Domain(RestSpec()).db
+    table = np.asarray(db.table)
+    queries = [[Database.DONT_CARE if q is None else q for q in query]
+               for query in sample_stat_queries(table, num_queries)]
+    loop_time = time_per_call(db.select, [([None if q == Database.DONT_CARE else q for q in query],)
+                                          for query in queries[0:num_loop]])
+    start = time.time()
+    counts, uids = db.select_many(queries)
+    batch_time = (time.time() - start) / num_queries
+    print("select_many: %d rows, %d queries, %.1f%% with a match"
+          % (db.num_rows, num_queries, 100.0 * np.mean(counts > 0)))
+    print("  select loop %.2f us/query, select_many %.3f us/query (%.0fx)"
+          % (loop_time * 1e6, batch_time * 1e6, loop_time / batch_time))
+
+
+def bench_synthetic(num_rows=10000000, num_calls=2000):
+    """
+    Write a synthetic KB with the restaurant slots, attach it and time select, select_many,
+    get_advice and sample_unique_row at that scale.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        SyntheticKB.from_spec(RestSpec()).write(tmp_dir, num_rows)
+        write_time = time.time() - start
+        start = time.time()
+        db = Database.attach(tmp_dir)
+        attach_time = time.time() - start
+        print("synthetic: %d rows, write %.1f s, attach %.3f s"
+              % (num_rows, write_time, attach_time))
+
+        queries = sample_stat_queries(np.asarray(db.cons_table), num_calls)
+        # a select copies every matching entry, millions of them for a loose query
+        select_time = time_per_call(db.select, [(q,) for q in queries[0:num_calls // 10]])
+        advice_time = time_per_call(db.get_advice, [(q,) for q in queries])
+        goal_time = time_per_call(db.sample_unique_row, [()] * num_calls)
+        batch = [[Database.DONT_CARE if v is None else v for v in q] for q in queries]
+        start = time.time()
+        db.select_many(batch)
+        sort_time = time.time() - start
+        start = time.time()
+        db.select_many(batch)
+        many_time = (time.time() - start) / num_calls
+        print("  select %.1f ms, get_advice %.1f us, sample_unique_row %.1f us"
+              % (select_time * 1e3, advice_time * 1e6, goal_time * 1e6))
+        print("  select_many %.2f us/query after sorting the rows by each query pattern in %.1f s"
+              % (many_time * 1e6, sort_time))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_writer(num_dialogs=2000):
+    """
+    Dialogs per second and output size of each corpus format and compression, in one process.
+    """
+    domain = Domain(RestSpec())
+    dialogs, usr_goals = Generator().gen(domain, Complexity(CleanSpec), num_sess=num_dialogs, seed=0)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print("writer: %d dialogs" % num_dialogs)
+        for fmt in sorted(WRITERS.keys()):
+            for compression in [None] if fmt == 'acts' else [None, 'gzip', 'xz']:
+                start = time.time()
+                with get_writer(os.path.join(tmp_dir, 'corpus'), fmt=fmt, compression=compression,
+                                domain=domain) as writer:
+                    for dialog, usr_goal in zip(dialogs, usr_goals):
+                        writer.write(dialog, usr_goal)
+                elapsed = time.time() - start
+                print("  %-5s %-4s %8.0f dialogs/s, %.2f MB"
+                      % (fmt, compression, num_dialogs / elapsed, path_size(writer.path) / 1e6))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def path_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def bench_acts(num_dialogs=1000000, shard_size=1000, num_calls=100000):
+    """
+    Open a columnar act corpus of num_dialogs dialogs, made of one generated shard written
+    over and over, and read random dialogs from it.
+    """
+    domain = Domain(RestSpec())
+    results = list(zip(*Generator().gen(domain, Complexity(CleanSpec), num_sess=shard_size, seed=0)))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        with get_writer(os.path.join(tmp_dir, 'corpus'), fmt='acts', domain=domain) as writer:
+            data = writer.encode_shard(0, results, domain=domain)
+            for _ in range(num_dialogs // shard_size):
+                writer.write_encoded(data, shard_size)
+        write_time = time.time() - start
+        start = time.time()
+        corpus = ActCorpus(writer.path)
+        open_time = time.time() - start
+        ids = np.random.randint(0, len(corpus), size=num_calls)
+        dialog_time = time_per_call(corpus.dialog, [(i,) for i in ids])
+        start = time.time()
+        num_inform = np.sum(corpus.columns['act'] == corpus.meta['act_names'].index('inform'))
+        scan_time = time.time() - start
+        print("acts: %d dialogs, %d turns, %.1f MB, write %.1f s"
+              % (len(corpus), corpus.meta['num_turns'], path_size(writer.path) / 1e6, write_time))
+        print("  open %.2f ms, dialog %.1f us/call, scan of %d acts (%d informs) %.1f ms"
+              % (open_time * 1e3, dialog_time * 1e6, corpus.meta['num_acts'], num_inform, scan_time * 1e3))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_gen(num_dialogs=2000):
+    """
+    User and system turns per second of Generator.gen, one process, with the noise of each complexity.
+    """
+    domain = Domain(RestSpec())
+    for spec in [CleanSpec, EnvSpec, InteractSpec]:
+        start = time.time()
+        dialogs, _ = Generator().gen(domain, Complexity(spec), num_sess=num_dialogs, seed=0)
+        elapsed = time.time() - start
+        num_turns = sum(len(d) for d in dialogs)
+        print("gen: %-12s %d dialogs, %d turns, %.0f turns/s" % (spec.__name__, num_dialogs, num_turns, num_turns / elapsed))
+
+
+def bench_actions(num_dialogs=2000):
+    """
+    Memory per action of the dialogs of Generator.gen. The actions are built again under
+    tracemalloc from the acts and parameters of the generated ones, so only the actions and
+    their parameter tuples are counted, not the slot values they share.
+    """
+    domain = Domain(RestSpec())
+    dialogs, _ = Generator().gen(domain, Complexity(CleanSpec), num_sess=num_dialogs, seed=0)
+    originals = [(a.act, list(a.parameters)) for d in dialogs for turn in d for a in turn['actions']]
+    gc.collect()
+    tracemalloc.start()
+    actions = [Action(act, parameters) for act, parameters in originals]
+    size = tracemalloc.get_traced_memory()[0] - sys.getsizeof(actions)
+    tracemalloc.stop()
+    print("actions: %d dialogs, %d actions, %.1f bytes/action, %.1f MB"
+          % (num_dialogs, len(actions), size / float(len(actions)), size / 1e6))
+
+
+def bench_batch(num_loop=1000, num_batch=100000):
+    """
+    Simulate dialogs one by one with Generator.gen and in lockstep with BatchSimulator.
+    """
+    domain = Domain(RestSpec())
+    complexity = Complexity(CleanSpec)
+    start = time.time()
+    dialogs, _ = Generator().gen(domain, complexity, num_sess=num_loop, seed=0)
+    loop_time = time.time() - start
+    loop_turns = sum(len(d) for d in dialogs)
+
+    np.random.seed(0)
+    simulator = BatchSimulator(domain, complexity)
+    start = time.time()
+    batch_turns = sum(len(columns['speaker']) for columns, _ in simulator.iter_shards(num_batch))
+    batch_time = time.time() - start
+    print("batch: loop %d dialogs %.0f turns/s, lockstep %d dialogs %.0f turns/s (%.1fx)"
+          % (num_loop, loop_turns / loop_time, num_batch, batch_turns / batch_time,
+             (batch_turns / batch_time) / (loop_turns / loop_time)))
+
+
+def bench_env(num_envs=64, num_steps=200):
+    """
+    Step a VecDialogEnv with System as the external policy, only the env steps are timed.
+    """
+    domain = Domain(RestSpec())
+    complexity = Complexity(CleanSpec)
+    env = VecDialogEnv(domain, complexity, num_envs)
+    sys_nlg = SysNlg(domain, complexity)
+    obs = env.reset(seed=0)
+    systems = [System(domain, complexity) for _ in range(num_envs)]
+    inputs = [([], 1.0)] * num_envs
+    env_time, num_dialogs = 0.0, 0
+    for _ in range(num_steps):
+        actions, suggestions = [], []
+        for system, (usr_as, conf) in zip(systems, inputs):
+            _, _, sys_as, _, stat_query = system.step(usr_as, conf)
+            actions.append(sys_as)
+            suggestions.append(sys_nlg.generate_sent(sys_as, domain=domain, stat_query=stat_query)[2])
+        start = time.time()
+        obs, rewards, dones, infos = env.step(actions, suggestions)
+        env_time += time.time() - start
+        inputs = [(info['actions'], float(conf)) for info, conf in zip(infos, obs['conf'])]
+        for row in np.flatnonzero(dones):
+            systems[row] = System(domain, complexity)
+            inputs[row] = ([], 1.0)
+        num_dialogs += int(dones.sum())
+    print("env: %d envs, %d dialogs done, %.0f user turns/s, %.1f us/turn"
+          % (num_envs, num_dialogs, num_envs * num_steps / env_time, env_time / (num_envs * num_steps) * 1e6))
+
+
+def bench_server(num_turns=50000, num_sessions=1000):
+    """
+    Load test a UserServer in a child process over a Unix socket, num_sessions dialogs at once.
+    """
+    domain = Domain(RestSpec())
+    complexity = Complexity(CleanSpec)
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'users.sock')
+    server = multiprocessing.Process(target=UserServer(domain, complexity).run, kwargs={'path': path})
+    server.start()
+    try:
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        result = asyncio.run(load_test(domain, complexity, num_turns, num_sessions, path=path))
+        latency = result['latency']
+        print("server: %d sessions, %d turns, %d dialogs, %.0f turns/s"
+              % (num_sessions, result['turns'], result['dialogs'], result['turns'] / result['seconds']))
+        print("  round trip p50 %.2f ms, p99 %.2f ms, server %.0f us/request mean, %.1f ms max"
+              % (np.percentile(latency, 50) * 1e3, np.percentile(latency, 99) * 1e3,
+                 result['server']['mean_us'], result['server']['max_us'] / 1e3))
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(tmp_dir)
+
+
+BENCHMARKS = {'advice': bench_advice,
+              'backend': bench_backend,
+              'cube': bench_cube,
+              'sketch': bench_sketch,
+              'select_many': bench_select_many,
+              'synthetic': bench_synthetic,
+              'writer': bench_writer,
+              'acts': bench_acts,
+              'actions': bench_actions,
+              'gen': bench_gen,
+              'batch': bench_batch,
+              'env': bench_env,
+              'server': bench_server}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or sorted(BENCHMARKS.keys()):
+        BENCHMARKS[name]()
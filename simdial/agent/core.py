@@ -2,7 +2,11 @@
 # author: Tiancheng Zhao
 
 import logging
-import copy
+try:
+    from sys import intern
+except ImportError:
+    # python 2 has a builtin intern
+    pass
 
 
 class Agent(object):
@@ -23,27 +27,85 @@ class Agent(object):
         raise NotImplementedError("Implement step function is required")
 
 
-class Action(dict):
+def _intern_slot(parameter):
+    # a (slot, value) parameter with the interned slot name, the same tuple if it already is
+    if type(parameter) is tuple and len(parameter) == 2 and type(parameter[0]) is str:
+        slot = intern(parameter[0])
+        if slot is not parameter[0]:
+            return slot, parameter[1]
+    return parameter
+
+
+class Action(object):
     """
     A generic class that corresponds to a discourse unit. An action is made of an Act and a list of parameters.
+    Actions are immutable values, so turns, dialog states and corpora can share them: replace makes
+    a modified copy. An action only holds the index of its act in ACTS and its parameters, whose
+    slot names are interned, so a corpus of millions of actions stays small.
     
-    :ivar act: dialog act String
-    :ivar parameters: [{slot -> usr_constrain}, {sys_slot -> value}] for INFORM, and [(type, value)...] for other acts. 
+    :ivar act_id: the index of the act in ACTS
+    :ivar parameters: ({slot -> usr_constrain}, {sys_slot -> value}) for INFORM, and ((type, value)...) for other acts. 
+    :cvar ACTS: the acts of SystemAct and UserAct, sorted
     
     """
 
+    __slots__ = ('act_id', 'parameters')
+
+    ACTS = []
+    ACT_IDS = {}
+
     def __init__(self, act, parameters=None):
-        self.act = act
         if parameters is None:
-            self.parameters = []
-        elif type(parameters) is not list:
-            self.parameters = [parameters]
+            parameters = ()
+        elif type(parameters) is list:
+            parameters = tuple([_intern_slot(p) for p in parameters])
         else:
-            self.parameters = parameters
-        super(Action, self).__init__(act=self.act, parameters=self.parameters)
+            parameters = (_intern_slot(parameters),)
+        act_id = self.ACT_IDS.get(act)
+        if act_id is None:
+            raise ValueError("Unknown dialog act %s" % act)
+        object.__setattr__(self, 'act_id', act_id)
+        object.__setattr__(self, 'parameters', parameters)
+
+    @property
+    def act(self):
+        """
+        dialog act String
+        """
+        return self.ACTS[self.act_id]
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Action is immutable, use replace")
+
+    def __reduce__(self):
+        # by act name, the ids of other processes may differ
+        return Action, (self.act, list(self.parameters))
+
+    def __eq__(self, other):
+        return isinstance(other, Action) and self.act_id == other.act_id and self.parameters == other.parameters
 
-    def add_parameter(self, type, value):
-        self.parameters.append((type, value))
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Action(%r, %r)" % (self.act, self.parameters)
+
+    def replace(self, act=None, parameters=None):
+        """
+        :param act: the new act, None to keep it
+        :param parameters: a sequence of the new parameters, None to keep them
+        :return: a copy of this action with the given act and parameters
+        """
+        return Action(self.act if act is None else act,
+                      list(self.parameters if parameters is None else parameters))
+
+    def to_json(self):
+        """
+        :return: {"act": act, "parameters": [...]}, the JSON object of the action
+        """
+        return {'act': self.act, 'parameters': self.parameters}
 
     def dump_string(self):
         str_paras = []
@@ -109,8 +171,8 @@ class State(object):
         :param speaker: SYS or USR
         :param actions: a list of Action
         """
-        # make a deep copy of actions
-        self.history.append((speaker, copy.deepcopy(actions)))
+        # actions are immutable, only the list can change
+        self.history.append((speaker, list(actions)))
 
 
 class SystemAct(object):
@@ -166,6 +228,11 @@ class UserAct(object):
     RESTART = "restart"
 
 
+Action.ACTS = sorted(set(v for act_cls in [SystemAct, UserAct]
+                        for k, v in vars(act_cls).items() if not k.startswith('_') and isinstance(v, str)))
+Action.ACT_IDS = dict((act, i) for i, act in enumerate(Action.ACTS))
+
+
 class BaseSysSlot(object):
     """
     :cvar DEFAULT: the db entry
@@ -6,7 +6,6 @@ import numpy as np
 from simdial.agent.core import SystemAct, UserAct, BaseUsrSlot
 from simdial.agent import core
 import json
-import copy
 
 
 class AbstractNlg(object):
@@ -119,7 +118,8 @@ class SysNlg(AbstractNlg):
         str_actions = []
         lexicalized_actions = []
         for a in actions:
-            a_copy = copy.deepcopy(a)
+            # a lexicalized copy replaces the action when its parameters change
+            lex_a = a
             requested_slot = None
             if a.act == SystemAct.GREET:
                 if domain:
@@ -140,8 +140,7 @@ class SysNlg(AbstractNlg):
                     else:
                         search_dict[k] = slot.vocabulary[v]
 
-                a_copy.parameters[0] = search_dict
-                a_copy.parameters[1] = sys_goals
+                lex_a = a.replace(parameters=(search_dict, sys_goals) + a.parameters[2:])
                 str_actions.append(json.dumps({"QUERY": search_dict,
                                                "GOALS": sys_goals}))
 
@@ -161,7 +160,7 @@ class SysNlg(AbstractNlg):
                         prefix = ""
                     informs.append(prefix + slot.sample_inform()
                                    % slot.vocabulary[v])
-                a_copy['parameters'] = [sys_goal_dict]
+                lex_a = a.replace(parameters=[sys_goal_dict])
                 str_actions.append(" ".join(informs))
 
             elif a.act == SystemAct.REQUEST:
@@ -179,23 +178,23 @@ class SysNlg(AbstractNlg):
                 slot_type, slot_val = a.parameters[0]
                 if slot_val is None:
                     str_actions.append(self.sample(templates[SystemAct.EXPLICIT_CONFIRM+"dont_care"]))
-                    a_copy.parameters[0] = (slot_type, "dont_care")
+                    lex_a = a.replace(parameters=((slot_type, "dont_care"),) + a.parameters[1:])
                 else:
                     slot = self.domain.get_usr_slot(slot_type)
                     str_actions.append("Do you mean %s?"
                                        % slot.vocabulary[slot_val])
-                    a_copy.parameters[0] = (slot_type, slot.vocabulary[slot_val])
+                    lex_a = a.replace(parameters=((slot_type, slot.vocabulary[slot_val]),) + a.parameters[1:])
 
             elif a.act == SystemAct.IMPLICIT_CONFIRM:
                 slot_type, slot_val = a.parameters[0]
                 if slot_val is None:
                     str_actions.append(self.sample(templates[SystemAct.IMPLICIT_CONFIRM+"dont_care"]))
-                    a_copy.parameters[0] = (slot_type, "dont_care")
+                    lex_a = a.replace(parameters=((slot_type, "dont_care"),) + a.parameters[1:])
                 else:
                     slot = self.domain.get_usr_slot(slot_type)
                     str_actions.append("I believe you said %s."
                                        % slot.vocabulary[slot_val])
-                    a_copy.parameters[0] = (slot_type, slot.vocabulary[slot_val])
+                    lex_a = a.replace(parameters=((slot_type, slot.vocabulary[slot_val]),) + a.parameters[1:])
 
             elif a.act in templates.keys():
                 str_actions.append(self.sample(templates[a.act]))
@@ -203,25 +202,17 @@ class SysNlg(AbstractNlg):
             else:
                 raise ValueError("Unknown dialog act %s" % a.act)
 
-            lexicalized_actions.append(a_copy)
+            lexicalized_actions.append(lex_a)
         
         stat_query, advice = stat_query
-#         print(stat_query, advice)
         suggestion = {}
         def add_to_suggestion(sug, i):
-            if i==0:
-                if "#food" not in sug:
-                    sug["#food"] = c
-            elif i==1:
-                if "#area" not in sug:
-                    sug["#area"] = c
-            elif i==2:
-                if "#pricerange" not in sug:
-                    sug["#pricerange"] = c
+            if "#" + names[i] not in sug:
+                sug["#" + names[i]] = c
             return sug
         
         advice_nlg = ''
-        names = ['food', 'area', 'pricerange']
+        names = [s.name[1:] for s in self.domain.usr_slots]
         given = []            
         t = ''        
         for i, q in enumerate(stat_query):
@@ -231,19 +222,11 @@ class SysNlg(AbstractNlg):
         if len(given)==0 and len(advice)>0:         
             #if no constraint is imposed
             to_convey = 0
-#             if target_slot is not None:
-#                 from_ad = 
             from_ad = np.random.choice(len(advice))
             if requested_slot is not None:
-                if requested_slot == '#food':
-                    ad = [i for i, ad in enumerate(advice) if ad[0]!='']
-                    from_ad = ad[0]
-                elif requested_slot == '#area':
-                    ad = [i for i, ad in enumerate(advice) if ad[1]!='']
-                    from_ad = ad[0]
-                elif requested_slot == '#pricerange':
-                    ad = [i for i, ad in enumerate(advice) if ad[2]!='']
-                    from_ad = ad[0] 
+                slot_id = names.index(requested_slot[1:])
+                ad = [i for i, ad in enumerate(advice) if ad[slot_id]!='']
+                from_ad = ad[0]
             
             for i, c in enumerate(advice[from_ad]):
                 if c!='':
@@ -253,20 +236,8 @@ class SysNlg(AbstractNlg):
 
             if to_convey is not None:
                 t += ':'+names[to_convey]
-                advice_nlg = adv_templates[t][0]
-                advice_nlg = advice_nlg.split()
-                for i, word in enumerate(advice_nlg):
-                    if word[0]=='<' and word[-1]=='>':
-                        if word == '<FOOD>':
-                            target_slot = self.domain.get_usr_slot('#food')
-                            advice_nlg[i] = target_slot.vocabulary[int(advice[from_ad][0])]
-                        elif word == "<AREA>":
-                            target_slot = self.domain.get_usr_slot('#area')
-                            advice_nlg[i] = target_slot.vocabulary[int(advice[from_ad][1])]
-                        elif word == '<PRICERANGE>':
-                            target_slot = self.domain.get_usr_slot('#pricerange')
-                            advice_nlg[i] = target_slot.vocabulary[int(advice[from_ad][2])]
-#             print(advice_nlg)
+                if t in adv_templates:
+                    advice_nlg = self._fill_advice(adv_templates[t][0], names, [advice[from_ad]])
         
         elif len(advice) > 1:
             for i, q in enumerate(stat_query):
@@ -275,122 +246,29 @@ class SysNlg(AbstractNlg):
                     t += names[i]+'_'
             t = t[:-1] + ':'
             
-            if advice[0][-1] == advice[1][-1]:# and not any(a==b for a, b in zip(advice[0][-1], advice[1][-1])):
-                to_convey = set()
-                
-                for i, c in enumerate(advice[0][:-1]):
-                    if i not in given and c!= '':
-                        to_convey.add(i)
-                        suggestion = add_to_suggestion(suggestion, i)
-                        
-                for i, c in enumerate(advice[1][:-1]):
-                    if i not in given and c!= '':
-                        to_convey.add(i)
-                        suggestion = add_to_suggestion(suggestion, i)
-                
-#                 print("to_convey: ", list(to_convey))
-                
-                to_convey = list(to_convey)
-                sorted(to_convey)
-                for c in to_convey:
-                    t += names[c] + '_'
-                
-                t = t[:-1]                
-                advice_nlg = adv_templates[t][0]
-                advice_nlg = advice_nlg.split()                
-                for i, word in enumerate(advice_nlg):
-                    if word[0]=='<' and word[-1]=='>':
-                        if word == '<FOOD>':
-                            target_slot = self.domain.get_usr_slot('#food')
-                            if advice[0][0] != '':
-                                advice_nlg[i] = target_slot.vocabulary[int(advice[0][0])]
-                            else:
-                                advice_nlg[i] = target_slot.vocabulary[int(advice[1][0])]
-                        
-                        elif word == "<AREA>":
-                            target_slot = self.domain.get_usr_slot('#area')
-                            if advice[0][1] != '':
-                                advice_nlg[i] = target_slot.vocabulary[int(advice[0][1])]
-                            else:
-                                advice_nlg[i] = target_slot.vocabulary[int(advice[1][1])]
-                        
-                        elif word == '<PRICERANGE>':
-                            target_slot = self.domain.get_usr_slot('#pricerange')
-                            if advice[0][2] != '':
-                                advice_nlg[i] = target_slot.vocabulary[int(advice[0][2])]
-                            else:
-                                advice_nlg[i] = target_slot.vocabulary[int(advice[1][2])]
-#                 print(advice_nlg)
-            
-            else:
-                to_convey = set()
-                for i, c in enumerate(advice[0][:-1]):
-                    if i not in given and c!= '':
-                        to_convey.add(i)
-                        suggestion = add_to_suggestion(suggestion, i)
-                for i, c in enumerate(advice[1][:-1]):
-                    if i not in given and c!= '':
-                        to_convey.add(i)
-                        suggestion = add_to_suggestion(suggestion, i)
-                
-#                 print("to_convey: ", list(to_convey))                
-                to_convey = list(to_convey)
-                sorted(to_convey)
-                for c in to_convey:
-                    t += names[c] + '_'
-                    
-                t = t[:-1]
-                if len(to_convey) > 1:
-                    advice_nlg = adv_templates[t][1]
-                    advice_nlg = advice_nlg.split()                
-                    for i, word in enumerate(advice_nlg):
-                        if word[0]=='<' and word[-1]=='>':
-                            if word == '<FOOD>':
-                                target_slot = self.domain.get_usr_slot('#food')
-                                if advice[0][0] != '':
-                                    advice_nlg[i] = target_slot.vocabulary[int(advice[0][0])]
-                                else:
-                                    advice_nlg[i] = target_slot.vocabulary[int(advice[1][0])]
-                            elif word == "<AREA>":
-                                target_slot = self.domain.get_usr_slot('#area')
-                                if advice[0][1] != '':
-                                    advice_nlg[i] = target_slot.vocabulary[int(advice[0][1])]
-                                else:
-                                    advice_nlg[i] = target_slot.vocabulary[int(advice[1][1])]
-                            elif word == '<PRICERANGE>':
-                                target_slot = self.domain.get_usr_slot('#pricerange')
-                                if advice[0][2] != '':
-                                    advice_nlg[i] = target_slot.vocabulary[int(advice[0][2])]
-                                else:
-                                    advice_nlg[i] = target_slot.vocabulary[int(advice[1][2])]
+            to_convey = set()
+            for i, c in enumerate(advice[0][:-1]):
+                if i not in given and c!= '':
+                    to_convey.add(i)
+                    suggestion = add_to_suggestion(suggestion, i)
+            for i, c in enumerate(advice[1][:-1]):
+                if i not in given and c!= '':
+                    to_convey.add(i)
+                    suggestion = add_to_suggestion(suggestion, i)
+
+            to_convey = sorted(to_convey)
+            for c in to_convey:
+                t += names[c] + '_'
+            t = t[:-1]
+
+            if t in adv_templates:
+                if advice[0][-1] == advice[1][-1]:
+                    advice_nlg = self._fill_advice(adv_templates[t][0], names, advice[0:2])
+                elif len(to_convey) > 1:
+                    advice_nlg = self._fill_advice(adv_templates[t][1], names, advice[0:2])
                 else:
-                    advice_nlg = adv_templates[t][1]
-                    advice_nlg = advice_nlg.split()
-                    flag = [False, False, False]
-                    for i, word in enumerate(advice_nlg):
-                        if word[0]=='<' and word[-1]=='>':
-                            if word == '<FOOD>':
-                                target_slot = self.domain.get_usr_slot('#food')
-                                if not flag[0]:
-                                    advice_nlg[i] = target_slot.vocabulary[int(advice[0][0])]
-                                    flag[0] = True
-                                else:
-                                    advice_nlg[i] = target_slot.vocabulary[int(advice[1][0])]
-                            elif word == "<AREA>":
-                                target_slot = self.domain.get_usr_slot('#area')
-                                if not flag[1]:
-                                    advice_nlg[i] = target_slot.vocabulary[int(advice[0][1])]
-                                    flag[1] = True
-                                else:
-                                    advice_nlg[i] = target_slot.vocabulary[int(advice[1][1])]
-                            elif word == '<PRICERANGE>':
-                                target_slot = self.domain.get_usr_slot('#pricerange')
-                                if not flag[2]:
-                                    advice_nlg[i] = target_slot.vocabulary[int(advice[0][2])]
-                                    flag[2] = True
-                                else:
-                                    advice_nlg[i] = target_slot.vocabulary[int(advice[1][2])]                    
-#                 print(advice_nlg)
+                    advice_nlg = self._fill_advice(adv_templates[t][1], names, advice[0:2], by_occurrence=True)
+
         elif len(advice)==1:
             for i, q in enumerate(stat_query):
                 if q is not None:
@@ -404,29 +282,39 @@ class SysNlg(AbstractNlg):
                     suggestion = add_to_suggestion(suggestion, i)
                     break
                 
-#                 print("to_convey: ", to_convey)                
             if to_convey is not None:
                 t += names[to_convey]                
-                advice_nlg = adv_templates[t][0]
-                advice_nlg = advice_nlg.split()                
-                for i, word in enumerate(advice_nlg):
-                    if word[0]=='<' and word[-1]=='>':
-                        if word == '<FOOD>':
-                            target_slot = self.domain.get_usr_slot('#food')
-                            advice_nlg[i] = target_slot.vocabulary[int(advice[0][0])]
-
-                        elif word == "<AREA>":
-                            target_slot = self.domain.get_usr_slot('#area')
-                            advice_nlg[i] = target_slot.vocabulary[int(advice[0][1])]
-
-                        elif word == '<PRICERANGE>':
-                            target_slot = self.domain.get_usr_slot('#pricerange')
-                            advice_nlg[i] = target_slot.vocabulary[int(advice[0][2])]
-
-#                 print(advice_nlg)            
+                if t in adv_templates:
+                    advice_nlg = self._fill_advice(adv_templates[t][0], names, advice[0:1])
                                     
         return " ".join(str_actions) + '. ' + ' '.join(advice_nlg), lexicalized_actions, suggestion
 
+    def _fill_advice(self, template, names, rows, by_occurrence=False):
+        """
+        Replace the <SLOT> placeholders of an advice template, e.g. <FOOD> for the slot food.
+
+        :param template: an advice template
+        :param names: the user slot names without #, in the column order of the advice rows
+        :param rows: the advice rows, a slot takes its value from the first row where it is set
+        :param by_occurrence: take the first occurrence of a slot from rows[0] and the others from rows[1]
+        :return: the list of words
+        """
+        slot_ids = dict(('<%s>' % name.upper(), i) for i, name in enumerate(names))
+        seen = set()
+        words = template.split()
+        for w_id, word in enumerate(words):
+            slot_id = slot_ids.get(word)
+            if slot_id is None:
+                continue
+            if by_occurrence:
+                value = rows[1][slot_id] if slot_id in seen else rows[0][slot_id]
+                seen.add(slot_id)
+            else:
+                value = next((row[slot_id] for row in rows if row[slot_id] != ''), rows[-1][slot_id])
+            target_slot = self.domain.get_usr_slot('#' + names[slot_id])
+            words[w_id] = target_slot.vocabulary[int(value)]
+        return words
+
 class UserNlg(AbstractNlg):
     """
     NLG class to generate utterances for the user side.
@@ -71,6 +71,10 @@ class BeliefSlot(object):
             return 0.0
         return max([s for s in self.value_map.values()])
 
+    def remove_value(self, value, turn_id):
+        self.last_update_turn = turn_id
+        self.value_map.pop(value, None)
+
     def clear(self, turn_id):
         middle = (self.IMPLICIT_THRESHOLD+self.EXPLICIT_THRESHOLD)/2.
         self.value_map = {k: middle for k in self.value_map.keys()}
@@ -108,7 +112,7 @@ class DialogState(State):
 
     :ivar history: the raw dialog history
     :ivar spk_state: the FSM state for turn-taking. SPK, LISTEN or EXIT
-    :ivar valid_entries: a list of valid system entries satisfy the user belief
+    :ivar num_valid: the number of system entries that satisfy the user belief
     :ivar usr_beliefs: a dict of slot name -> BeliefSlot()
     :ivar sys_goals:  a dict of system goal that is obligated to answer
     """
@@ -121,7 +125,7 @@ class DialogState(State):
         self.usr_beliefs = OrderedDict([(s.name, BeliefSlot(s.name, s.vocabulary)) for s in domain.usr_slots])
         self.sys_goals = OrderedDict([(s.name, BeliefGoal(s.name)) for s in domain.sys_slots])
         self.sys_goals[BaseSysSlot.DEFAULT] = BeliefGoal(BaseSysSlot.DEFAULT, conf=1.0)
-        self.valid_entries = domain.db.select(self.gen_query())
+        self.num_valid = domain.db.count(self.gen_query())
         self.pending_return = None
         self.domain = domain
         self.restart = False
@@ -297,6 +301,23 @@ class System(Agent):
                 self.state.usr_beliefs[slot].add_grounding(1.0, 0.0, self.state.turn_id())
                 
 
+    def relax_beliefs(self, stat_query):
+        """
+        Drop the believed value of the user slot whose removal matches the most KB entries, so
+        that the advice suggests alternatives for it and the slot is asked again.
+
+        :param stat_query: the current query, which matches no entry
+        :return: the relaxed query, None if no relaxation matches anything
+        """
+        for relaxed, count in self.domain.db.get_relaxations(stat_query):
+            dropped = [i for i, v in enumerate(relaxed) if v is None and stat_query[i] is not None]
+            if dropped:
+                slot = list(self.state.usr_beliefs.values())[dropped[0]]
+                slot.remove_value(stat_query[dropped[0]], self.state.turn_id())
+                self.logger.info("No match, relax %s to %d entries" % (slot.uid, count))
+                return list(relaxed)
+        return None
+
     def policy(self):
         if len(self.state.history) > 100:
             return Action(SystemAct.GOODBYE), ([], [])
@@ -327,17 +348,8 @@ class System(Agent):
                 self.state.spk_state = State.EXIT
                 return Action(SystemAct.GOODBYE), ([], [])
 
-        constraints = [(key, slot.get_maxconf_value()) for key, slot in self.state.usr_beliefs.items()]
-        cols = {'food':0, 'area':1, 'pricerange':2}
-        stat_query = [None, None, None]
-        for c in constraints:
-            a, b = c
-            if a == '#area':
-                stat_query[cols['area']] = b
-            elif a == "#pricerange":
-                stat_query[cols['pricerange']] = b
-            else:
-                stat_query[cols['food']] = b
+        # usr_beliefs follows domain.usr_slots, which is also the column order of the database
+        stat_query = [slot.get_maxconf_value() for slot in self.state.usr_beliefs.values()]
                 
 #         if random.random() <= 0.1:
 #             advice = self.domain.db.get_advice(stat_query)
@@ -384,7 +396,11 @@ class System(Agent):
             if random.random() <= 1.0:
                 advice = self.domain.db.get_advice(stat_query)
                 if self.state.atleast_1_slot and (len(advice)==0):
-                    return Action(SystemAct.RESTART), ([], [])            
+                    relaxed = self.relax_beliefs(stat_query) if self.domain.relax_no_match else None
+                    if relaxed is None:
+                        return Action(SystemAct.RESTART), ([], [])
+                    stat_query = relaxed
+                    advice = self.domain.db.get_advice(stat_query)
             implicit_confirms = []
             exp_confirms = []
             requests = []
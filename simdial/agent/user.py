@@ -3,7 +3,6 @@
 from simdial.agent.core import Agent, Action, UserAct, SystemAct, BaseSysSlot, BaseUsrSlot, State
 import logging
 import numpy as np
-import copy
 from collections import OrderedDict
 import random
 
@@ -71,11 +70,15 @@ class User(Agent):
         def reset_goal(self, sys_goals):
             self.goals_met = {g: False for g in sys_goals}
 
-    def __init__(self, domain, complexity, advice_prob=1.0):
+    def __init__(self, domain, complexity, advice_prob=1.0, goal_row=None):
+        """
+        :param goal_row: the KB row of the first goal, e.g. drawn with the other users of a batch by
+        Database.sample_unique_rows, None to sample it
+        """
         super(User, self).__init__(domain, complexity)
-        self.goal_cnt = np.random.choice(complexity.multi_goals.keys(), p=complexity.multi_goals.values())
+        self.goal_cnt = np.random.choice(list(complexity.multi_goals.keys()), p=list(complexity.multi_goals.values()))
         self.goal_ptr = 0
-        self.usr_constrains, self.sys_goals, self.usr_cons_readable = self._sample_goal()
+        self.usr_constrains, self.sys_goals, self.usr_cons_readable = self._sample_goal(goal_row)
 #         print(self.usr_cons_readable)
         self.state = self.DialogState(self.sys_goals)
         self.advice_prob = advice_prob
@@ -88,14 +91,17 @@ class User(Agent):
         """
         self.state.update_history(self.state.SYS, sys_actions)
         self.state.spk_state = self.DialogState.SPEAK
-        self.state.input_buffer = copy.deepcopy(sys_actions)
+        self.state.input_buffer = list(sys_actions)
 
-    def _sample_goal(self):
+    def _sample_goal(self, goal_row=None):
         """
+        :param goal_row: the KB row to constrain, None to sample one
         :return: {slot_name -> value} for user constrains, [slot_name, ..] for system goals
         """
 #         print(self.domain.db.table)
-        temp_constrains = self.domain.db.sample_unique_row().tolist()
+        if goal_row is None:
+            goal_row = self.domain.db.sample_unique_row()
+        temp_constrains = goal_row.tolist()
 #         print(temp_constrains)
 #         exit()
         temp_constrains = [None if np.random.rand() < self.complexity.dont_care
@@ -128,7 +134,7 @@ class User(Agent):
         else:
             self.goal_ptr += 1
             _, self.sys_goals, _ = self._sample_goal()
-            change_key = np.random.choice(self.usr_constrains.keys())
+            change_key = np.random.choice(list(self.usr_constrains.keys()))
             change_slot = self.domain.get_usr_slot(change_key)
             old_value = self.usr_constrains[change_key]
             old_value = -1 if old_value is None else old_value
@@ -172,8 +178,8 @@ class User(Agent):
                 if slot_val == self.usr_constrains[slot_type] or self.usr_constrains[slot_type] is None:
                     return None
                 else:
-                    strategy = np.random.choice(self.complexity.reject_style.keys(),
-                                                p=self.complexity.reject_style.values())
+                    strategy = np.random.choice(list(self.complexity.reject_style.keys()),
+                                                p=list(self.complexity.reject_style.values()))
                     if strategy == "reject":
                         return Action(UserAct.DISCONFIRM, (slot_type, slot_val))
                     elif strategy == "reject+inform":
@@ -246,8 +252,8 @@ class User(Agent):
 
             elif self.domain.is_usr_slot(slot_type):
                 if len(self.domain.usr_slots) > 1:
-                    num_informs = np.random.choice(self.complexity.multi_slots.keys(),
-                                                   p=self.complexity.multi_slots.values(),
+                    num_informs = np.random.choice(list(self.complexity.multi_slots.keys()),
+                                                   p=list(self.complexity.multi_slots.values()),
                                                    replace=False)
                     if num_informs > 1:
                         candidates = [k for k, v in self.usr_constrains.items() if k != slot_type and v is not None]
@@ -276,17 +282,14 @@ class User(Agent):
             last_usr_actions = self.state.last_actions(self.state.USR)
             if last_usr_actions is None:
                 raise ValueError("Unexpected ask rephrase")
-            for a in last_usr_actions:
-                a.add_parameter(BaseUsrSlot.AGAIN, True)
-            return last_usr_actions
+            return [a.replace(parameters=a.parameters + ((BaseUsrSlot.AGAIN, True),)) for a in last_usr_actions]
 
         elif top_action.act == SystemAct.QUERY:
             query, goals = top_action.parameters[0], top_action.parameters[1]
-            valid_entries = self.domain.db.select([v for name, v in query])
+            chosen_entry = self.domain.db.sample_entry([v for name, v in query])
 
             results = {}
-            if len(valid_entries)>0:#chosen_entry.shape[0] > 0:
-                chosen_entry = valid_entries[np.random.randint(0, len(valid_entries)), :]                
+            if chosen_entry is not None:
                 for goal in goals:
                     _, slot_id = self.domain.get_sys_slot(goal, return_idx=True)
                     results[goal] = chosen_entry[slot_id]
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+from simdial.database import GoalSampler
+from simdial.table import ColumnTable
+from simdial.cube import DataCube, AdviceIndex
+import numpy as np
+import logging
+import sqlite3
+import json
+import os
+
+
+class KBBackend(object):
+    """
+    Abstract storage behind Database.select, count, sample_entry, get_advice and sample_unique_row.
+    See Database.from_backend.
+
+    :ivar num_rows: the number of KB entries
+    :ivar usr_slot_names: the name of each searchable attribute
+    :ivar usr_modalities: the vocab size of each searchable attribute
+    :ivar sys_modalities: the vocab size of each non-searchable attribute
+    """
+
+    num_rows = None
+    usr_slot_names = None
+    usr_modalities = None
+    sys_modalities = None
+
+    def select(self, query):
+        """
+        :param query: a tuple with one value per searchable attribute, None means don't care
+        :return: an iterator of the system entries [UID + sys attributes] that match, in UID order,
+        read as it is consumed
+        """
+        raise NotImplementedError("Implement select function is required")
+
+    def count(self, query):
+        """
+        :param query: a tuple with one value per searchable attribute, None means don't care
+        :return: the number of entries that match
+        """
+        raise NotImplementedError("Implement count function is required")
+
+    def entry(self, query, rank):
+        """
+        :param query: a tuple with one value per searchable attribute, None means don't care
+        :param rank: 0 <= rank < count(query)
+        :return: 1D array, the system entry [UID + sys attributes] of the rank-th match in UID order
+        """
+        raise NotImplementedError("Implement entry function is required")
+
+    def get_advice(self, constraints):
+        """
+        :param constraints: one value per searchable attribute, None means not given
+        :return: a list of [value or '' for each attribute, count], see Database.get_advice
+        """
+        raise NotImplementedError("Implement get_advice function is required")
+
+    def get_relaxations(self, constraints):
+        """
+        :param constraints: one value per searchable attribute, None means not given
+        :return: a list of (relaxed constraint tuple, count), see Database.get_relaxations
+        """
+        raise NotImplementedError("Implement get_relaxations function is required")
+
+    def sample_unique_row(self):
+        """
+        :return: 1D array, a user goal
+        """
+        raise NotImplementedError("Implement sample_unique_row function is required")
+
+
+class SQLiteBackend(KBBackend):
+    """
+    A KB stored in a SQLite file, so that only the rows a query touches are loaded into memory.
+
+    The file has four tables:
+    kb(uid, u0 .. uk, s0 .. sm) with one index per searchable attribute,
+    stat(u0 .. uk, count) the count of every combination of all the searchable attributes in
+    lexicographic order, goal(u0 .. uk, weight, cum_weight) the unique user goals and their frequency,
+    meta(key, value) the slot names, modalities and the advice without any constraint.
+    """
+
+    logger = logging.getLogger(__name__)
+    TOP_K = 6
+
+    def __init__(self, path, goal_sampling=GoalSampler.UNIFORM):
+        """
+        :param path: a file written by SQLiteBackend.build
+        :param goal_sampling: GoalSampler.UNIFORM or GoalSampler.FREQUENCY
+        """
+        if goal_sampling not in [GoalSampler.UNIFORM, GoalSampler.FREQUENCY]:
+            raise ValueError("Unknown goal sampling mode %s" % goal_sampling)
+        self.path = path
+        self._conn = None
+        self._conn_pid = None
+        self._inherited = []
+        meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+        self.num_rows = int(meta['num_rows'])
+        self.usr_slot_names = json.loads(meta['usr_slot_names'])
+        self.usr_modalities = json.loads(meta['usr_modalities'])
+        self.sys_modalities = json.loads(meta['sys_modalities'])
+        self.goal_sampling = goal_sampling
+        self.num_goals, self.total_weight = self.conn.execute("SELECT COUNT(*), SUM(weight) FROM goal").fetchone()
+        self.top_advice = json.loads(meta['top_advice'])
+
+        usr_cols = ["u%d" % i for i in range(len(self.usr_modalities))]
+        sys_cols = ["s%d" % i for i in range(len(self.sys_modalities))]
+        self._usr_cols = ", ".join(usr_cols)
+        self._entry_cols = ", ".join(["uid"] + sys_cols)
+        # the dtype of a row of the ColumnTable of Database.select
+        self._entry_dtype = np.result_type(*[ColumnTable.narrowest_dtype(m)
+                                             for m in [self.num_rows] + self.sys_modalities])
+
+    @property
+    def conn(self):
+        """
+        The connection of this process, opened on first use. A forked worker (e.g. of the pool of
+        Generator.iter_dialogs) opens its own, SQLite connections must not be used across fork.
+        """
+        if self._conn_pid != os.getpid():
+            if self._conn is not None:
+                # closing it would also touch the state the parent shares, keep it alive instead
+                self._inherited.append(self._conn)
+            self._conn = sqlite3.connect(self.path)
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    @classmethod
+    def build(cls, path, usr_slot_names, usr_modalities, sys_modalities, chunks, goals):
+        """
+        Write a KB file, streaming the entries in chunks.
+
+        :param path: the SQLite file, replaced if it exists
+        :param chunks: iterable of (usr_block [n x num_usr_slots], sys_block [n x num_sys_slots])
+        in UID order
+        :param goals: 2D int array of user goals, rows may repeat
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        usr_cols = ["u%d" % i for i in range(len(usr_modalities))]
+        sys_cols = ["s%d" % i for i in range(len(sys_modalities))]
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE kb (uid INTEGER PRIMARY KEY, %s)"
+                     % ", ".join("%s INTEGER" % c for c in usr_cols + sys_cols))
+        conn.execute("CREATE TABLE stat (%s, count INTEGER)" % ", ".join("%s INTEGER" % c for c in usr_cols))
+        conn.execute("CREATE TABLE goal (%s, weight INTEGER, cum_weight INTEGER)"
+                     % ", ".join("%s INTEGER" % c for c in usr_cols))
+
+        insert = "INSERT INTO kb VALUES (%s)" % ", ".join(["?"] * (1 + len(usr_cols) + len(sys_cols)))
+        num_rows = 0
+        for usr_block, sys_block in chunks:
+            uids = np.arange(num_rows, num_rows + len(usr_block))
+            block = np.concatenate([uids[:, None], np.asarray(usr_block), np.asarray(sys_block)], axis=1)
+            conn.executemany(insert, block.tolist())
+            num_rows += len(usr_block)
+
+        # an index entry ends with the rowid, the uid, so the rows of a value come in uid order
+        for col in usr_cols:
+            conn.execute("CREATE INDEX kb_%s ON kb (%s)" % (col, col))
+
+        counts = conn.execute("SELECT %s, COUNT(*) FROM kb GROUP BY %s ORDER BY %s"
+                              % ((", ".join(usr_cols),) * 3)).fetchall()
+        counts = np.array(counts, dtype=np.int64).reshape(-1, len(usr_cols) + 1)
+        conn.executemany("INSERT INTO stat VALUES (%s)" % ", ".join(["?"] * (len(usr_cols) + 1)), counts.tolist())
+        conn.execute("CREATE INDEX stat_count ON stat (count DESC)")
+        top_advice = AdviceIndex(DataCube(counts[:, :-1], counts[:, -1])).lookup([])
+
+        unique_goals, weights = np.unique(np.asarray(goals), axis=0, return_counts=True)
+        conn.executemany("INSERT INTO goal VALUES (%s)" % ", ".join(["?"] * (len(usr_cols) + 2)),
+                         np.concatenate([unique_goals, weights[:, None], np.cumsum(weights)[:, None]], axis=1).tolist())
+        conn.execute("CREATE INDEX goal_cum_weight ON goal (cum_weight)")
+
+        meta = {'num_rows': str(num_rows),
+                'usr_slot_names': json.dumps(list(usr_slot_names)),
+                'usr_modalities': json.dumps([int(m) for m in usr_modalities]),
+                'sys_modalities': json.dumps([int(m) for m in sys_modalities]),
+                'top_advice': json.dumps(top_advice)}
+        conn.executemany("INSERT INTO meta VALUES (?, ?)", list(meta.items()))
+        conn.execute("ANALYZE")
+        conn.commit()
+        conn.close()
+        cls.logger.info("Built SQLite KB %s with %d rows" % (path, num_rows))
+
+    @classmethod
+    def from_database(cls, path, db, chunk_size=100000):
+        """
+        Copy the tables of an in-memory Database into a KB file.
+        """
+        def chunks():
+            for start in range(0, db.num_rows, chunk_size):
+                rows = slice(start, start + chunk_size)
+                yield np.asarray(db.table[rows]), np.asarray(db.sys_table[rows])[:, 1:]
+
+        cls.build(path, db.usr_slot_names, db.usr_modalities, db.sys_modalities, chunks(), np.asarray(db.cons_table))
+
+    @staticmethod
+    def _where(query):
+        given = [(i, int(q)) for i, q in enumerate(query) if q is not None]
+        if not given:
+            return "", []
+        return " WHERE " + " AND ".join("u%d = ?" % i for i, _ in given), [v for _, v in given]
+
+    def select(self, query):
+        where, values = self._where(query)
+        return self.conn.execute("SELECT %s FROM kb%s ORDER BY uid" % (self._entry_cols, where), values)
+
+    def count(self, query):
+        where, values = self._where(query)
+        if not where:
+            return self.num_rows
+        return self.conn.execute("SELECT COUNT(*) FROM kb" + where, values).fetchone()[0]
+
+    def entry(self, query, rank):
+        where, values = self._where(query)
+        if not where:
+            # the uids are 0 .. num_rows - 1
+            row = self.conn.execute("SELECT %s FROM kb WHERE uid = ?" % self._entry_cols, (int(rank),)).fetchone()
+        else:
+            row = self.conn.execute("SELECT %s FROM kb%s ORDER BY uid LIMIT 1 OFFSET ?" % (self._entry_cols, where),
+                                    values + [int(rank)]).fetchone()
+        return np.array(row, dtype=self._entry_dtype)
+
+    def get_advice(self, constraints):
+        given = [(i, int(c)) for i, c in enumerate(constraints) if c is not None]
+        if not given:
+            return self.top_advice
+        # any given constraint only matches fully specified combinations
+        sql = "SELECT %s, count FROM stat WHERE %s ORDER BY count DESC, rowid LIMIT %d" \
+              % (self._usr_cols, " AND ".join("u%d = ?" % i for i, _ in given), self.TOP_K)
+        return [list(row) for row in self.conn.execute(sql, [v for _, v in given])]
+
+    def get_relaxations(self, constraints):
+        key = tuple(None if c is None else int(c) for c in constraints)
+        given = [(i, c) for i, c in enumerate(key) if c is not None]
+        relaxations = []
+        for i, _ in given:
+            others = [(j, c) for j, c in given if j != i]
+            sql = "SELECT u%d, COUNT(*) FROM kb" % i
+            if others:
+                sql += " WHERE " + " AND ".join("u%d = ?" % j for j, _ in others)
+            counts = self.conn.execute(sql + " GROUP BY u%d ORDER BY u%d" % (i, i), [c for _, c in others]).fetchall()
+            relaxed = list(key)
+            relaxed[i] = None
+            relaxations.append((tuple(relaxed), sum(count for _, count in counts)))
+            for value, count in counts:
+                if value != key[i]:
+                    relaxed[i] = value
+                    relaxations.append((tuple(relaxed), count))
+        relaxations = [r for r in relaxations if r[1] > 0]
+        relaxations.sort(key=lambda r: -r[1])
+        return relaxations
+
+    def sample_unique_row(self):
+        if self.goal_sampling == GoalSampler.UNIFORM:
+            row = self.conn.execute("SELECT %s FROM goal WHERE rowid = ?" % self._usr_cols,
+                                    (int(np.random.randint(1, self.num_goals + 1)),)).fetchone()
+        else:
+            row = self.conn.execute("SELECT %s FROM goal WHERE cum_weight > ? ORDER BY cum_weight LIMIT 1"
+                                    % self._usr_cols, (int(np.random.randint(0, self.total_weight)),)).fetchone()
+        return np.array(row)
+
+    def close(self):
+        if self._conn is not None and self._conn_pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+        self._conn_pid = None
@@ -0,0 +1,745 @@
+# -*- coding: utf-8 -*-
+from simdial.agent.core import SystemAct, UserAct, BaseSysSlot, BaseUsrSlot
+from simdial.agent.system import BeliefSlot, BeliefGoal
+from simdial.writer import ActCorpusWriter, ActVocab
+import numpy as np
+import logging
+
+
+class _ActRecorder(object):
+    """
+    Collects the acts and parameters of the turns of a batch of dialogs in any order, and sorts
+    them into the columns of ActCorpusWriter.encode_shard.
+    """
+
+    # the key of the first act that follows the implicit confirms and their answers
+    MAIN = 100
+
+    def __init__(self):
+        self.turns = []
+        self.acts = []
+        self.params = []
+
+    def turn(self, dialogs, turn, speaker, conf):
+        self.turns.append((dialogs, np.full(len(dialogs), turn), np.full(len(dialogs), speaker),
+                           np.broadcast_to(conf, len(dialogs))))
+
+    def act(self, dialogs, turn, key, act):
+        if len(dialogs):
+            self.acts.append((dialogs, np.full(len(dialogs), turn), np.full(len(dialogs), key),
+                              np.broadcast_to(act, len(dialogs))))
+
+    def param(self, dialogs, turn, key, p_id, slot, value):
+        if len(dialogs):
+            self.params.append((dialogs, np.full(len(dialogs), turn), np.broadcast_to(key, len(dialogs)),
+                                np.full(len(dialogs), p_id), np.broadcast_to(slot, len(dialogs)),
+                                np.broadcast_to(value, len(dialogs))))
+
+    @staticmethod
+    def _stack(records, num_cols):
+        if not records:
+            return [np.zeros(0, dtype=np.int64)] * num_cols
+        return [np.concatenate([r[i] for r in records]) for i in range(num_cols)]
+
+    def columns(self, num_dialogs):
+        t_dialog, t_turn, speaker, conf = self._stack(self.turns, 4)
+        a_dialog, a_turn, a_key, act = self._stack(self.acts, 4)
+        p_dialog, p_turn, p_key, p_id, slot, value = self._stack(self.params, 6)
+
+        # every dialog has the turns 0 .. len - 1
+        turn_counts = np.bincount(t_dialog, minlength=num_dialogs)
+        first_turn = np.concatenate([[0], np.cumsum(turn_counts)[:-1]])
+        t_order = np.lexsort((t_turn, t_dialog))
+        a_global = first_turn[a_dialog] + a_turn
+        a_sort_key = a_global * 256 + a_key
+        a_order = np.argsort(a_sort_key, kind='mergesort')
+        a_sorted_key = a_sort_key[a_order]
+        p_act = np.searchsorted(a_sorted_key, (first_turn[p_dialog] + p_turn) * 256 + p_key)
+        p_order = np.lexsort((p_id, p_act))
+
+        dtypes = dict(ActCorpusWriter.COLUMNS + [(name, '<i8') for name, _ in ActCorpusWriter.OFFSETS])
+        data = {'dialog_turns': np.cumsum(turn_counts),
+                'turn_acts': np.cumsum(np.bincount(a_global, minlength=len(t_turn))),
+                'act_params': np.cumsum(np.bincount(p_act, minlength=len(act))),
+                'speaker': speaker[t_order], 'conf': conf[t_order], 'act': act[a_order],
+                'slot': slot[p_order], 'value': value[p_order]}
+        return dict((name, np.asarray(column, dtype=dtypes[name])) for name, column in data.items())
+
+
+class BatchSimulator(object):
+    """
+    Simulates many dialogs between a User and a System in lockstep: the belief confidences, user
+    goals, goal-met flags and turn-taking state of every dialog live in numpy arrays, each round
+    advances all the active dialogs by one system turn and one user turn, and the finished dialogs
+    are retired from the arrays.
+
+    It follows the policies of System and User, the ActionChannel noise and the advice suggestions
+    of SysNlg, so its dialogs have the same distribution as the ones of Generator.gen, but it only
+    produces dialog acts: the output is the columns of the 'acts' corpus format (see
+    ActCorpusWriter), without utterances. Unlike SysNlg, a system request whose slot is missing from
+    the advice gives no suggestion. The random draws come from the global numpy random state.
+
+    :ivar domain: the Domain of the dialogs
+    :ivar complexity: the Complexity of the user and of the channel
+    :ivar advice_prob: the chance that the user takes each suggestion
+    :ivar vocab: the ActVocab of the output
+    """
+
+    logger = logging.getLogger(__name__)
+
+    BATCH_SIZE = 4096
+    # the user says goodbye when its history is longer than 100 turns
+    MAX_ROUNDS = 51
+
+    def __init__(self, domain, complexity, advice_prob=1.0):
+        self.domain = domain
+        self.complexity = complexity
+        self.advice_prob = advice_prob
+        self.db = domain.db
+        self.vocab = ActCorpusWriter.vocab(domain)
+
+        self.num_usr = len(domain.usr_slots)
+        self.num_sys = len(domain.sys_slots)
+        self.usr_dims = np.array([s.dim for s in domain.usr_slots])
+        self.sys_dims = np.array([s.dim for s in domain.sys_slots])
+        self.num_values = int(self.usr_dims.max()) + 1
+
+        self.usr_slot_ids = np.array([self.vocab.slot_ids[s.name] for s in domain.usr_slots])
+        self.sys_slot_ids = np.array([self.vocab.slot_ids[s.name] for s in domain.sys_slots])
+        self.acts = self.vocab.act_ids
+        self.slots = self.vocab.slot_ids
+
+        # the values of each system slot that the user can ask a yes/no question about
+        self.yn_dim = int(self.sys_dims[1:].max()) if self.num_sys > 1 else 1
+        self.yn_ok = np.zeros((self.num_sys, self.yn_dim), dtype=bool)
+        for s_id, slot in enumerate(domain.sys_slots):
+            if slot.name == BaseSysSlot.DEFAULT:
+                continue
+            for v_id, value in enumerate(slot.vocabulary):
+                self.yn_ok[s_id, v_id] = len(slot.yn_questions.get(value, [])) > 0
+
+        unknown = set(complexity.reject_style.keys()) - {'reject', 'reject+inform'}
+        if unknown:
+            raise ValueError("Unknown reject strategy %s" % unknown.pop())
+        self.reject_inform_prob = complexity.reject_style.get('reject+inform', 0.0)
+        self.multi_slots = (np.array(list(complexity.multi_slots.keys())),
+                            np.array(list(complexity.multi_slots.values()), dtype=np.float64))
+        self.multi_goals = (np.array(list(complexity.multi_goals.keys())),
+                            np.array(list(complexity.multi_goals.values()), dtype=np.float64))
+
+        # the advice, suggestions and relaxations of each stat query, valid for one version of the KB
+        self._memo_version = self.db.version
+        self._advice_memo = {}
+        self._suggest_memo = {}
+        self._relax_memo = {}
+
+    # -- dialog state --
+
+    def _sample_goals(self, num):
+        """
+        :return: the user constrains [num x num_usr] (-1 if the user does not care) and the system
+        goals [num x num_sys] (-1 padded), #default first then the others in random order, see User._sample_goal
+        """
+        rows = np.asarray(self.db.sample_unique_rows(num), dtype=np.int64)
+        cons = np.where(np.random.rand(num, self.num_usr) < self.complexity.dont_care, -1, rows)
+
+        num_interest = np.random.randint(0, self.num_sys - 1, size=num)
+        shuffled = np.argsort(np.random.rand(num, self.num_sys - 1), axis=1) + 1
+        goals = np.full((num, self.num_sys), -1, dtype=np.int64)
+        goals[:, 0] = 0
+        keep = np.arange(self.num_sys - 1) < num_interest[:, None]
+        goals[:, 1:] = np.where(keep, shuffled, -1)
+        return cons, goals
+
+    def _new_state(self, num):
+        cons, goals = self._sample_goals(num)
+        goal_cnt = np.random.choice(self.multi_goals[0], p=self.multi_goals[1], size=num)
+        st = {'ids': np.arange(num), 'cons': cons, 'goals': goals, 'goals_met': np.zeros(goals.shape, dtype=bool),
+              'goal_cnt': goal_cnt, 'goal_ptr': np.zeros(num, dtype=np.int64), 'usr_bye': np.zeros(num, dtype=bool)}
+        self._reset_system(st, np.ones(num, dtype=bool), allocate=True)
+        return st
+
+    def _reset_system(self, st, rows, allocate=False):
+        """
+        A new DialogState for the systems of rows.
+        """
+        num = len(rows)
+        if allocate:
+            st['beliefs'] = np.full((num, self.num_usr, self.num_values), -1.0)
+            st['g_conf'] = np.zeros((num, self.num_sys))
+            st['g_delivered'] = np.zeros((num, self.num_sys), dtype=bool)
+            st['g_value'] = np.full((num, self.num_sys), -1, dtype=np.int64)
+            st['pending'] = np.zeros(num, dtype=bool)
+            st['pending_query'] = np.full((num, self.num_usr), -1, dtype=np.int64)
+            st['atleast_1_slot'] = np.zeros(num, dtype=bool)
+        st['beliefs'][rows] = -1.0
+        st['g_conf'][rows] = 0.0
+        st['g_conf'][rows, 0] = 1.0
+        st['g_delivered'][rows] = False
+        st['g_value'][rows] = -1
+        st['pending'][rows] = False
+        st['atleast_1_slot'][rows] = False
+
+    @staticmethod
+    def _compact(st, keep):
+        for name in st:
+            st[name] = st[name][keep]
+
+    # -- beliefs, a value v of a slot is at index v + 1 and None at index 0, -1 means absent --
+
+    @staticmethod
+    def _max_conf(beliefs):
+        """
+        :return: the max confidence of each slot (0 if empty), the value with the max confidence (-1 for None or empty)
+        """
+        max_conf = beliefs.max(axis=-1)
+        # max over (conf, value) in BeliefSlot.get_maxconf_value prefers the larger value
+        idx = beliefs.shape[-1] - 1 - np.argmax(beliefs[..., ::-1], axis=-1)
+        value = np.where(max_conf < 0, -1, idx - 1)
+        return np.maximum(max_conf, 0.0), value
+
+    @staticmethod
+    def _observe(beliefs, rows, slot, value, conf):
+        """
+        BeliefSlot.add_new_observation for each row.
+        """
+        idx = value + 1
+        old = beliefs[rows, slot, idx]
+        known = old >= 0
+        beliefs[rows[known], slot[known], idx[known]] = np.maximum(old[known], conf[known]) + 0.2
+        new_rows, new_slots = rows[~known], slot[~known]
+        cells = beliefs[new_rows, new_slots]
+        beliefs[new_rows, new_slots] = np.where(cells >= 0, cells / 2, cells)
+        beliefs[new_rows, new_slots, idx[~known]] = conf[~known]
+
+    @classmethod
+    def _ground(cls, beliefs, rows, slot, confirm_conf, disconfirm_conf):
+        """
+        BeliefSlot.add_grounding of the value with the max confidence for each row.
+        """
+        max_conf, value = cls._max_conf(beliefs[rows, slot])
+        known = beliefs[rows, slot].max(axis=-1) >= 0
+        rows, slot, idx = rows[known], slot[known], value[known] + 1
+        scale = 1.0 - BeliefSlot.EXPLICIT_THRESHOLD
+        delta = (confirm_conf[known] - disconfirm_conf[known]) * scale
+        beliefs[rows, slot, idx] = np.clip(beliefs[rows, slot, idx] + delta, 0.0, 1.5)
+
+    # -- advice --
+
+    def _keys(self, values):
+        # one int per stat query, values are -1 for None
+        return np.ravel_multi_index(tuple((values + 1).T), [self.num_values] * self.num_usr)
+
+    def _query(self, key):
+        values = np.unravel_index(key, [self.num_values] * self.num_usr)
+        return [None if v == 0 else int(v) - 1 for v in values]
+
+    def _check_memos(self):
+        # insert, delete and update change the answers of the KB
+        if self._memo_version != self.db.version:
+            self._memo_version = self.db.version
+            self._advice_memo.clear()
+            self._suggest_memo.clear()
+            self._relax_memo.clear()
+
+    def _no_advice(self, key):
+        empty = self._advice_memo.get(key)
+        if empty is None:
+            empty = self._advice_memo[key] = len(self.db.get_advice(self._query(key))) == 0
+        return empty
+
+    def _relax(self, key):
+        """
+        :return: (the dropped slot, its value, the key of the relaxed query) as System.relax_beliefs, None if none
+        """
+        if key not in self._relax_memo:
+            query = self._query(key)
+            self._relax_memo[key] = None
+            for relaxed, count in self.db.get_relaxations(query):
+                dropped = [i for i, v in enumerate(relaxed) if v is None and query[i] is not None]
+                if dropped:
+                    values = np.array([[-1 if v is None else v for v in relaxed]])
+                    self._relax_memo[key] = (dropped[0], query[dropped[0]], int(self._keys(values)[0]))
+                    break
+        return self._relax_memo[key]
+
+    def _suggestions(self, key, requested):
+        """
+        The suggestions of SysNlg.generate_sent.
+
+        :param requested: the user slot of the last system request, -1 if none
+        :return: 2D array [num_candidates x num_usr] of the suggested value of each slot (-1 if none),
+        one of the candidates is drawn uniformly
+        """
+        memo_key = (key, requested)
+        candidates = self._suggest_memo.get(memo_key)
+        if candidates is not None:
+            return candidates
+
+        query = self._query(key)
+        advice = self.db.get_advice(query)
+        given = [i for i, q in enumerate(query) if q is not None]
+        rows = []
+        if len(given) == 0 and len(advice) > 0:
+            if requested >= 0:
+                row_ids = [i for i, row in enumerate(advice) if row[requested] != ''][0:1]
+            else:
+                row_ids = range(len(advice))
+            for r_id in row_ids:
+                suggestion = [-1] * self.num_usr
+                for i, c in enumerate(advice[r_id][0:self.num_usr]):
+                    if c != '':
+                        suggestion[i] = int(c)
+                        break
+                rows.append(suggestion)
+        elif len(advice) > 0:
+            suggestion = [-1] * self.num_usr
+            for row in advice[0:2 if len(advice) > 1 else 1]:
+                for i, c in enumerate(row[0:self.num_usr]):
+                    if i not in given and c != '' and suggestion[i] < 0:
+                        suggestion[i] = int(c)
+                        if len(advice) == 1:
+                            break
+            rows.append(suggestion)
+        if not rows:
+            rows.append([-1] * self.num_usr)
+        candidates = self._suggest_memo[memo_key] = np.array(rows, dtype=np.int64)
+        return candidates
+
+    def _map_keys(self, keys, func):
+        uniques, inverse = np.unique(keys, return_inverse=True)
+        return [func(int(k)) for k in uniques], inverse.reshape(-1)
+
+    # -- simulation --
+
+    def iter_shards(self, num_sess, batch_size=BATCH_SIZE):
+        """
+        :return: iterator of (columns of ActCorpusWriter.encode_shard, number of dialogs), e.g. for
+        ActCorpusWriter.write_encoded
+        """
+        for start in range(0, num_sess, batch_size):
+            num = min(batch_size, num_sess - start)
+            yield self.simulate(num), num
+
+    def write(self, writer, num_sess, batch_size=BATCH_SIZE):
+        """
+        Simulate num_sess dialogs into an ActCorpusWriter.
+        """
+        for columns, num in self.iter_shards(num_sess, batch_size):
+            writer.write_encoded(columns, num)
+
+    def simulate(self, num):
+        """
+        :return: the columns of num dialogs, see ActCorpusWriter.encode_shard
+        """
+        self._check_memos()
+        st = self._new_state(num)
+        rec = _ActRecorder()
+        round_id = 0
+        while len(st['ids']) > 0:
+            sys_turn = self._system_turn(st, rec, round_id)
+            talk = ~st['usr_bye']
+            self._compact(sys_turn, talk)
+            self._compact(st, talk)
+            if len(st['ids']) > 0:
+                self._user_turn(st, rec, round_id, sys_turn)
+            round_id += 1
+        return rec.columns(num)
+
+    def _system_turn(self, st, rec, round_id):
+        """
+        System.step for every active dialog.
+
+        :return: {name -> array} what the user needs to know about the turn
+        """
+        num = len(st['ids'])
+        ids, turn = st['ids'], 2 * round_id
+        acts, slots = self.acts, self.slots
+        rec.turn(ids, turn, 0, np.nan)
+        beliefs, g_conf = st['beliefs'], st['g_conf']
+        bye = st['usr_bye']
+        greet = np.zeros(num, dtype=bool) if round_id > 0 else ~bye
+        inform = st['pending'] & ~bye & ~greet
+        rest = ~(bye | greet | inform)
+        max_conf, values = self._max_conf(beliefs)
+        goal_pending = ((g_conf > 0) & (g_conf < BeliefGoal.THRESHOLD)).any(axis=1)
+        ready = rest & (max_conf >= BeliefSlot.GROUND_THRESHOLD).all(axis=1) & ~goal_pending
+        other = rest & ~ready
+
+        # the advice of the current query, restart when nothing matches
+        keys = np.zeros(num, dtype=np.int64)
+        restart = np.zeros(num, dtype=bool)
+        o_rows = np.flatnonzero(other)
+        if len(o_rows):
+            keys[o_rows] = self._keys(values[o_rows])
+            empty, inverse = self._map_keys(keys[o_rows], self._no_advice)
+            no_match = o_rows[np.array(empty, dtype=bool)[inverse] & st['atleast_1_slot'][o_rows]]
+            if len(no_match) and self.domain.relax_no_match:
+                relaxed, inverse = self._map_keys(keys[no_match], self._relax)
+                found = np.array([r is not None for r in relaxed], dtype=bool)[inverse]
+                for r_id, r in enumerate(relaxed):
+                    if r is None:
+                        continue
+                    rows = no_match[(inverse == r_id)]
+                    beliefs[rows, r[0], r[1] + 1] = -1.0
+                    keys[rows] = r[2]
+                    self.logger.info("No match, relax %s" % self.domain.usr_slots[r[0]].name)
+                no_match = no_match[~found]
+                max_conf, values = self._max_conf(beliefs)
+            restart[no_match] = True
+        other &= ~restart
+
+        # the confirms and requests of System.policy
+        exp = other[:, None] & (max_conf < BeliefSlot.EXPLICIT_THRESHOLD)
+        ec = other[:, None] & (max_conf >= BeliefSlot.EXPLICIT_THRESHOLD) & (max_conf < BeliefSlot.IMPLICIT_THRESHOLD)
+        ic = other[:, None] & (max_conf >= BeliefSlot.IMPLICIT_THRESHOLD) & (max_conf < BeliefSlot.GROUND_THRESHOLD)
+        req_slot = exp.any(axis=1)
+        # the explicit requests are shuffled, one of them is asked
+        main_slot = np.argmax(np.where(exp, np.random.rand(num, self.num_usr), -1.0), axis=1)
+        confirm = other & ~req_slot & ec.any(axis=1)
+        main_slot = np.where(confirm, np.argmax(ec, axis=1), main_slot)
+        req_need = other & ~req_slot & ~confirm & goal_pending
+        query = ready | (other & ~req_slot & ~confirm & ~req_need)
+
+        ic_values = np.where(ic, values, -1)
+        for s_id in range(self.num_usr):
+            rows = np.flatnonzero(ic[:, s_id])
+            rec.act(ids[rows], turn, s_id, acts[SystemAct.IMPLICIT_CONFIRM])
+            rec.param(ids[rows], turn, s_id, 0, self.usr_slot_ids[s_id], self._lexicalize(values[rows, s_id]))
+            ones = np.ones(len(rows))
+            self._ground(beliefs, rows, np.full(len(rows), s_id), ones, ones * 0.0)
+
+        main = _ActRecorder.MAIN
+        rows = np.flatnonzero(bye)
+        rec.act(ids[rows], turn, main, acts[SystemAct.GOODBYE])
+        rows = np.flatnonzero(greet)
+        rec.act(ids[rows], turn, main, acts[SystemAct.GREET])
+        rec.act(ids[rows], turn, main + 1, acts[SystemAct.REQUEST])
+        rec.param(ids[rows], turn, main + 1, 0, slots[BaseUsrSlot.NEED], -1)
+        rows = np.flatnonzero(restart)
+        rec.act(ids[rows], turn, main, acts[SystemAct.RESTART])
+        rows = np.flatnonzero(req_slot | req_need)
+        rec.act(ids[rows], turn, main, acts[SystemAct.REQUEST])
+        rec.param(ids[rows], turn, main, 0,
+                  np.where(req_slot[rows], self.usr_slot_ids[main_slot[rows]], slots[BaseUsrSlot.NEED]), -1)
+        rows = np.flatnonzero(confirm)
+        rec.act(ids[rows], turn, main, acts[SystemAct.EXPLICIT_CONFIRM])
+        rec.param(ids[rows], turn, main, 0, self.usr_slot_ids[main_slot[rows]],
+                  self._lexicalize(values[rows, main_slot[rows]]))
+
+        # the goals that are asked and not delivered, in the order of the system slots
+        open_goals = ~st['g_delivered'] & (g_conf >= BeliefGoal.THRESHOLD)
+        inform_goals = open_goals & inform[:, None]
+        rows = np.flatnonzero(inform)
+        rec.act(ids[rows], turn, main, acts[SystemAct.INFORM])
+        for g_id in range(self.num_sys):
+            g_rows = np.flatnonzero(inform_goals[:, g_id])
+            rec.param(ids[g_rows], turn, main, g_id, self.sys_slot_ids[g_id], st['g_value'][g_rows, g_id])
+        rec.act(ids[rows], turn, main + 1, acts[SystemAct.REQUEST])
+        rec.param(ids[rows], turn, main + 1, 0, slots[BaseUsrSlot.HAPPY], -1)
+        inform_query = st['pending_query'].copy()
+        st['pending'][rows] = False
+
+        query_goals = open_goals & query[:, None]
+        query_values = np.where(query[:, None], self._max_conf(beliefs)[1], -1)
+        rows = np.flatnonzero(query)
+        rec.act(ids[rows], turn, main, acts[SystemAct.QUERY])
+        for s_id in range(self.num_usr):
+            rec.param(ids[rows], turn, main, s_id, self.usr_slot_ids[s_id], self._lexicalize(query_values[rows, s_id]))
+        for g_id in range(self.num_sys):
+            g_rows = np.flatnonzero(query_goals[:, g_id])
+            rec.param(ids[g_rows], turn, main, self.num_usr + g_id, self.sys_slot_ids[g_id], -1)
+
+        # the suggestions of the advice that comes with a request or a confirm
+        suggestions = np.full((num, self.num_usr), -1, dtype=np.int64)
+        rows = np.flatnonzero(req_slot | confirm | req_need)
+        if len(rows):
+            requested = np.where(req_slot[rows], main_slot[rows], -1)
+            pairs = keys[rows] * (self.num_usr + 1) + requested + 1
+            candidates, inverse = self._map_keys(
+                pairs, lambda p: self._suggestions(p // (self.num_usr + 1), p % (self.num_usr + 1) - 1))
+            sizes = np.array([len(c) for c in candidates])[inverse]
+            picks = (np.random.rand(len(rows)) * sizes).astype(np.int64)
+            for c_id, c in enumerate(candidates):
+                sel = inverse == c_id
+                suggestions[rows[sel]] = c[picks[sel]]
+
+        return {'greet': greet, 'inform': inform, 'restart': restart, 'query': query, 'req_slot': req_slot,
+                'req_need': req_need, 'confirm': confirm, 'main_slot': main_slot, 'main_value': values[np.arange(num), main_slot],
+                'ic': ic, 'ic_values': ic_values, 'inform_goals': inform_goals, 'inform_query': inform_query,
+                'query_goals': query_goals, 'query_values': query_values, 'suggestions': suggestions}
+
+    @staticmethod
+    def _lexicalize(values):
+        # SysNlg writes a None value as dont_care
+        return np.where(values < 0, ActVocab.DONT_CARE, values)
+
+    def _unmet_goal(self, st):
+        open_goal = (st['goals'] >= 0) & ~st['goals_met']
+        first = np.argmax(open_goal, axis=1)
+        return np.where(open_goal.any(axis=1), st['goals'][np.arange(len(first)), first], -1)
+
+    def _user_turn(self, st, rec, round_id, sys_turn):
+        """
+        User.step, the ActionChannel and System.state_update for every active dialog.
+        """
+        num = len(st['ids'])
+        ids, turn = st['ids'], 2 * round_id + 1
+        acts, slots = self.acts, self.slots
+        cons = st['cons']
+        rand = np.random.rand
+
+        take = (sys_turn['suggestions'] >= 0) & (rand(num, self.num_usr) <= self.advice_prob)
+        cons[take] = sys_turn['suggestions'][take]
+        bye = np.full(num, round_id + 1 >= self.MAX_ROUNDS)
+        talk = ~bye
+
+        # the answers to the implicit confirms, a disconfirm and maybe the right value per slot
+        wrong = sys_turn['ic'] & talk[:, None] & (sys_turn['ic_values'] != cons) & (cons >= 0)
+        add_inform = wrong & (rand(num, self.num_usr) < self.reject_inform_prob)
+
+        # the answer to the main system act: up to max_main actions of (act, slot, value)
+        max_main = max(2, self.num_usr)
+        m_act = np.full((num, max_main), -1, dtype=np.int64)
+        m_slot = np.full((num, max_main), -1, dtype=np.int64)
+        m_value = np.full((num, max_main), -1, dtype=np.int64)
+        # the goals of a satisfy or more_request, the query and results of a kb_return or restart
+        m_goals = np.zeros((num, self.num_sys), dtype=bool)
+        m_query = np.full((num, self.num_usr), -1, dtype=np.int64)
+        m_results = np.full((num, self.num_sys), -1, dtype=np.int64)
+        m_has_query = np.zeros(num, dtype=bool)
+
+        def put(rows, pos, act, slot=-1, value=-1):
+            m_act[rows, pos] = act
+            m_slot[rows, pos] = slot
+            m_value[rows, pos] = value
+
+        put(np.flatnonzero(bye), 0, acts[UserAct.GOODBYE])
+        rows = np.flatnonzero(sys_turn['greet'] & talk)
+        put(rows, 0, acts[UserAct.GREET])
+        put(rows, 1, acts[UserAct.REQUEST], self._unmet_goal(st)[rows])
+        put(np.flatnonzero(sys_turn['restart'] & talk), 0, acts[UserAct.RESTART])
+        rows = np.flatnonzero(sys_turn['req_need'] & talk)
+        put(rows, 0, acts[UserAct.REQUEST], self._unmet_goal(st)[rows])
+
+        rows = np.flatnonzero(sys_turn['confirm'] & talk)
+        slot, value = sys_turn['main_slot'][rows], sys_turn['main_value'][rows]
+        right = value == cons[rows, slot]
+        put(rows, 0, np.where(right, acts[UserAct.CONFIRM], acts[UserAct.DISCONFIRM]), slot, value)
+
+        rows = np.flatnonzero(sys_turn['req_slot'] & talk)
+        if len(rows):
+            slot = sys_turn['main_slot'][rows]
+            put(rows, 0, acts[UserAct.INFORM], slot, cons[rows, slot])
+            if self.num_usr > 1:
+                num_informs = np.random.choice(self.multi_slots[0], p=self.multi_slots[1], size=len(rows))
+                candidates = (cons[rows] >= 0) & (np.arange(self.num_usr) != slot[:, None])
+                num_extra = np.minimum(num_informs - 1, candidates.sum(axis=1))
+                # the extra slots in random order
+                order = np.argsort(np.where(candidates, rand(len(rows), self.num_usr), 2.0), axis=1)
+                for e_id in range(self.num_usr - 1):
+                    sel = num_extra > e_id
+                    extra = order[sel, e_id]
+                    put(rows[sel], 1 + e_id, acts[UserAct.INFORM], extra, cons[rows[sel], extra])
+
+        rows = np.flatnonzero(sys_turn['inform'] & talk)
+        if len(rows):
+            self._answer_inform(st, rows, sys_turn, put, m_goals)
+
+        rows = np.flatnonzero(sys_turn['query'] & talk)
+        if len(rows):
+            queries = sys_turn['query_values'][rows]
+            found, entries = self._select(queries)
+            m_query[rows] = queries
+            m_has_query[rows] = True
+            hits, misses = rows[found], rows[~found]
+            put(hits, 0, acts[UserAct.KB_RETURN])
+            goals = sys_turn['query_goals'][hits]
+            m_results[hits] = np.where(goals, entries[found], -1)
+            put(misses, 0, acts[UserAct.RESTART])
+            st['cons'][misses] = self._sample_goals(len(misses))[0]
+
+        self._transmit(st, rec, turn, wrong, add_inform, sys_turn['ic_values'], m_act, m_slot, m_value,
+                       m_goals, m_query, m_results, m_has_query)
+
+    def _answer_inform(self, st, rows, sys_turn, put, m_goals):
+        acts = self.acts
+        cons = st['cons']
+        differ = sys_turn['inform_query'][rows] != cons[rows]
+        wrong = differ.any(axis=1)
+        w_rows = rows[wrong]
+        w_slot = np.argmax(differ[wrong], axis=1)
+        put(w_rows, 0, acts[UserAct.INFORM], w_slot, cons[w_rows, w_slot])
+
+        rows = rows[~wrong]
+        goals = st['goals'][rows]
+        proposed = sys_turn['inform_goals'][rows]
+        r_ids = np.arange(len(rows))[:, None]
+        st['goals_met'][rows] |= (goals >= 0) & proposed[r_ids, np.maximum(goals, 0)]
+        wanted = np.zeros(proposed.shape, dtype=bool)
+        valid = goals >= 0
+        wanted[np.broadcast_to(r_ids, goals.shape)[valid], goals[valid]] = True
+        m_goals[rows] = proposed & wanted
+        next_goal = self._unmet_goal(st)[rows]
+
+        done = next_goal < 0
+        last = done & (st['goal_ptr'][rows] >= st['goal_cnt'][rows] - 1)
+        put(rows[last], 0, acts[UserAct.SATISFY])
+        put(rows[last], 1, acts[UserAct.GOODBYE])
+
+        # a new search with new system goals and one user constrain changed
+        new = rows[done & ~last]
+        if len(new):
+            st['goal_ptr'][new] += 1
+            st['goals'][new] = self._sample_goals(len(new))[1]
+            st['goals_met'][new] = False
+            change = np.random.randint(0, self.num_usr, size=len(new))
+            value = (np.random.rand(len(new)) * (self.usr_dims[change] - 1)).astype(np.int64) % self.usr_dims[change]
+            cons[new, change] = value
+            put(new, 0, acts[UserAct.NEW_SEARCH], 0)
+            put(new, 1, acts[UserAct.INFORM], change, value)
+
+        more = rows[~done]
+        if len(more):
+            next_goal = next_goal[~done]
+            put(more, 0, acts[UserAct.MORE_REQUEST])
+            expected = (np.random.rand(len(more)) * self.sys_dims[next_goal]).astype(np.int64)
+            ask_yn = (np.random.rand(len(more)) < self.complexity.yn_question) & \
+                self.yn_ok[next_goal, np.minimum(expected, self.yn_dim - 1)]
+            put(more[ask_yn], 1, acts[UserAct.YN_QUESTION], next_goal[ask_yn], expected[ask_yn])
+            put(more[~ask_yn], 1, acts[UserAct.REQUEST], next_goal[~ask_yn])
+
+    def _select(self, queries):
+        """
+        :return: if each query matches an entry, the system values [UID + sys attributes] of a random matching entry
+        """
+        entries = np.zeros((len(queries), self.num_sys), dtype=np.int64)
+        if self.db.backend is None:
+            counts, uids = self.db.select_many(queries)
+            found = counts > 0
+            entries[found] = np.asarray(self.db.sys_table[uids[found]])
+            return found, entries
+        found = np.zeros(len(queries), dtype=bool)
+        for q_id, query in enumerate(queries.tolist()):
+            entry = self.db.sample_entry([None if v < 0 else v for v in query])
+            if entry is not None:
+                found[q_id] = True
+                entries[q_id] = entry
+        return found, entries
+
+    def _transmit(self, st, rec, turn, wrong, add_inform, ic_values, m_act, m_slot, m_value, m_goals, m_query,
+                  m_results, m_has_query):
+        """
+        The ActionChannel noise on the user turn, its record and System.state_update.
+        """
+        num = len(st['ids'])
+        ids, acts, slots = st['ids'], self.acts, self.slots
+        rand = np.random.rand
+        c = self.complexity
+
+        has_confirm = wrong.any(axis=1) | np.isin(m_act, [acts[UserAct.CONFIRM], acts[UserAct.DISCONFIRM]]).any(axis=1)
+        conf = np.clip(np.random.normal(c.asr_acc, c.asr_std, size=num), 0.1, 0.99)
+        conf = np.where(has_confirm, np.clip(conf + 0.1, 0.1, 0.99), conf)
+        rec.turn(ids, turn, 1, conf)
+
+        def corrupt(rows, slot, value):
+            # EnvironmentNoise replaces an inform value by any value or None
+            noisy = rand(len(rows)) > conf[rows]
+            dims = self.usr_dims[slot]
+            other = (rand(len(rows)) * (dims + 1)).astype(np.int64)
+            return np.where(noisy, np.where(other == dims, -1, other), value)
+
+        def self_correct(rows, key):
+            sel = rows[rand(len(rows)) < c.self_correct]
+            rec.param(ids[sel], turn, key, 1, slots[BaseUsrSlot.SELF_CORRECT], 1)
+
+        def flip(rows, act):
+            # EnvironmentNoise turns a confirm into a disconfirm and back, the corpus keeps the act the user meant
+            flipped = rand(len(rows)) > conf[rows]
+            other = np.where(act == acts[UserAct.CONFIRM], acts[UserAct.DISCONFIRM], acts[UserAct.CONFIRM])
+            return np.where(flipped, other, act)
+
+        beliefs = st['beliefs']
+        for s_id in range(self.num_usr):
+            rows = np.flatnonzero(wrong[:, s_id])
+            key = 2 * s_id
+            value = ic_values[rows, s_id]
+            rec.act(ids[rows], turn, key, acts[UserAct.DISCONFIRM])
+            rec.param(ids[rows], turn, key, 0, self.usr_slot_ids[s_id], value)
+            act = flip(rows, np.full(len(rows), acts[UserAct.DISCONFIRM]))
+            self._update_ground(st, rows, np.full(len(rows), s_id), act, conf[rows])
+
+            rows = np.flatnonzero(add_inform[:, s_id])
+            slot = np.full(len(rows), s_id)
+            value = corrupt(rows, slot, st['cons'][rows, s_id])
+            rec.act(ids[rows], turn, key + 1, acts[UserAct.INFORM])
+            self_correct(rows, key + 1)
+            rec.param(ids[rows], turn, key + 1, 0, self.usr_slot_ids[s_id], value)
+            self._observe(beliefs, rows, slot, value, conf[rows])
+            st['atleast_1_slot'][rows] = True
+
+        restarted = np.zeros(num, dtype=bool)
+        for pos in range(m_act.shape[1]):
+            key = _ActRecorder.MAIN + pos
+            act = m_act[:, pos]
+            rows = np.flatnonzero(act >= 0)
+            act, slot, value = act[rows], m_slot[rows, pos], m_value[rows, pos]
+
+            is_inform = act == acts[UserAct.INFORM]
+            value = np.where(is_inform, corrupt(rows, np.maximum(slot, 0), value), value)
+            is_confirm = np.isin(act, [acts[UserAct.CONFIRM], acts[UserAct.DISCONFIRM]])
+            rec.act(ids[rows], turn, key, act)
+            act = np.where(is_confirm, flip(rows, act), act)
+
+            sel = is_inform | is_confirm
+            rec.param(ids[rows[sel]], turn, key, 0, self.usr_slot_ids[slot[sel]], value[sel])
+            self_correct(rows[is_inform], key)
+            self._observe(beliefs, rows[is_inform], slot[is_inform], value[is_inform], conf[rows[is_inform]])
+            self._update_ground(st, rows[is_confirm], slot[is_confirm], act[is_confirm], conf[rows[is_confirm]])
+            st['atleast_1_slot'][rows[sel]] = True
+
+            sel = np.isin(act, [acts[UserAct.REQUEST], acts[UserAct.YN_QUESTION]])
+            g_rows, g_slot = rows[sel], slot[sel]
+            g_value = np.where(act[sel] == acts[UserAct.YN_QUESTION], value[sel], -1)
+            rec.param(ids[g_rows], turn, key, 0, np.where(g_slot >= 0, self.sys_slot_ids[g_slot], self.vocab.UNKNOWN), g_value)
+            g_rows, g_slot = g_rows[g_slot >= 0], g_slot[g_slot >= 0]
+            st['g_conf'][g_rows, g_slot] = np.maximum(conf[g_rows], st['g_conf'][g_rows, g_slot]) + 0.2
+
+            sel = rows[np.isin(act, [acts[UserAct.SATISFY], acts[UserAct.MORE_REQUEST]])]
+            for g_id in range(self.num_sys):
+                g_rows = sel[m_goals[sel, g_id]]
+                rec.param(ids[g_rows], turn, key, g_id, self.sys_slot_ids[g_id], -1)
+                st['g_delivered'][g_rows, g_id] = True
+
+            sel = rows[act == acts[UserAct.GOODBYE]]
+            st['usr_bye'][sel] = True
+
+            sel = rows[act == acts[UserAct.NEW_SEARCH]]
+            rec.param(ids[sel], turn, key, 0, slots[BaseSysSlot.DEFAULT], -1)
+            st['g_conf'][sel] = 0.0
+            st['g_conf'][sel, 0] = 1.0
+            st['g_delivered'][sel] = False
+            st['g_value'][sel, 0] = -1
+            beliefs[sel] = np.where(beliefs[sel] >= 0, (BeliefSlot.IMPLICIT_THRESHOLD + BeliefSlot.EXPLICIT_THRESHOLD) / 2., -1.0)
+
+            # a kb_return, or a restart because the query matched nothing, carries the query
+            with_query = m_has_query[rows] & np.isin(act, [acts[UserAct.KB_RETURN], acts[UserAct.RESTART]])
+            for s_id in range(self.num_usr):
+                q_rows = rows[with_query]
+                rec.param(ids[q_rows], turn, key, s_id, self.usr_slot_ids[s_id], m_query[q_rows, s_id])
+            sel = rows[act == acts[UserAct.KB_RETURN]]
+            for g_id in range(self.num_sys):
+                g_rows = sel[m_results[sel, g_id] >= 0]
+                rec.param(ids[g_rows], turn, key, self.num_usr + g_id, self.sys_slot_ids[g_id], m_results[g_rows, g_id])
+                st['g_value'][g_rows, g_id] = m_results[g_rows, g_id]
+            st['pending'][sel] = True
+            st['pending_query'][sel] = m_query[sel]
+
+            restarted[rows[act == acts[UserAct.RESTART]]] = True
+        self._reset_system(st, np.flatnonzero(restarted))
+
+    def _update_ground(self, st, rows, slot, act, conf):
+        confirm = act == self.acts[UserAct.CONFIRM]
+        up = np.where(confirm, conf, 1.0 - conf)
+        self._ground(st['beliefs'], rows, slot, up, 1.0 - up)
+        st['atleast_1_slot'][rows] = True
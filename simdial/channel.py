@@ -2,7 +2,6 @@
 # author: Tiancheng Zhao
 import numpy as np
 from simdial.agent.core import UserAct, BaseUsrSlot
-import copy
 
 
 class AbstractNoise(object):
@@ -38,15 +37,15 @@ class EnvironmentNoise(AbstractNoise):
         for a in actions:
             if a.act == UserAct.CONFIRM:
                 if np.random.rand() > conf:
-                    a.act = UserAct.DISCONFIRM
+                    a = a.replace(act=UserAct.DISCONFIRM)
             elif a.act == UserAct.DISCONFIRM:
                 if np.random.rand() > conf:
-                    a.act = UserAct.CONFIRM
+                    a = a.replace(act=UserAct.CONFIRM)
             elif a.act == UserAct.INFORM:
                 if np.random.rand() > conf:
                     slot, value = a.parameters[0]
-                    choices = range(self.dim_map[slot]) + [None]
-                    a.parameters[0] = (slot, np.random.choice(choices))
+                    choices = list(range(self.dim_map[slot])) + [None]
+                    a = a.replace(parameters=((slot, np.random.choice(choices)),) + a.parameters[1:])
 
             noisy_actions.append(a)
 
@@ -82,10 +81,12 @@ class InteractionNoise(AbstractNoise):
         return utt
 
     def add_self_correct(self, actions):
+        noisy_actions = []
         for a in actions:
             if a.act == UserAct.INFORM and np.random.rand() < self.complexity.self_correct:
-                a.parameters.append((BaseUsrSlot.SELF_CORRECT, True))
-        return actions
+                a = a.replace(parameters=a.parameters + ((BaseUsrSlot.SELF_CORRECT, True),))
+            noisy_actions.append(a)
+        return noisy_actions
 
 
 class SocialNoise(AbstractNoise):
@@ -112,12 +113,24 @@ class ActionChannel(object):
         :param actions: a list of clean action from the user to the system
         :return: a list of corrupted actions.
         """
-        action_copy = [copy.deepcopy(a) for a in actions]
-        noisy_actions = self.interaction.transmit(action_copy)
+        noisy_actions = self.interaction.transmit(actions)
         noisy_actions = self.social.transmit(noisy_actions)
         noisy_actions, conf = self.environment.transmit(noisy_actions)
         return noisy_actions, conf
 
+    @staticmethod
+    def recorded_actions(actions, noisy_actions):
+        """
+        The user actions as the corpus records them: the noisy ones, except that a confirm or a
+        disconfirm flipped by the environment keeps the act the user meant.
+
+        :param actions: the clean actions given to transmit2sys
+        :param noisy_actions: the actions returned by transmit2sys, one per clean action
+        :return: a list of actions
+        """
+        return [noisy if noisy.act == clean.act else noisy.replace(act=clean.act)
+                for clean, noisy in zip(actions, noisy_actions)]
+
 
 class WordChannel(object):
     """
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import itertools
+from collections import OrderedDict
+
+
+def group_rows(rows, weights):
+    """
+    Sum the weights of equal rows.
+
+    :param rows: 2D int array [n x num_cols]
+    :param weights: 1D int array [n]
+    :return: the distinct rows in lexicographic order, the summed weight of each of them
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) == 0:
+        return rows.reshape(0, rows.shape[1]), np.zeros(0, dtype=np.int64)
+    dims = rows.max(axis=0) + 1
+    if np.sum(np.log2(dims.astype(np.float64))) < 62:
+        keys, inverse = np.unique(np.ravel_multi_index(rows.transpose(), dims), return_inverse=True)
+        distinct = np.stack(np.unravel_index(keys, dims), axis=1).astype(np.int64)
+    else:
+        # too many combinations for a mixed radix key
+        distinct, inverse = np.unique(rows, axis=0, return_inverse=True)
+    sums = np.bincount(inverse.reshape(-1), weights=weights, minlength=len(distinct))
+    return distinct, sums.astype(np.int64)
+
+
+class Cuboid(object):
+    """
+    The count of every value combination of a subset of the searchable attributes that occurs
+    in the KB.
+
+    :ivar slots: the attribute ids, increasing
+    :ivar rows: 2D int array [num_cells x len(slots)] in lexicographic order
+    :ivar counts: 1D int array, the count of each row
+    :ivar pending: {row -> count change} not merged into rows yet
+    """
+
+    def __init__(self, slots, rows, counts):
+        self.slots = slots
+        self.rows = rows
+        self.counts = counts
+        self.pending = {}
+
+    def add(self, row, delta):
+        self.pending[row] = self.pending.get(row, 0) + delta
+
+    def merge(self):
+        """
+        :return: rows, counts with the pending changes applied
+        """
+        if self.pending:
+            changes = list(self.pending.items())
+            rows = np.array([row for row, _ in changes], dtype=np.int64).reshape(-1, len(self.slots))
+            counts = np.array([delta for _, delta in changes], dtype=np.int64)
+            rows, counts = group_rows(np.concatenate([self.rows, rows]), np.concatenate([self.counts, counts]))
+            keep = counts != 0
+            self.rows, self.counts = rows[keep], counts[keep]
+            self.pending = {}
+        return self.rows, self.counts
+
+
+class DataCube(object):
+    """
+    Group-by counts of the searchable attributes of a KB, for any subset of them. Only the full
+    cuboid, over all the attributes, is built from the start. Any other cuboid is aggregated from
+    it the first time it is needed and kept in an LRU cache, so a KB with many attributes never
+    pays for the 2^num_slots cuboids up front.
+
+    :ivar num_slots: the number of searchable attributes
+    :ivar full: the Cuboid over all the attributes
+    :ivar cache_size: the max number of other cuboids kept
+    :ivar cuboids: OrderedDict {slots -> Cuboid}, the least recently used first
+    """
+
+    CACHE_SIZE = 64
+
+    def __init__(self, rows, counts, cache_size=CACHE_SIZE):
+        """
+        :param rows: 2D int array, the distinct KB rows in lexicographic order
+        :param counts: 1D int array, the count of each row
+        """
+        self.num_slots = rows.shape[1]
+        self.full = Cuboid(tuple(range(self.num_slots)), rows, counts)
+        self.cache_size = cache_size
+        self.cuboids = OrderedDict()
+
+    @classmethod
+    def from_columns(cls, columns, cache_size=CACHE_SIZE):
+        """
+        :param columns: one 1D int array per searchable attribute
+        """
+        rows = np.stack([np.asarray(col, dtype=np.int64) for col in columns], axis=1)
+        return cls(*group_rows(rows, np.ones(len(rows), dtype=np.int64)), cache_size=cache_size)
+
+    def slot_sets(self):
+        """
+        :return: every non-empty attribute set, by size and then in lexicographic order
+        """
+        for size in range(1, self.num_slots + 1):
+            for slots in itertools.combinations(range(self.num_slots), size):
+                yield slots
+
+    def cuboid(self, slots):
+        """
+        :param slots: increasing attribute ids
+        :return: the Cuboid over these attributes
+        """
+        slots = tuple(slots)
+        if len(slots) == self.num_slots:
+            return self.full
+        cuboid = self.cuboids.pop(slots, None)
+        if cuboid is None:
+            rows, counts = self.full.merge()
+            cuboid = Cuboid(slots, *group_rows(rows[:, list(slots)], counts))
+        # re-insert to mark it as the most recently used
+        self.cuboids[slots] = cuboid
+        if len(self.cuboids) > self.cache_size:
+            self.cuboids.popitem(last=False)
+        return cuboid
+
+    def update(self, row, delta):
+        """
+        :param row: one value id per attribute of a KB row
+        :param delta: the change of its count, +1 for an insert and -1 for a delete
+        """
+        row = tuple(int(v) for v in row)
+        self.full.add(row, delta)
+        for slots, cuboid in self.cuboids.items():
+            cuboid.add(tuple(row[i] for i in slots), delta)
+
+    def stat_frame(self, slot_names):
+        """
+        All the cuboids in one table, in slot_sets order. This materializes 2^num_slots - 1
+        cuboids, it is meant for inspection of small KBs.
+
+        :return: DataFrame with one column per attribute ('' if it is not in the combination) and count
+        """
+        blocks, counts = [], []
+        for slots in self.slot_sets():
+            rows, count = self.cuboid(slots).merge()
+            block = np.full((len(rows), self.num_slots), -1, dtype=np.int64)
+            block[:, list(slots)] = rows
+            blocks.append(block)
+            counts.append(count)
+        table = np.concatenate(blocks) if blocks else np.zeros((0, self.num_slots), dtype=np.int64)
+        columns = OrderedDict()
+        for slot_id, name in enumerate(slot_names):
+            col = table[:, slot_id].astype(object)
+            col[table[:, slot_id] < 0] = ''
+            columns[name] = col
+        columns['count'] = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+        return pd.DataFrame(columns, columns=list(columns.keys()))
+
+
+class AdviceIndex(object):
+    """
+    The advice rows of Database.get_advice for any partial constraint on the searchable
+    attributes. An advice row is [value id or '' for each attribute, count].
+
+    Without any constraint every cell of every cuboid is a candidate. Count ties are broken by
+    DataCube.slot_sets order and then by the lexicographic order of the cells. A cell never
+    counts more than the cell of a coarser cuboid it belongs to, so the cuboids are visited by
+    size and a cuboid is skipped when its coarser ones cannot beat the current top_k.
+
+    As soon as one attribute is given only the cells of the full cuboid that agree with it
+    qualify, ties are broken by their lexicographic order. They are found by intersecting posting
+    lists over the full cuboid, one per attribute value, and the changes that are still pending
+    in the full cuboid are applied to them on the fly.
+
+    Each answer is memoized, so a repeated constraint is a single dict access.
+
+    :ivar cube: the DataCube
+    :ivar top_k: the max number of advice rows
+    :ivar postings: [{value -> sorted positions in the full cuboid}] one per attribute
+    :ivar memo: {constraint tuple -> advice rows}
+    """
+
+    MERGE_LIMIT = 1024
+
+    def __init__(self, cube, top_k=6, postings=None, top_advice=None):
+        """
+        :param postings: None, or the posting lists of the full cuboid of cube, see export
+        :param top_advice: None, or the advice without any constraint
+        """
+        self.cube = cube
+        self.top_k = top_k
+        self.postings = postings
+        self._postings_rows = None if postings is None else cube.full.rows
+        self.memo = {}
+        if top_advice is not None:
+            self.memo[(None,) * cube.num_slots] = top_advice
+
+    def export(self):
+        """
+        :return: the posting lists as one (values, positions, bounds) of 1D arrays per attribute,
+        with np.split(positions, bounds) the posting list of each value, and the advice without
+        any constraint
+        """
+        exported = []
+        for posting in self._get_postings():
+            values = sorted(posting.keys())
+            lists = [posting[v] for v in values]
+            exported.append((np.array(values, dtype=np.int64),
+                             np.concatenate(lists) if lists else np.zeros(0, dtype=np.int64),
+                             np.cumsum([len(l) for l in lists[:-1]], dtype=np.int64)))
+        return exported, self.lookup([])
+
+    @staticmethod
+    def load_postings(exported):
+        """
+        :param exported: the (values, positions, bounds) of each attribute, see export
+        :return: the postings argument of AdviceIndex
+        """
+        return [dict(zip(values.tolist(), np.split(positions, bounds))) for values, positions, bounds in exported]
+
+    def lookup(self, constraints):
+        """
+        :param constraints: one value id per attribute, None means not given
+        :return: a list of advice rows (shared, do not modify), [] if nothing matches
+        """
+        key = tuple(constraints)
+        if len(key) < self.cube.num_slots:
+            key += (None,) * (self.cube.num_slots - len(key))
+        advice = self.memo.get(key)
+        if advice is None:
+            given = tuple(i for i, v in enumerate(key) if v is not None)
+            if given:
+                advice = self._group_advice(given, tuple(int(key[i]) for i in given))
+            else:
+                advice = self._top_advice()
+            self.memo[key] = advice
+        return advice
+
+    def update(self, row, delta):
+        """
+        :param row: one value id per attribute of a KB row
+        :param delta: the change of its count, +1 for an insert and -1 for a delete
+        """
+        self.cube.update(row, delta)
+        self.memo.clear()
+
+    def _get_postings(self):
+        full = self.cube.full
+        if len(full.pending) > self.MERGE_LIMIT:
+            full.merge()
+        # the posting lists hold positions, so they are rebuilt whenever the full cuboid was merged
+        if self._postings_rows is not full.rows:
+            self.postings = []
+            for col in full.rows.transpose():
+                order = np.argsort(col, kind='mergesort')
+                values, starts = np.unique(col[order], return_index=True)
+                self.postings.append(dict(zip(values.tolist(), np.split(order, starts[1:]))))
+            self._postings_rows = full.rows
+        return self.postings
+
+    def _group_advice(self, given, values):
+        postings = self._get_postings()
+        full = self.cube.full
+        candidates = sorted([postings[i].get(v, np.zeros(0, dtype=np.int64)) for i, v in zip(given, values)], key=len)
+        ids = candidates[0]
+        for posting in candidates[1:]:
+            ids = np.intersect1d(ids, posting, assume_unique=True)
+        rows, counts = full.rows[ids], full.counts[ids]
+
+        changes = [(row, delta) for row, delta in full.pending.items()
+                   if all(row[i] == v for i, v in zip(given, values))]
+        if changes:
+            rows = np.concatenate([rows, np.array([row for row, _ in changes], dtype=np.int64)])
+            counts = np.concatenate([counts, np.array([delta for _, delta in changes], dtype=np.int64)])
+            rows, counts = group_rows(rows, counts)
+            keep = counts != 0
+            rows, counts = rows[keep], counts[keep]
+
+        order = np.argsort(-counts, kind='mergesort')[0:self.top_k]
+        return [row + [count] for row, count in zip(rows[order].tolist(), counts[order].tolist())]
+
+    def _top_advice(self):
+        num_slots = self.cube.num_slots
+        max_counts = {}
+        blocks = []
+        threshold = None
+        for size in range(1, num_slots + 1):
+            level = {}
+            for slots in itertools.combinations(range(num_slots), size):
+                if size > 1:
+                    coarser = [slots[0:i] + slots[i + 1:] for i in range(size)]
+                    if any(c not in max_counts for c in coarser):
+                        continue
+                    if threshold is not None and min(max_counts[c] for c in coarser) <= threshold:
+                        continue
+                rows, counts = self.cube.cuboid(slots).merge()
+                level[slots] = int(counts.max()) if len(counts) > 0 else 0
+                order = np.argsort(-counts, kind='mergesort')[0:self.top_k]
+                block = np.full((len(order), num_slots), -1, dtype=np.int64)
+                block[:, list(slots)] = rows[order]
+                blocks.append((block, counts[order]))
+
+                all_counts = np.concatenate([c for _, c in blocks])
+                if len(all_counts) >= self.top_k:
+                    threshold = np.sort(all_counts)[-self.top_k]
+            if not level:
+                break
+            max_counts.update(level)
+
+        if not blocks:
+            return []
+        rows = np.concatenate([b for b, _ in blocks])
+        counts = np.concatenate([c for _, c in blocks])
+        # blocks are in slot_sets order, so a stable sort breaks ties as documented
+        order = np.argsort(-counts, kind='mergesort')[0:self.top_k]
+        return [[v if v >= 0 else '' for v in row] + [count]
+                for row, count in zip(rows[order].tolist(), counts[order].tolist())]
+
+
+class RelaxationIndex(object):
+    """
+    The nearest relaxations of a partial constraint: every query that drops one given attribute
+    or changes its value, and that matches some KB rows. They are all read from the cuboid over
+    the given attributes: a cell that differs from the constraint in exactly one attribute is
+    a changed query, and a dropped attribute matches the cells that agree on all the others.
+
+    Each answer is memoized, so a repeated constraint is a single dict access.
+
+    :ivar cube: the DataCube
+    :ivar memo: {constraint tuple -> relaxations}
+    """
+
+    def __init__(self, cube):
+        self.cube = cube
+        self.memo = {}
+
+    def lookup(self, constraints):
+        """
+        :param constraints: one value id per attribute, None means not given
+        :return: a list of (relaxed constraint tuple, number of matching rows) (shared, do not
+        modify) by decreasing count, [] if nothing is given. Ties keep the attribute order, with
+        the dropped attribute before its changed values in increasing order.
+        """
+        key = tuple(None if c is None else int(c) for c in constraints)
+        if len(key) < self.cube.num_slots:
+            key += (None,) * (self.cube.num_slots - len(key))
+        relaxations = self.memo.get(key)
+        if relaxations is None:
+            relaxations = self.memo[key] = self._relax(key)
+        return relaxations
+
+    def _relax(self, key):
+        given = tuple(i for i, v in enumerate(key) if v is not None)
+        if not given:
+            return []
+        rows, counts = self.cube.cuboid(given).merge()
+        diff = rows != np.array([key[i] for i in given], dtype=np.int64)
+        num_diff = diff.sum(axis=1)
+        exact = int(counts[num_diff == 0].sum())
+        near = num_diff == 1
+        rows, counts, pos = rows[near], counts[near], np.argmax(diff[near], axis=1)
+
+        relaxations = []
+        for j, slot_id in enumerate(given):
+            relaxed = list(key)
+            mine = pos == j
+            relaxed[slot_id] = None
+            relaxations.append((tuple(relaxed), exact + int(counts[mine].sum())))
+            # the cells are in lexicographic order and only differ in this attribute
+            for value, count in zip(rows[mine, j].tolist(), counts[mine].tolist()):
+                relaxed[slot_id] = value
+                relaxations.append((tuple(relaxed), count))
+        relaxations = [r for r in relaxations if r[1] > 0]
+        # stable sort, ties keep the attribute order
+        relaxations.sort(key=lambda r: -r[1])
+        return relaxations
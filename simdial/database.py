@@ -2,9 +2,17 @@ import numpy as np
 import logging
 import pandas as pd
 import json
+import itertools
+import os
+from collections import OrderedDict
+from simdial.snapshot import KBSnapshot
+from simdial.table import ColumnTable
+from simdial.cube import DataCube, AdviceIndex, RelaxationIndex
+from simdial.sketch import SketchAdvice
 
 class slot_vocab():
     def __init__(self, usr_slots):
+        self.slot_names = [slot for slot, desc, values in usr_slots]
         self.slot_vocab = {}
         self.slot_vocab_inv = {}
         for slot, desc, values in usr_slots:
@@ -23,6 +31,17 @@ class slot_vocab():
             self.slot_vocab_inv[slot][len(self.slot_vocab_inv[slot])] = value
             return self.slot_vocab[slot][value]
         
+    def get_vocabularies(self):
+        """
+        :return: {slot -> [value, ...]} values in id order
+        """
+        return {slot: [inv[idx] for idx in range(len(inv))] for slot, inv in self.slot_vocab_inv.items()}
+
+    def set_vocabularies(self, vocab):
+        for slot, values in vocab.items():
+            self.slot_vocab[slot] = {value: idx for idx, value in enumerate(values)}
+            self.slot_vocab_inv[slot] = {idx: value for idx, value in enumerate(values)}
+
     def get_slot_value(self, slot, idx):
         if idx in self.slot_vocab_inv[slot]:
             return self.slot_vocab_inv[slot][idx]
@@ -30,6 +49,93 @@ class slot_vocab():
         else:
             raise IndexError
 
+class GoalSampler(object):
+    """
+    Samples user goals from the unique rows of a constraint table. The rows are deduplicated
+    once and drawn through an alias table, so each draw is O(1) whatever the table size.
+
+    :cvar UNIFORM: every unique row is equally likely
+    :cvar FREQUENCY: a unique row is as likely as its number of copies in the table
+    :ivar unique_rows: 2D array of the distinct rows
+    :ivar prob: alias table, the chance to keep the drawn row
+    :ivar alias: alias table, the row to take otherwise
+    """
+
+    UNIFORM = "uniform"
+    FREQUENCY = "frequency"
+
+    def __init__(self, table, mode=UNIFORM):
+        self.unique_rows, counts = np.unique(table, axis=0, return_counts=True)
+        self.mode = mode
+        self.prob, self.alias = self.alias_table(counts, mode)
+
+    @classmethod
+    def wrap(cls, unique_rows, prob, alias, mode):
+        """
+        A sampler over alias tables built by alias_table, used as they are without copy.
+        """
+        sampler = cls.__new__(cls)
+        sampler.unique_rows = unique_rows
+        sampler.mode = mode
+        sampler.prob, sampler.alias = prob, alias
+        return sampler
+
+    @classmethod
+    def alias_table(cls, counts, mode):
+        """
+        :param counts: the number of copies of each unique row
+        :return: prob, alias
+        """
+        if mode == cls.UNIFORM:
+            weights = np.ones(len(counts))
+        elif mode == cls.FREQUENCY:
+            weights = counts
+        else:
+            raise ValueError("Unknown goal sampling mode %s" % mode)
+        return cls._build_alias(weights)
+
+    @staticmethod
+    def _build_alias(weights):
+        """
+        Vose's alias method.
+
+        :param weights: 1D array of non-negative weights
+        :return: prob, alias
+        """
+        num = len(weights)
+        prob = np.asarray(weights, dtype=np.float64) * num / np.sum(weights)
+        alias = np.arange(num)
+        small = np.nonzero(prob < 1.0)[0].tolist()
+        large = np.nonzero(prob >= 1.0)[0].tolist()
+        while small and large:
+            s_id, l_id = small.pop(), large.pop()
+            alias[s_id] = l_id
+            prob[l_id] += prob[s_id] - 1.0
+            if prob[l_id] < 1.0:
+                small.append(l_id)
+            else:
+                large.append(l_id)
+        # what remains is 1.0 up to rounding errors
+        prob[small + large] = 1.0
+        return prob, alias
+
+    def draw(self, size):
+        """
+        :param size: the number of goals
+        :return: 2D array [size x num_slots] of independently drawn rows
+        """
+        idxes = np.random.randint(0, len(self.prob), size=size)
+        use_alias = np.random.rand(size) >= self.prob[idxes]
+        idxes[use_alias] = self.alias[idxes[use_alias]]
+        return self.unique_rows[idxes]
+
+    def sample(self):
+        """
+        :return: 1D array, one row
+        """
+        return self.draw(1)[0]
+
+
 class Database(object):
     """
     A table-based database class. Each row is an entry and each column is an attribute. Each attribute
@@ -39,18 +145,47 @@ class Database(object):
     :ivar num_usr_slots: the number of columns: Int
     :ivar usr_modalities: the vocab size of each column : List
     :ivar usr_pdf: the PDF for each columns : 2D list
-    :ivar num_rows: the number of entries
-    :ivar table: the content : 2D list [[] *num_rows]
-    :ivar indexes: for efficient SELECT : [{attribute_word -> corresponding rows}]
+    :ivar num_rows: the number of entries, deleted ones included
+    :ivar table: the content, one narrow int column per attribute : ColumnTable [num_rows x num_usr_slots]
+    :ivar sys_table: the UID and the non-searchable attributes of each row : ColumnTable
+    :ivar indexes: for efficient SELECT : [{attribute_word -> sorted array of corresponding rows}]
+    :ivar cube: group-by counts of the searchable attributes, built lazily, None with approximate advice : DataCube
+    :ivar db_stat: count of every value combination of the searchable attributes : DataFrame
+    :ivar deleted: the UIDs of the deleted entries, whose rows stay in the tables : set
+    :ivar advice_index: the advice for every partial constraint : AdviceIndex or SketchAdvice
+    :ivar pattern_cache: the entries sorted by each recently used set of constrained attributes, for select_many : QueryCache
+    :ivar goal_sampler: samples user goals from the unique rows of cons_table : GoalSampler
+    :ivar usr_slot_names: the name of each column : List
+    :ivar read_only: True if the tables are memory mapped from an export_shared directory
+    :ivar backend: the KBBackend that answers the queries, None for the in-memory tables
+    :ivar version: the number of changes made by insert, delete and update, for the caches of the callers
+
+    The in-memory tables can be changed with insert, delete and update. Each change costs
+    O(num_usr_slots): new row ids wait in pending posting lists that are merged into a posting
+    list the first time it is read, ids that no longer match their posting list are filtered out
+    by select until the next compact, and the advice statistics are updated one count at a time.
     """
 
     logger = logging.getLogger(__name__)
 
-    def __init__(self, usr_dirichlet_priors, sys_dirichlet_priors, num_rows, usr_slots):
+    KB_PATH = 'db.json'
+    DENSE_KEY_LIMIT = 1 << 24
+    COMPACT_RATIO = 0.25
+    DONT_CARE = -1
+    PATTERN_CACHE_SIZE = 16
+
+    def __init__(self, usr_dirichlet_priors, sys_dirichlet_priors, num_rows, usr_slots, cache_size=None,
+                 goal_sampling=GoalSampler.UNIFORM, kb_cache_dir=None, advice_eps=None, advice_delta=0.01):
         """
         :param usr_dirichlet_priors: 2D list [[]_0, []_1, ... []_k] for each searchable attributes
         :param sys_dirichlet_priors: 2D llst for each entry (non-searchable attributes)
         :param num_rows: the number of row in the database
+        :param cache_size: the max number of SELECT results to memoize, None disables the cache
+        :param goal_sampling: GoalSampler.UNIFORM or GoalSampler.FREQUENCY
+        :param kb_cache_dir: the directory of compiled KB snapshots, None to always parse KB_PATH
+        :param advice_eps: None for exact advice statistics, or the error bound of approximate ones
+        relative to the number of rows, see SketchAdvice
+        :param advice_delta: the failure probability of the approximate advice counts
         """
         self.usr_dirichlet_priors = usr_dirichlet_priors
         self.sys_dirichlet_priors = sys_dirichlet_priors
@@ -68,103 +203,265 @@ class Database(object):
 
         # begin to generate the table
         slot_voc = slot_vocab(usr_slots)
-        usr_table, usr_index = self.load_kb(slot_voc)   
-        self.num_rows = len(usr_table[0])
+        usr_table, usr_index = self._load_compiled_kb(slot_voc, usr_slots, kb_cache_dir)
+        self.num_rows = len(usr_table)
         print(self.num_rows)
 #         usr_table, usr_index = self._gen_table(self.usr_pdf, self.usr_modalities, self.num_usr_slots, num_rows)
         sys_table, sys_index = self._gen_table(self.sys_pdf, self.sys_modalities, self.num_sys_slots, self.num_rows)
         
         # append the UID in the first column
-        sys_table.insert(0, range(self.num_rows))        
+        sys_table.insert(0, np.arange(self.num_rows))
         
-        self.table = np.array(usr_table).transpose()
+        self.table = ColumnTable.from_array(usr_table, [len(slot_voc.slot_vocab[slot]) for slot, _, _ in usr_slots])
         self.indexes = usr_index
-        self.sys_table = np.array(sys_table).transpose()
+        self.all_rows = np.arange(self.num_rows)
+        self.all_rows.setflags(write=False)
+        self.sys_table = ColumnTable(sys_table, [self.num_rows] + self.sys_modalities)
         
-#         print(len(usr_table[0]), usr_table)
-        self.db_stat = self._get_stat(self.table)
         cons_table, cons_index = self._gen_table(self.usr_pdf, self.usr_modalities, self.num_usr_slots, 5000)#num_rows)
 #         self.cons_table = self.table
 #         self.cons_index = self.indexes
-        self.cons_table = np.array(cons_table).transpose()
+        self.cons_table = ColumnTable(cons_table, self.usr_modalities)
         self.cons_index = cons_index
-#         print(usr_table, usr_index)
-#         print(len(usr_table[0]), self.cons_table, self.cons_table[0], cons_index)
-        kb_table = self.table.tolist()
-        c = 0
-        for row in self.cons_table:
-            if row.tolist() in kb_table:
-                c += 1
-            
-        print(c, float(c)/5000)
-        exit()        
-#         with open('db.txt', 'w') as out_file:
-#             json.dump(usr_table, out_file)
-        
-#         exit()
-        
+        self.usr_slot_names = [slot for slot, desc, values in usr_slots]
+        self.read_only = False
+        self.backend = None
+        self._setup_search(cache_size, goal_sampling, advice_eps, advice_delta)
+
+    def _setup_search(self, cache_size, goal_sampling, advice_eps=None, advice_delta=0.01, shared=None):
+        """
+        Build the per-process structures on top of the tables and the indexes.
+
+        :param shared: None, or the search structures of an export_shared directory, see _load_search
+        """
+        self.no_rows = np.arange(0)
+        self.no_rows.setflags(write=False)
+        self.version = 0
+        self.pending_postings = [{} for _ in range(self.num_usr_slots)]
+        self.num_stale = 0
+        self.deleted = set()
+        self._deleted_ids = None
+        self.query_cache = QueryCache(cache_size) if cache_size else None
+        self.pattern_cache = QueryCache(self.PATTERN_CACHE_SIZE)
+        if advice_eps is not None:
+            self.cube = None
+            self.advice_index = SketchAdvice.build(self._iter_chunks(SketchAdvice.CHUNK_SIZE), self.num_usr_slots,
+                                                   advice_eps, advice_delta)
+        elif shared is not None:
+            self.cube = DataCube(shared['cube_rows'], shared['cube_counts'])
+            self.advice_index = AdviceIndex(self.cube, postings=AdviceIndex.load_postings(shared['advice']),
+                                            top_advice=shared['top_advice'])
+        else:
+            self.cube = self._build_cube()
+            self.advice_index = AdviceIndex(self.cube)
+        self._db_stat = None
+        self._relax_index = None
+        if shared is not None and goal_sampling in shared['goal_alias']:
+            self.goal_sampler = GoalSampler.wrap(shared['goal_rows'], *shared['goal_alias'][goal_sampling],
+                                                 mode=goal_sampling)
+        else:
+            self.goal_sampler = GoalSampler(self.cons_table, mode=goal_sampling)
+
+    def _build_cube(self):
+        live_rows = self._live_rows()
+        if len(live_rows) < self.num_rows:
+            return DataCube.from_columns([col[live_rows] for col in self.table.columns])
+        return DataCube.from_columns(self.table.columns)
+
+    @property
+    def db_stat(self):
+        # every cuboid of the cube, built on first access and after the KB changed
+        if self.cube is None:
+            raise ValueError("db_stat needs exact advice statistics")
+        if self._db_stat is None:
+            self._db_stat = self.cube.stat_frame(self.usr_slot_names)
+        return self._db_stat
+
+    @classmethod
+    def from_backend(cls, backend, cache_size=None):
+        """
+        A Database that answers select, get_advice and sample_unique_row from a KBBackend
+        instead of in-memory tables.
+
+        :param backend: an implementation of KBBackend
+        :param cache_size: the max number of SELECT results to memoize, None disables the cache
+        """
+        db = cls.__new__(cls)
+        db.backend = backend
+        db.num_rows = backend.num_rows
+        db.usr_slot_names = backend.usr_slot_names
+        db.num_usr_slots = len(backend.usr_modalities)
+        db.usr_modalities = backend.usr_modalities
+        db.num_sys_slots = len(backend.sys_modalities)
+        db.sys_modalities = backend.sys_modalities
+        db.read_only = True
+        db.version = 0
+        db.query_cache = QueryCache(cache_size) if cache_size else None
+        return db
+
+    def export_shared(self, path):
+        """
+        Write the tables and indexes as one .npy file per array, so that other processes
+        can attach to them with memory mapping instead of building their own copy. Put path on a
+        RAM backed file system (e.g. /dev/shm) to keep the KB off the disk.
+
+        :param path: a directory, created if needed
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if self.num_stale > 0 or any(self.pending_postings):
+            self.compact()
+
+        def save(name, array):
+            np.save(os.path.join(path, name + '.npy'), np.asarray(array))
+
+        for prefix, table in [('table', self.table), ('sys', self.sys_table), ('cons', self.cons_table)]:
+            for col_id, col in enumerate(table.columns):
+                save('%s_%d' % (prefix, col_id), col)
+        for slot_id, index in enumerate(self.indexes):
+            postings = [index[m_id] for m_id in range(len(index))]
+            save('postings_%d' % slot_id, np.concatenate(postings))
+            save('bounds_%d' % slot_id, np.cumsum([len(p) for p in postings])[:-1])
+        save('all_rows', self._live_rows())
+        self._save_search(path, self._build_cube() if self.cube is None else self.cube, self.cons_table,
+                          self.usr_modalities)
+
+        meta = {'num_rows': self.num_rows,
+                'usr_slot_names': self.usr_slot_names,
+                'usr_dirichlet_priors': [np.asarray(p).tolist() for p in self.usr_dirichlet_priors],
+                'sys_dirichlet_priors': [np.asarray(p).tolist() for p in self.sys_dirichlet_priors],
+                'usr_pdf': [p.tolist() for p in self.usr_pdf],
+                'sys_pdf': [p.tolist() for p in self.sys_pdf]}
+        # written last, an export without meta.json is incomplete
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        self.logger.info("Exported shared KB to %s" % path)
+
     @staticmethod
-    def _get_stat(db):
-        data = pd.DataFrame(db, columns=['food', 'area', 'pricerange'])
-        food = [x for x in list(data.food.unique()) if str(x)!='nan']
-        food = sorted(food)
+    def _save_search(path, cube, cons_table, usr_modalities):
+        """
+        Write what _setup_search derives from the tables, so that attach maps it instead of
+        rebuilding it in every process: the full cuboid, the advice posting lists and the advice
+        without any constraint, the goal alias tables of every sampling mode and the posting
+        lists of cons_table.
 
-        area = [x for x in list(data.area.unique())]
-        area = sorted(area)
+        :param cube: the DataCube of the entries
+        :param cons_table: the user goal table, ColumnTable
+        :param usr_modalities: the vocab size of each searchable attribute
+        """
+        def save(name, array):
+            np.save(os.path.join(path, name + '.npy'), np.asarray(array))
 
-        pricerange = [x for x in list(data.pricerange.unique())]
-        pricerange = sorted(pricerange)
+        rows, counts = cube.full.merge()
+        save('cube_rows', rows)
+        save('cube_counts', counts)
+        postings, top_advice = AdviceIndex(cube).export()
+        for slot_id, (values, positions, bounds) in enumerate(postings):
+            save('advice_values_%d' % slot_id, values)
+            save('advice_positions_%d' % slot_id, positions)
+            save('advice_bounds_%d' % slot_id, bounds)
 
-        stat = pd.DataFrame(columns=['food', 'area', 'pricerange', 'count'])
+        goal_rows, goal_counts = np.unique(np.asarray(cons_table), axis=0, return_counts=True)
+        save('goal_rows', goal_rows)
+        for mode in [GoalSampler.UNIFORM, GoalSampler.FREQUENCY]:
+            prob, alias = GoalSampler.alias_table(goal_counts, mode)
+            save('goal_prob_%s' % mode, prob)
+            save('goal_alias_%s' % mode, alias)
+        for slot_id, (col, modality) in enumerate(zip(cons_table.columns, usr_modalities)):
+            index = Database._build_index(col, modality)
+            postings = [index[m_id] for m_id in range(len(index))]
+            save('cons_postings_%d' % slot_id, np.concatenate(postings))
+            save('cons_bounds_%d' % slot_id, np.cumsum([len(p) for p in postings])[:-1])
 
-        for f in food:
-            curr_db = data[data.food==f]
-            stat.loc[len(stat)] = [f, '', '', len(curr_db)]
+        with open(os.path.join(path, 'search.json'), 'w') as f:
+            json.dump({'top_advice': top_advice}, f)
 
-        for a in area:
-            curr_db = data[data.area==a]
-            stat.loc[len(stat)] = ['', a, '', len(curr_db)]
+    @staticmethod
+    def _load_search(path, num_usr_slots):
+        """
+        :return: the structures written by _save_search, memory mapped, None if path has none
+        """
+        if not os.path.exists(os.path.join(path, 'search.json')):
+            return None
 
-        for p in pricerange:
-            curr_db = data[data.pricerange==p]
-            stat.loc[len(stat)] = ['', '', p, len(curr_db)] 
+        def load(name):
+            # a plain ndarray view of the mapped pages, indexing a np.memmap costs more
+            return np.asarray(np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
 
-        for f in food:
-            curr_db = data[data.food==f]
-            totalcount = len(curr_db)
+        with open(os.path.join(path, 'search.json')) as f:
+            search = json.load(f)
+        search['cube_rows'] = load('cube_rows')
+        search['cube_counts'] = load('cube_counts')
+        search['advice'] = [(load('advice_values_%d' % i), load('advice_positions_%d' % i),
+                             load('advice_bounds_%d' % i)) for i in range(num_usr_slots)]
+        search['goal_rows'] = load('goal_rows')
+        search['goal_alias'] = dict((mode, (load('goal_prob_%s' % mode), load('goal_alias_%s' % mode)))
+                                    for mode in [GoalSampler.UNIFORM, GoalSampler.FREQUENCY])
+        search['cons_index'] = []
+        for slot_id in range(num_usr_slots):
+            postings = np.split(load('cons_postings_%d' % slot_id), load('cons_bounds_%d' % slot_id))
+            search['cons_index'].append({m_id: posting for m_id, posting in enumerate(postings)})
+        return search
 
-            for a in area:
-                count = len(curr_db[curr_db.area==a])        
-                if count > 0:
-                    stat.loc[len(stat)] = [f, a, '', count]
-                    curr_db_ = curr_db[curr_db.area==a]
+    @classmethod
+    def attach(cls, path, cache_size=None, goal_sampling=GoalSampler.UNIFORM, advice_eps=None, advice_delta=0.01):
+        """
+        Open a KB written by export_shared. The tables, the indexes and the search structures
+        are memory mapped read-only, so every process that attaches to the same path shares one
+        copy of them. An export without search structures has them rebuilt in this process.
 
-                    for p in pricerange:
-                        count = len(curr_db_[(curr_db_.pricerange==p)])
-                        if count > 0:
-                            stat.loc[len(stat)] = [f, a, p, count]
+        :param path: the export directory
+        :return: a read-only Database
+        """
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
 
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
 
-        for a in area:
-            curr_db = data[data.area==a]
-            totalcount = len(curr_db)
+        db = cls.__new__(cls)
+        db.usr_dirichlet_priors = [np.array(p) for p in meta['usr_dirichlet_priors']]
+        db.sys_dirichlet_priors = [np.array(p) for p in meta['sys_dirichlet_priors']]
+        db.num_usr_slots = len(db.usr_dirichlet_priors)
+        db.usr_modalities = [len(p) for p in db.usr_dirichlet_priors]
+        db.num_sys_slots = len(db.sys_dirichlet_priors)
+        db.sys_modalities = [len(p) for p in db.sys_dirichlet_priors]
+        db.usr_pdf = [np.array(p) for p in meta['usr_pdf']]
+        db.sys_pdf = [np.array(p) for p in meta['sys_pdf']]
+        db.num_rows = meta['num_rows']
+        db.usr_slot_names = meta['usr_slot_names']
 
-            for p in pricerange:
-                count = len(curr_db[curr_db.pricerange==p])        
-                if count > 0:
-                    stat.loc[len(stat)] = ['', a, p, count]
+        db.table = ColumnTable.wrap([load('table_%d' % i) for i in range(db.num_usr_slots)])
+        db.sys_table = ColumnTable.wrap([load('sys_%d' % i) for i in range(db.num_sys_slots + 1)])
+        db.cons_table = ColumnTable.wrap([load('cons_%d' % i) for i in range(db.num_usr_slots)])
+        shared = cls._load_search(path, db.num_usr_slots)
+        if shared is not None:
+            db.cons_index = shared['cons_index']
+        else:
+            db.cons_index = [cls._build_index(col, m) for col, m in zip(db.cons_table.columns, db.usr_modalities)]
+        db.indexes = []
+        for slot_id in range(db.num_usr_slots):
+            postings = np.split(load('postings_%d' % slot_id), load('bounds_%d' % slot_id))
+            db.indexes.append({m_id: posting for m_id, posting in enumerate(postings)})
+        db.all_rows = load('all_rows')
+        db.read_only = True
+        db.backend = None
+        db._setup_search(cache_size, goal_sampling, advice_eps, advice_delta, shared)
+        return db
 
-        for p in pricerange:
-            curr_db = data[data.pricerange==p]
-            totalcount = len(curr_db)
+    @staticmethod
+    def _get_stat(db, slot_names):
+        """
+        Build the advice statistics: the count of every value combination of every subset of the
+        searchable attributes that occurs in the table. An attribute that is not part of a
+        combination is left as ''.
+
+        :param db: 2D int array [num_rows x num_usr_slots]
+        :param slot_names: the name of each column
+        :return: DataFrame with one column per slot name and count
+        """
+        return DataCube.from_columns(list(np.asarray(db).transpose())).stat_frame(slot_names)
 
-            for f in food:
-                count = len(curr_db[curr_db.food==f])        
-                if count > 0:
-                    stat.loc[len(stat)] = [f, '', p, count]
-        
-        return stat
-            
     @staticmethod
     def _gen_table(pdf, modalities, num_cols, num_rows):
         list_table = []
@@ -172,114 +469,549 @@ class Database(object):
         for idx in range(num_cols):
             col = np.random.choice(range(modalities[idx]), p=pdf[idx], size=num_rows)
             list_table.append(col)
-            # indexing
-            index = {}
-            for m_id in range(modalities[idx]):
-                matched_list = np.squeeze(np.argwhere(col == m_id)).tolist()
-                matched_list = set(matched_list) if type(matched_list) is list else {matched_list}
-                index[m_id] = matched_list
-            indexes.append(index)
+            indexes.append(Database._build_index(col, modalities[idx]))
         return list_table, indexes
 
+    @staticmethod
+    def _build_index(col, modality):
+        """
+        Build the posting lists of one column.
+
+        :param col: 1D int array
+        :param modality: the vocab size of the column
+        :return: {attribute_word -> sorted array of row ids}
+        """
+        col = np.asarray(col, dtype=np.int64)
+        # a stable sort keeps the row ids of each value in increasing order
+        order = np.argsort(col, kind='mergesort')
+        order.setflags(write=False)
+        bounds = np.cumsum(np.bincount(col, minlength=modality))[:-1]
+        return {m_id: posting for m_id, posting in enumerate(np.split(order, bounds))}
+
+    @classmethod
+    def _load_compiled_kb(cls, slot_voc, usr_slots, kb_cache_dir):
+        """
+        Load the searchable table and its indexes from the KB snapshot in kb_cache_dir,
+        or build them from KB_PATH and save the snapshot if there is none yet.
+
+        :return: 2D int array [num_rows x num_usr_slots], indexes
+        """
+        snapshot_path = None
+        if kb_cache_dir is not None:
+            snapshot_path = KBSnapshot.get_path(kb_cache_dir, cls.KB_PATH, usr_slots)
+            snapshot = KBSnapshot.load(snapshot_path)
+            if snapshot is not None:
+                slot_voc.set_vocabularies(snapshot.vocab)
+                return snapshot.table, snapshot.indexes
+
+        usr_table, usr_index = cls.load_kb(slot_voc)
+        usr_table = np.array(usr_table).transpose()
+        if snapshot_path is not None:
+            KBSnapshot(slot_voc.get_vocabularies(), usr_table, usr_index).save(snapshot_path)
+        return usr_table, usr_index
+
     @staticmethod
     def load_kb(slot_voc):
-        db = pd.read_json('db.json')
+        db = pd.read_json(Database.KB_PATH)
         db = db.reset_index()
-        slots = ['food', 'area', 'pricerange']
+        slots = slot_voc.slot_names
         list_table = [np.array([slot_voc.get_slot_id(slot, v) for v in db[slot].values]) for slot in slots]
-        indexes = [{i:set(db.index[db[slot]==slot_voc.get_slot_value(slot, i)].tolist()) for i in range(len(slot_voc.slot_vocab[slot]))} for slot in slots]
+        indexes = [Database._build_index(col, len(slot_voc.slot_vocab[slot])) for col, slot in zip(list_table, slots)]
         return list_table, indexes
     
     def sample_unique_row(self):
         """
         :return: a unique row in the searchable table
         """
-        unique_rows = np.unique(self.cons_table, axis=0)
-        idxes = range(len(unique_rows))
-        np.random.shuffle(idxes)
-        return unique_rows[idxes[0]]
-        return row
+        if self.backend is not None:
+            return self.backend.sample_unique_row()
+        return self.goal_sampler.sample()
+
+    def sample_unique_rows(self, size):
+        """
+        :param size: the number of rows
+        :return: 2D array [size x num_usr_slots], independent draws of sample_unique_row
+        """
+        if self.backend is not None:
+            rows = [self.backend.sample_unique_row() for _ in range(size)]
+            return np.array(rows, dtype=np.int64).reshape(size, self.num_usr_slots)
+        return self.goal_sampler.draw(size)
 
     def select(self, query, return_index=False):
         """
-        Filter the database entries according the query.
+        Filter the database entries according the query. The posting lists of the constrained
+        attributes are intersected from the shortest to the longest one.
         
         :param query: 1D [] equal to the number of attributes, None means don't care
         :param return_index: if return the db index
-        :return return a list system_entries and (optional)index that satisfy all constrains
-        
+        :return return a read-only array of system_entries and (optional) the sorted index array
+        that satisfy all constrains
         """
-        valid_idx = set(range(self.num_rows))
-        for q, a_id in zip(query, range(self.num_usr_slots)):
-#             print(valid_idx, q, a_id, self.indexes)
-            if q:
-                valid_idx = valid_idx.intersection(self.indexes[a_id][q])
+        key = tuple(None if q is None else int(q) for q in query)
+        if self.query_cache is None:
+            entries, valid_idx = self._select(key)
+        else:
+            result = self.query_cache.get(key)
+            if result is None:
+                result = self._select(key)
+                self.query_cache.put(key, result)
+            entries, valid_idx = result
+
+        if return_index:
+            return entries, valid_idx
+        else:
+            return entries
+
+    def count(self, query):
+        """
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :return: the number of entries that satisfy all constrains, without loading them from a backend
+        """
+        key = tuple(None if q is None else int(q) for q in query)
+        if self.backend is not None:
+            return self.backend.count(key)
+        if all(q is None for q in key):
+            return len(self._live_rows())
+        return len(self.select(key, return_index=True)[1])
+
+    def sample_entry(self, query):
+        """
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :return: the system entry [UID + sys attributes] of a uniformly sampled entry that satisfies
+        all constrains, None if there is none. A backend only loads that entry.
+        """
+        if self.backend is not None:
+            key = tuple(None if q is None else int(q) for q in query)
+            num_valid = self.backend.count(key)
+            if num_valid == 0:
+                return None
+            return self.backend.entry(key, np.random.randint(0, num_valid))
+        entries = self.select(query)
+        if len(entries) == 0:
+            return None
+        return entries[np.random.randint(0, len(entries)), :]
+
+    def _select(self, query):
+        if self.backend is not None:
+            # loads every match, count and sample_entry do not
+            entries = np.array(list(self.backend.select(query)), dtype=np.int64).reshape(-1, 1 + self.num_sys_slots)
+            table = ColumnTable(list(entries.transpose()), [self.num_rows] + self.sys_modalities)
+            table.setflags(write=False)
+            valid_idx = table.columns[0].astype(np.int64)
+            valid_idx.setflags(write=False)
+            return table, valid_idx
+
+        given = [(a_id, q) for a_id, q in enumerate(query) if q is not None]
+        postings = [self._posting(a_id, q) for a_id, q in given]
+        if postings:
+            postings.sort(key=len)
+            valid_idx = postings[0]
+            for posting in postings[1:]:
                 if len(valid_idx) == 0:
                     break
-        valid_idx = list(valid_idx)        
-#         print('v_idx: ', valid_idx, query)
-        if return_index:
-            return self.sys_table[valid_idx, :], valid_idx
+                valid_idx = self._intersect(valid_idx, posting)
+        else:
+            valid_idx = self._live_rows()
+        if self.num_stale > 0 and postings and len(valid_idx) > 0:
+            valid_idx = self._verify(valid_idx, given)
+
+        entries = self.sys_table[valid_idx]
+        entries.setflags(write=False)
+        valid_idx.setflags(write=False)
+        return entries, valid_idx
+
+    def select_many(self, queries):
+        """
+        Count the matches of many queries at once and sample one matching entry for each of them.
+        The queries are grouped by the set of attributes they constrain, and each group is answered
+        with one binary search per query in the rows sorted by these attributes.
+
+        :param queries: 2D int array [num_queries x num_usr_slots], DONT_CARE means don't care
+        :return: 1D int array of the number of entries that satisfy each query, 1D int array of the
+        UID of one uniformly sampled matching entry per query (-1 if none), e.g. sys_table[uid]
+        """
+        queries = np.asarray(queries, dtype=np.int64).reshape(-1, self.num_usr_slots)
+        counts = np.zeros(len(queries), dtype=np.int64)
+        uids = np.full(len(queries), -1, dtype=np.int64)
+        if self.backend is not None:
+            for q_id, query in enumerate(queries.tolist()):
+                key = tuple(None if q == self.DONT_CARE else q for q in query)
+                counts[q_id] = self.backend.count(key)
+                if counts[q_id] > 0:
+                    uids[q_id] = self.backend.entry(key, np.random.randint(0, counts[q_id]))[0]
+            return counts, uids
+
+        patterns = (queries != self.DONT_CARE).dot(1 << np.arange(self.num_usr_slots, dtype=np.int64))
+        for pattern in np.unique(patterns).tolist():
+            q_ids = np.flatnonzero(patterns == pattern)
+            slots = tuple(a_id for a_id in range(self.num_usr_slots) if pattern >> a_id & 1)
+            lo, hi, order = self._pattern_ranges(slots, queries[q_ids][:, list(slots)])
+            counts[q_ids] = hi - lo
+            found = hi > lo
+            pos = lo[found] + (np.random.random(int(found.sum())) * (hi - lo)[found]).astype(np.int64)
+            uids[q_ids[found]] = order[pos]
+        return counts, uids
+
+    def _pattern_ranges(self, slots, values):
+        """
+        :param slots: the constrained attribute ids
+        :param values: 2D int array [n x len(slots)], the given values of n queries
+        :return: lo, hi, order such that order[lo[i]:hi[i]] are the entries that match query i
+        """
+        index = self.pattern_cache.get(slots)
+        if index is None:
+            live = self._live_rows()
+            # a constant last column keeps the key well defined when no attribute is constrained
+            rows = np.stack([self.table.columns[a_id][live] for a_id in slots] +
+                            [np.zeros(len(live), dtype=np.int64)], axis=1).astype(np.int64)
+            dims = rows.max(axis=0) + 1 if len(rows) > 0 else np.ones(len(slots) + 1, dtype=np.int64)
+            if np.sum(np.log2(dims.astype(np.float64))) < 62:
+                keys = np.ravel_multi_index(rows.transpose(), dims)
+                cells = None
+            else:
+                # too many combinations for a mixed radix key, number the distinct rows instead
+                distinct, keys = np.unique(rows, axis=0, return_inverse=True)
+                keys = keys.reshape(-1)
+                cells = dict((tuple(row), key) for key, row in enumerate(distinct.tolist()))
+            order = np.argsort(keys, kind='mergesort')
+            index = (dims, cells, keys[order], live[order])
+            self.pattern_cache.put(slots, index)
+        dims, cells, sorted_keys, order = index
+
+        values = np.concatenate([values, np.zeros((len(values), 1), dtype=np.int64)], axis=1)
+        valid = np.all((values >= 0) & (values < dims), axis=1)
+        if cells is None:
+            keys = np.ravel_multi_index(np.where(valid[:, None], values, 0).transpose(), dims)
+        else:
+            keys = np.array([cells.get(tuple(row), -1) for row in values.tolist()], dtype=np.int64)
+            valid &= keys >= 0
+        lo = np.searchsorted(sorted_keys, keys, side='left')
+        hi = np.where(valid, np.searchsorted(sorted_keys, keys, side='right'), lo)
+        return lo, hi, order
+
+    def _posting(self, a_id, value):
+        """
+        :return: the sorted row ids of a value, after merging the ids inserted since the last read
+        """
+        posting = self.indexes[a_id].get(value, self.no_rows)
+        pending = self.pending_postings[a_id].pop(value, None)
+        if pending:
+            posting = np.union1d(posting, pending)
+            posting.setflags(write=False)
+            self.indexes[a_id][value] = posting
+        return posting
+
+    def _verify(self, valid_idx, given):
+        """
+        Drop the candidate rows that were deleted or no longer hold the given values.
+
+        :param given: [(attribute id, value)]
+        """
+        keep = np.ones(len(valid_idx), dtype=bool)
+        for a_id, q in given:
+            keep &= self.table.columns[a_id][valid_idx] == q
+        if self.deleted:
+            keep &= ~np.isin(valid_idx, self._get_deleted_ids())
+        return valid_idx[keep]
+
+    def _live_rows(self):
+        """
+        :return: read-only sorted array of the ids of all the entries that are not deleted
+        """
+        if self.all_rows is None:
+            rows = np.arange(self.num_rows)
+            if self.deleted:
+                rows = np.setdiff1d(rows, self._get_deleted_ids(), assume_unique=True)
+            rows.setflags(write=False)
+            self.all_rows = rows
+        return self.all_rows
+
+    def _iter_chunks(self, chunk_size):
+        """
+        :return: iterator of 2D int arrays [<= chunk_size x num_usr_slots], the searchable values
+        of the entries that are not deleted
+        """
+        for start in range(0, self.num_rows, chunk_size):
+            block = np.stack([col[start:start + chunk_size] for col in self.table.columns], axis=1).astype(np.int64)
+            if self.deleted:
+                uids = np.arange(start, start + len(block))
+                block = block[~np.isin(uids, self._get_deleted_ids())]
+            if len(block) > 0:
+                yield block
+
+    def _get_deleted_ids(self):
+        if self._deleted_ids is None:
+            self._deleted_ids = np.array(sorted(self.deleted), dtype=np.int64)
+        return self._deleted_ids
+
+    def insert(self, usr_values, sys_values=None):
+        """
+        Add an entry to the KB.
+
+        :param usr_values: one value id per searchable attribute
+        :param sys_values: one value id per non-searchable attribute, sampled from sys_pdf if None
+        :return: the UID of the new entry
+        """
+        self._check_writable()
+        usr_values = [int(v) for v in usr_values]
+        if sys_values is None:
+            sys_values = [np.random.choice(m, p=pdf) for m, pdf in zip(self.sys_modalities, self.sys_pdf)]
+        uid = self.num_rows
+        self.table.append(usr_values)
+        self.sys_table.append([uid] + [int(v) for v in sys_values])
+        self.num_rows += 1
+        for a_id, v in enumerate(usr_values):
+            self.pending_postings[a_id].setdefault(v, []).append(uid)
+        self.advice_index.update(usr_values, 1)
+        self._kb_changed()
+        return uid
+
+    def delete(self, uid):
+        """
+        Remove an entry from the KB. Its UID is not reused.
+        """
+        self._check_uid(uid)
+        self.deleted.add(uid)
+        self.num_stale += self.num_usr_slots
+        self.advice_index.update(self.table[uid, :], -1)
+        self._kb_changed()
+
+    def update(self, uid, usr_values=None, sys_values=None):
+        """
+        Change the attributes of an entry.
+
+        :param usr_values: one value id per searchable attribute, None keeps the current ones
+        :param sys_values: one value id per non-searchable attribute, None keeps the current ones
+        """
+        self._check_uid(uid)
+        if sys_values is not None:
+            self.sys_table.set_row(uid, [uid] + [int(v) for v in sys_values])
+        if usr_values is not None:
+            old_values = self.table[uid, :].tolist()
+            usr_values = [int(v) for v in usr_values]
+            if usr_values != old_values:
+                self.table.set_row(uid, usr_values)
+                for a_id, (old, new) in enumerate(zip(old_values, usr_values)):
+                    if old != new:
+                        # the old posting list keeps a stale id until compact
+                        self.pending_postings[a_id].setdefault(new, []).append(uid)
+                        self.num_stale += 1
+                self.advice_index.update(old_values, -1)
+                self.advice_index.update(usr_values, 1)
+        self._kb_changed()
+
+    def compact(self):
+        """
+        Rebuild the posting lists from the current columns, without the deleted entries and the
+        stale ids left by update. Runs automatically once the stale ids exceed COMPACT_RATIO of
+        the rows.
+        """
+        self._check_writable()
+        live = self._live_rows()
+        self.indexes = []
+        for col, modality in zip(self.table.columns, self.usr_modalities):
+            col = col[live]
+            modality = max(modality, int(col.max()) + 1) if len(col) > 0 else modality
+            index = {}
+            for value, posting in self._build_index(col, modality).items():
+                posting = live[posting]
+                posting.setflags(write=False)
+                index[value] = posting
+            self.indexes.append(index)
+        self.pending_postings = [{} for _ in range(self.num_usr_slots)]
+        self.num_stale = 0
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ValueError("Cannot modify a read-only Database")
+
+    def _check_uid(self, uid):
+        self._check_writable()
+        if not 0 <= uid < self.num_rows or uid in self.deleted:
+            raise ValueError("No entry with UID %s" % uid)
+
+    def _kb_changed(self):
+        self.version += 1
+        self._db_stat = None
+        self._relax_index = None
+        self.all_rows = None
+        self._deleted_ids = None
+        if self.query_cache is not None:
+            self.query_cache.clear()
+        self.pattern_cache.clear()
+        if self.num_stale > self.COMPACT_RATIO * self.num_rows:
+            self.compact()
+
+    @staticmethod
+    def _intersect(small, large):
+        """
+        :param small: sorted id array
+        :param large: sorted id array, not shorter than small
+        :return: the sorted ids that are in both arrays
+        """
+        if len(large) == 0:
+            return large
+        pos = np.searchsorted(large, small)
+        pos[pos == len(large)] = 0
+        return small[large[pos] == small]
+
+    def coverage_report(self, goals=None):
+        """
+        Measure how many goals can be satisfied by the KB, for every combination of searchable
+        attributes. A goal is covered on a combination if some KB row has the same values on
+        all of its attributes.
+
+        :param goals: 2D int array [num_goals x num_usr_slots], cons_table if None
+        :return: OrderedDict {(slot_name, ...) -> fraction of covered goals}
+        """
+        goals = self.cons_table if goals is None else np.asarray(goals)
+        kb = self.table[self._live_rows()] if self.deleted else self.table
+        report = OrderedDict()
+        for size in range(1, self.num_usr_slots + 1):
+            for combo in itertools.combinations(range(self.num_usr_slots), size):
+                combo = list(combo)
+                (kb_keys, goal_keys), num_keys = self._pack_rows(kb[:, combo], goals[:, combo])
+                if num_keys <= self.DENSE_KEY_LIMIT:
+                    present = np.zeros(num_keys, dtype=bool)
+                    present[kb_keys] = True
+                    covered = present[goal_keys]
+                else:
+                    covered = np.isin(goal_keys, np.unique(kb_keys))
+                names = tuple(self.usr_slot_names[i] for i in combo)
+                report[names] = float(np.mean(covered)) if len(covered) > 0 else 0.0
+                self.logger.info("KB covers %.4f of %d goals on %s" % (report[names], len(goals), names))
+        return report
+
+    @staticmethod
+    def _pack_rows(*tables):
+        """
+        Encode the rows of int tables with the same columns as one int64 key per row, so that
+        equal rows get equal keys.
+
+        :return: [a 1D key array for each table], the number of possible keys
+        """
+        tables = [np.asarray(t, dtype=np.int64) for t in tables]
+        stacked = np.concatenate(tables)
+        dims = stacked.max(axis=0) + 1 if len(stacked) > 0 else np.ones(stacked.shape[1], dtype=np.int64)
+        if np.sum(np.log2(dims.astype(np.float64))) < 62:
+            keys = np.ravel_multi_index(stacked.transpose(), dims)
+            num_keys = int(np.prod(dims))
         else:
-            return self.sys_table[valid_idx, :]
+            # too many combinations for a mixed radix key, number the distinct rows instead
+            keys = np.unique(stacked, axis=0, return_inverse=True)[1].reshape(-1)
+            num_keys = int(keys.max()) + 1
+        return np.split(keys, np.cumsum([len(t) for t in tables])[:-1]), num_keys
 
     def pprint(self):
         """
         print statistics of the database in a beautiful format. 
         """
+        if self.backend is not None:
+            self.logger.info("DB contains %d rows in %s, with %d attributes"
+                             % (self.num_rows, self.backend.__class__.__name__, self.num_usr_slots))
+            return
 
         self.logger.info("DB contains %d rows (%d unique ones), with %d attributes"
                          % (self.num_rows, len(np.unique(self.table, axis=0)), self.num_usr_slots))
     
     
-    def get_advice(self, constraints, constraint_order=[]):           
-        belief_state = {'area': None, 'pricerange': None, 'food': None}
-        cols = {0:'food', 1:'area', 2:'pricerange'}
-#         for k, v in constraints.iteritems():            
-#             belief_state[k] = v
-        for i, c in enumerate(constraints):
-            belief_state[cols[i]] = c
-        
-        search_query = {s: None for s in belief_state}
-        flag = False
-        for s, v in belief_state.items():
-            if v is not None:
-                search_query[s] = v
-                flag = True
-#             else:
-#                 search_query.pop(s)
-        
-        t = self.db_stat
-        for s,v in search_query.items():
-            if v is not None:
-                t = t[t[s]==v]
-            else:
-                if flag:
-                    t = t[t[s]!='']
+    def get_advice(self, constraints, constraint_order=[]):
+        """
+        :param constraints: one value id per searchable attribute, None means not given
+        :return: up to 6 [value id or '' for each attribute, count] rows with the highest count
+        """
+        if self.backend is not None:
+            return self.backend.get_advice(constraints)
+        return self.advice_index.lookup(constraints)
+
+    def get_relaxations(self, constraints):
+        """
+        The queries nearest to a constraint that have matches, e.g. to offer alternatives when
+        select finds nothing.
 
-        t = t.sort_values(by=['count'], ascending=False)
+        :param constraints: one value id per searchable attribute, None means not given
+        :return: a list of (constraint tuple with one attribute dropped or changed, number of
+        matching rows) by decreasing count, see RelaxationIndex.lookup
+        """
+        if self.backend is not None:
+            return self.backend.get_relaxations(constraints)
+        if self.cube is None:
+            raise ValueError("get_relaxations needs exact advice statistics")
+        if self._relax_index is None:
+            self._relax_index = RelaxationIndex(self.cube)
+        return self._relax_index.lookup(constraints)
+
+    @staticmethod
+    def _frame_advice(db_stat, constraints, top_k=6):
+        """
+        Reference implementation of get_advice that filters and sorts the stat DataFrame on
+        every call. AdviceIndex is checked against it.
+        """
+        slot_names = list(db_stat.columns[:-1])
+        given = dict((slot_names[i], c) for i, c in enumerate(constraints) if c is not None)
+
+        t = db_stat
+        for s in slot_names:
+            if s in given:
+                t = t[t[s] == given[s]]
+            elif given:
+                t = t[t[s] != '']
+
+        # stable sort, ties keep the order of db_stat
+        t = t.sort_values(by=['count'], ascending=False, kind='mergesort')
         t = t.reset_index(drop=True)
-#         print(t)
         
         advice = []        
         for idx, row in t.iterrows():
-            advice.append([row.food, row.area, row.pricerange, row['count']])
-            if idx >=5:
+            advice.append([row[s] for s in slot_names] + [row['count']])
+            if idx >= top_k - 1:
                 break
-  
-#         if len(advice) == 0:
-#             for i in range(len(belief_state)):
-# #                 search_query = [v for j, (s,v) in enumerate(belief_state.items()) if v in uniq_constraint[:-(i+1)]]
-# #                 search_query = {s: v for j, (s,v) in enumerate(belief_state.items()) if j!=i}
-#                 c = [None, None, None]
-#                 for i, v in enumerate(constraints[:-1]):
-#                     c[i] = v
-                
-#                 advice = self.get_advice(c)
-#                 if len(advice) > 0:
-#                     break
-                    
-#         if len(advice) == 0:
-#             advice = self.get_advice({})
         return advice
-        
\ No newline at end of file
+
+
+class QueryCache(object):
+    """
+    A bounded LRU cache of SELECT results keyed by the normalized query tuple.
+
+    :ivar max_size: the max number of cached queries
+    :ivar hits: the number of lookups answered from the cache
+    :ivar misses: the number of lookups that were not cached
+    :ivar evictions: the number of results dropped to respect max_size
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        :return: the cached result or None if the key is not cached
+        """
+        result = self.entries.pop(key, None)
+        if result is None:
+            self.misses += 1
+            return None
+        # re-insert to mark it as the most recently used
+        self.entries[key] = result
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        self.entries[key] = result
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def hit_rate(self):
+        """
+        :return: hits / lookups, 0.0 if there was no lookup
+        """
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups > 0 else 0.0
+
+    def clear(self):
+        self.entries.clear()
+
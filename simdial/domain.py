@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 # author: Tiancheng Zhao
-from simdial.database import Database
+from simdial.database import Database, GoalSampler
 import numpy as np
 from simdial.agent.core import BaseSysSlot
 import logging
@@ -14,11 +14,24 @@ class DomainSpec(object):
     :cvar sys_slots: [(slot_name, slot_description, dim) ...]
     :cvar nlg_spec: {slot_type -> {inform: [], request: [], yn_question: [(utt, target)]}}
     :cvar db_size: the size of database
+    :cvar db_cache_size: the number of SELECT results the database memoizes, None disables it
+    :cvar goal_sampling: how user goals are drawn from the constraint table, see GoalSampler
+    :cvar kb_cache_dir: the directory of compiled KB snapshots, None to parse the KB every time
+    :cvar advice_eps: None for exact advice statistics, or the relative error bound of approximate ones
+    :cvar advice_delta: the failure probability of the approximate advice counts
+    :cvar relax_no_match: when the user constraints match nothing, the system offers the alternatives of
+    the best relaxed query instead of restarting the search, needs exact advice statistics
     """
     nlg_spec = None
     usr_slots = None
     sys_slots = None
     db_size = None
+    db_cache_size = None
+    goal_sampling = GoalSampler.UNIFORM
+    kb_cache_dir = None
+    advice_eps = None
+    advice_delta = 0.01
+    relax_no_match = False
     name = None
     greet = None
 
@@ -83,12 +96,14 @@ class Domain(object):
 
     logger = logging.getLogger(__name__)
 
-    def __init__(self, domain_spec):
+    def __init__(self, domain_spec, db=None):
         """
         :param domain_spec: an implementation of DomainSpec
+        :param db: an existing Database for this spec (e.g. from Database.attach), None to build one
         """
         self.name = domain_spec.name
         self.greet = domain_spec.greet
+        self.relax_no_match = domain_spec.relax_no_match
         self.usr_slots = [Slot("#"+name, desc, vocab) for name, desc, vocab in domain_spec.usr_slots]
         self.sys_slots = [Slot("#"+name, desc, vocab) for name, desc, vocab in domain_spec.sys_slots]
         self.sys_slots.insert(0, Slot(BaseSysSlot.DEFAULT, "", [str(i) for i in range(domain_spec.db_size)]))
@@ -106,7 +121,14 @@ class Domain(object):
         # we left out DEFAULT from prior since it'e KEY
         sys_slot_priors = [np.ones(s.dim) for s in self.sys_slots[1:]]
 
-        self.db = Database(usr_slot_priors, sys_slot_priors, num_rows=domain_spec.db_size, usr_slots=domain_spec.usr_slots)
+        if db is None:
+            db = Database(usr_slot_priors, sys_slot_priors, num_rows=domain_spec.db_size, usr_slots=domain_spec.usr_slots,
+                          cache_size=domain_spec.db_cache_size, goal_sampling=domain_spec.goal_sampling,
+                          kb_cache_dir=domain_spec.kb_cache_dir, advice_eps=domain_spec.advice_eps,
+                          advice_delta=domain_spec.advice_delta)
+        if self.relax_no_match and db.backend is None and db.cube is None:
+            raise ValueError("relax_no_match needs exact advice statistics, unset advice_eps")
+        self.db = db
         self.db.pprint()
 
     def get_usr_slot(self, slot_name, return_idx=False):
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+from simdial.agent.core import UserAct
+from simdial.agent.user import User
+from simdial.agent.nlg import UserNlg
+from simdial.channel import ActionChannel, WordChannel
+from simdial.generator import seed_dialog
+from simdial.writer import ActCorpusWriter
+import numpy as np
+
+
+class TurnEncoder(object):
+    """
+    Encodes the actions of a user turn into fixed size arrays of ActVocab ids, the observations
+    of DialogEnv:
+
+        act    int16 [max_acts] the act of each action, NONE after the last one
+        slot   int16 [max_acts x max_params] the slot of each parameter, NONE after the last one
+        value  int32 [max_acts x max_params] see ActVocab.value_id
+        conf   float32 the confidence of the channel
+
+    :ivar vocab: the ActVocab of the domain
+    :ivar max_acts: the most actions of a turn
+    :ivar max_params: the most parameters of an action, a kb_return with every goal and a repeat
+    """
+
+    def __init__(self, domain, max_acts):
+        self.vocab = ActCorpusWriter.vocab(domain)
+        self.max_acts = max_acts
+        self.max_params = len(domain.usr_slots) + len(domain.sys_slots) + 2
+
+    def empty(self, num=None):
+        """
+        :param num: None for one observation, else a batch of num
+        :return: {name -> array} of empty turns
+        """
+        lead = () if num is None else (num,)
+        obs = {'act': np.empty(lead + (self.max_acts,), dtype=np.int16),
+               'slot': np.empty(lead + (self.max_acts, self.max_params), dtype=np.int16),
+               'value': np.empty(lead + (self.max_acts, self.max_params), dtype=np.int32),
+               'conf': np.empty(lead, dtype=np.float32)}
+        self.clear(obs, Ellipsis)
+        return obs
+
+    def clear(self, obs, row):
+        for name in ['act', 'slot', 'value']:
+            obs[name][row] = self.vocab.NONE
+        obs['conf'][row] = 1.0
+
+    def encode(self, actions, conf, obs, row):
+        """
+        Write a turn into row of obs, Ellipsis for an observation of empty(None).
+        """
+        if len(actions) > self.max_acts:
+            raise ValueError("A turn of %d actions, max_acts is %d" % (len(actions), self.max_acts))
+        vocab = self.vocab
+        self.clear(obs, row)
+        act, slot, value = obs['act'][row], obs['slot'][row], obs['value'][row]
+        for a_id, action in enumerate(actions):
+            act[a_id] = action.act_id
+            for p_id, (s, v) in enumerate(vocab.iter_params(action.parameters)):
+                if p_id >= self.max_params:
+                    raise ValueError("%s has more than %d parameters" % (action.act, self.max_params))
+                slot[a_id, p_id] = vocab.slot_ids.get(s, vocab.UNKNOWN)
+                value[a_id, p_id] = vocab.value_id(s, v)
+        obs['conf'][row] = conf
+
+
+class DialogEnv(object):
+    """
+    A Gym-style environment in which the caller plays the system against one simulated user,
+    in place of System.policy. step takes the system actions of a turn, and the User,
+    ActionChannel, UserNlg and WordChannel answer as in Generator.gen_dialog.
+
+    The observation is the noisy user turn encoded by TurnEncoder; reset gives an empty turn,
+    as System.step sees before the greeting. The dialog is done when the user says goodbye,
+    with the terminal reward of User.step: 1.0 if every goal of the user is met, -1.0 if not.
+    The other rewards are 0.
+
+    :ivar domain: the Domain of the dialogs
+    :ivar complexity: the Complexity of the user and of the channels
+    :ivar advice_prob: the chance that the user takes each suggestion
+    :ivar encoder: the TurnEncoder of the observations
+    :ivar usr: the User of the current dialog, None before reset and when it is done
+    """
+
+    MAX_ACTS = 16
+
+    def __init__(self, domain, complexity, advice_prob=1.0, max_acts=MAX_ACTS):
+        self.domain = domain
+        self.complexity = complexity
+        self.advice_prob = advice_prob
+        self.encoder = TurnEncoder(domain, max_acts)
+        self.action_channel = ActionChannel(domain, complexity)
+        self.word_channel = WordChannel(domain, complexity)
+        self.usr_nlg = UserNlg(domain, complexity)
+        self.usr = None
+
+    def reset(self, seed=None):
+        """
+        Start a dialog with a new user.
+
+        :param seed: None, or a seed of the global np.random and random states, see seed_dialog
+        :return: the first observation
+        """
+        if seed is not None:
+            seed_dialog(seed, 0)
+        self.usr = User(self.domain, self.complexity, self.advice_prob)
+        return self.encoder.empty()
+
+    def step(self, actions, suggestions=None):
+        """
+        :param actions: the Action, or list of Action, of the system turn
+        :param suggestions: None, or the {slot -> value} advice of SysNlg.generate_sent
+        :return: observation, reward, done, info (see respond)
+        """
+        obs = self.encoder.empty()
+        reward, done, info = self._step(actions, suggestions, obs, Ellipsis)
+        return obs, reward, done, info
+
+    def respond(self, actions, suggestions=None):
+        """
+        The user turn that answers a system turn, as step without the encoding.
+
+        :return: reward, done, info with the noisy user 'actions', their 'conf', the 'utt' and,
+        when done, the 'success' of the dialog
+        """
+        if self.usr is None:
+            raise ValueError("The dialog is over, call reset")
+        if type(actions) is not list:
+            actions = [actions]
+        _, _, usr_as = self.usr.step(actions, suggestions or {})
+        noisy_usr_as, conf = self.action_channel.transmit2sys(usr_as)
+        usr_utt = self.word_channel.transmit2sys(self.usr_nlg.generate_sent(noisy_usr_as))
+
+        info = {'actions': noisy_usr_as, 'conf': conf, 'utt': usr_utt}
+        done = any(a.act == UserAct.GOODBYE for a in usr_as)
+        reward = 0.0
+        if done:
+            info['success'] = self.usr.state.unmet_goal() is None
+            reward = 1.0 if info['success'] else -1.0
+            self.usr = None
+        return reward, done, info
+
+    def _step(self, actions, suggestions, obs, row):
+        reward, done, info = self.respond(actions, suggestions)
+        self.encoder.encode(info['actions'], info['conf'], obs, row)
+        return reward, done, info
+
+
+class VecDialogEnv(object):
+    """
+    num_envs DialogEnv stepped in lockstep in one process, with batched observations, rewards
+    and dones. The observations are written into one preallocated batch of TurnEncoder arrays.
+
+    A dialog that is done is reset at once: its row of the returned observations is the first
+    observation of the next dialog, and its last observation is info['terminal_observation'].
+
+    :ivar envs: the DialogEnv of each row
+    :ivar encoder: the TurnEncoder of the observations
+    :ivar copy: return copies of the batch, else the batch itself, overwritten by the next step
+    """
+
+    def __init__(self, domain, complexity, num_envs, advice_prob=1.0, max_acts=DialogEnv.MAX_ACTS, copy=True):
+        self.envs = [DialogEnv(domain, complexity, advice_prob, max_acts) for _ in range(num_envs)]
+        self.encoder = self.envs[0].encoder
+        self.copy = copy
+        self.obs = self.encoder.empty(num_envs)
+        self.rewards = np.zeros(num_envs, dtype=np.float32)
+        self.dones = np.zeros(num_envs, dtype=bool)
+
+    @property
+    def num_envs(self):
+        return len(self.envs)
+
+    def _batch(self, arrays):
+        if not self.copy:
+            return arrays
+        if isinstance(arrays, dict):
+            return dict((name, a.copy()) for name, a in arrays.items())
+        return arrays.copy()
+
+    def reset(self, seed=None):
+        """
+        :param seed: None, or a seed of the global np.random and random states, see seed_dialog
+        :return: the first observations
+        """
+        if seed is not None:
+            seed_dialog(seed, 0)
+        for env in self.envs:
+            env.reset()
+        self.encoder.clear(self.obs, Ellipsis)
+        return self._batch(self.obs)
+
+    def step(self, actions, suggestions=None):
+        """
+        :param actions: a list of num_envs system turns, see DialogEnv.step
+        :param suggestions: None, or a list of num_envs suggestions
+        :return: observations, rewards, dones, a list of num_envs info
+        """
+        if len(actions) != len(self.envs):
+            raise ValueError("Expected %d system turns, got %d" % (len(self.envs), len(actions)))
+        infos = []
+        for row, env in enumerate(self.envs):
+            reward, done, info = env._step(actions[row], None if suggestions is None else suggestions[row],
+                                           self.obs, row)
+            if done:
+                info['terminal_observation'] = dict((name, a[row].copy()) for name, a in self.obs.items())
+                env.reset()
+                self.encoder.clear(self.obs, row)
+            self.rewards[row] = reward
+            self.dones[row] = done
+            infos.append(info)
+        return self._batch(self.obs), self._batch(self.rewards), self._batch(self.dones), infos
@@ -3,17 +3,49 @@
 
 from simdial.agent.user import User
 from simdial.agent.system import System
+from simdial.agent.core import SystemAct, UserAct
 from simdial.channel import ActionChannel, WordChannel
 from simdial.agent.nlg import SysNlg, UserNlg
 from simdial.complexity import Complexity
 from simdial.domain import Domain
+from simdial.writer import TextWriter, JsonlWriter, get_writer
 #import progressbar
+from collections import OrderedDict, deque
+import multiprocessing
+import itertools
 import json
 import numpy as np
+import random
 import sys
 import os
 import re
 
+
+def seed_dialog(seed, dialog_id):
+    """
+    Seed the global np.random and random states with the stream of one dialog, an independent
+    child of the master seed, so that the dialog does not depend on the ones before it.
+    """
+    words = np.random.SeedSequence(seed, spawn_key=(dialog_id,)).generate_state(4)
+    np.random.seed(words[0:2])
+    random.seed(int(words[2]) << 32 | int(words[3]))
+
+
+# the arguments of gen in a worker process, set by the pool initializer
+_worker_args = None
+
+
+def _init_worker(generator, domain, complexity, advice_prob, seed, writer_cls, compression):
+    global _worker_args
+    _worker_args = (generator, domain, complexity, advice_prob, seed, writer_cls, compression)
+
+
+def _gen_shard(bounds):
+    generator, domain, complexity, advice_prob, seed, writer_cls, compression = _worker_args
+    results = generator.gen_seeded(domain, complexity, bounds[0], bounds[1], seed, advice_prob)
+    return generator.format_shard(bounds[0], results, writer_cls, compression, domain)
+
+
 class Generator(object):
     """
     The generator class used to generate synthetic slot-filling human-computer conversation in any domain. 
@@ -21,8 +53,14 @@ class Generator(object):
     level. 
     
     The required input is a domain specification dictionary + a configuration dict.
+
+    :cvar SHARD_SIZE: the number of dialogs a worker process generates per task
+    :cvar MAX_PENDING_SHARDS: the max number of shards per worker that are generated ahead of the consumer
     """
 
+    SHARD_SIZE = 256
+    MAX_PENDING_SHARDS = 2
+
     @staticmethod
     def pack_msg(speaker, utt, **kwargs):
         resp = {k: v for k, v in kwargs.items()}
@@ -33,147 +71,220 @@ class Generator(object):
     @staticmethod
     def pprint(dialogs, usr_goals, in_json, domain_spec, output_file=None):
         """
-        Print the dailog to a file or STDOUT
+        Print the dailog to a file or STDOUT, in one JSON document or in the format of TextWriter
         
         :param dialogs: a list of dialogs generated
         :param output_file: None if print to STDOUT. Otherwise write the file in the path
         """
-        f = sys.stdout if output_file is None else open(output_file, "wb")
-        
-        cnt_others, cnt_inf, cnt_req, cnt_query = 0., 0., 0., 0.
-        
-        if in_json:
-            combo = {'dialogs': dialogs}#, 'meta': domain_spec.to_dict()}
-            json.dump(combo, f, indent=2)
-        
-        else:
-            for idx, (d, usr_g) in enumerate(zip(dialogs, usr_goals)):
-                f.write("## DIALOG %d ##\n" % idx)
-                f.write("User goal: " + str(usr_g)+'\n')
-                for turn in d:
-                    speaker, utt, actions = turn["speaker"], turn["utt"], turn["actions"]
-#                     print(actions)
-                    act = [a.dump_string() for a in actions]
-                    act = " ".join(act)
-#                     print(act, utt)
-#                     print(act, any(s in act for s in ['#open', '#parking']))        
-                    if any(s in act for s in ['query']):
-                        cnt_query += 1
-
-                    elif any(s in act for s in ['#open', '#parking', 'kb_return']):
-                        cnt_req += 1               
-                    
-                    elif any(s in act for s in ['#food', '#area', '#pricerange']):
-                        cnt_inf += 1                                    
-                    
-                    else:
-                        cnt_others += 1
-                    
-                    if utt:
-                        str_actions = utt
-                    else:
-                        str_actions = " ".join([a.dump_string() for a in actions])
-                    
-#                     if speaker == "SYS":
-#                         f.write('Act: %s, Sugg: %s\n' %(act, turn["suggestions"]))
-#                     else:
-#                         f.write('Act: %s\n' %(act))
-                    
-                    if '{"QUERY"' not in str_actions and '{"RET"' not in str_actions:
-                        if speaker == "USR":
-    #                         f.write("%s(%f)-> %s\n" % (speaker, turn['conf'], str_actions))
-                            f.write("%s -> %s\n" % (speaker, str_actions))
-                        else:
-                            f.write("%s -> %s\n" % (speaker, str_actions))
-
-                f.write("\n")
-                
-        if output_file is not None:
-            f.close()
-        
-        print(cnt_inf/len(dialogs), cnt_req/len(dialogs), cnt_others/len(dialogs), cnt_query/len(dialogs))
-        
+        stats = CorpusStats()
+        for d in dialogs:
+            stats.add(d)
+
+        f = sys.stdout if output_file is None else open(output_file, "w")
+        try:
+            if in_json:
+                combo = {'dialogs': dialogs}#, 'meta': domain_spec.to_dict()}
+                json.dump(combo, f, indent=2, default=JsonlWriter._to_json)
+            else:
+                for idx, (d, usr_g) in enumerate(zip(dialogs, usr_goals)):
+                    Generator.write_dialog(f, idx, d, usr_g)
+        finally:
+            if output_file is not None:
+                f.close()
+
+        stats.print_act_ratios()
+
+    @staticmethod
+    def write_dialog(f, idx, dialog, usr_goal):
+        """
+        Write one dialog in the text format of pprint.
+
+        :param f: a file opened for writing
+        :param idx: the dialog number
+        """
+        f.write(TextWriter.format_dialog(idx, dialog, usr_goal))
+
     @staticmethod
-    def print_stats(dialogs):
+    def print_stats(dialogs, db=None):
         """
         Print some basic stats of the dialog.
         
         :param dialogs: A list of dialogs generated.
+        :param db: the Database used for generation, to report its query cache
         """
-        print("%d dialogs" % len(dialogs))
-        all_lens = [len(d) for d in dialogs]
-        print("Avg len {} Max Len {}".format(np.mean(all_lens), np.max(all_lens)))
-
-        total_cnt = 0.
-        kb_cnt = 0.
-        ratio = []
+        stats = CorpusStats()
         for d in dialogs:
-            local_cnt = 0.
-            for t in d:
-                total_cnt +=1
-                if 'QUERY' in t['utt']:
-                    kb_cnt += 1
-                    local_cnt += 1
-            ratio.append(local_cnt/len(d))
-#         print(kb_cnt/total_cnt)
-#         print(np.mean(ratio))
-
-    def gen(self, domain, complexity, num_sess=1, advice_prob=1.0):
+            stats.add(d)
+        stats.print_stats(db)
+
+    def gen(self, domain, complexity, num_sess=1, advice_prob=1.0, num_workers=1, seed=None):
         """
         Generate synthetic dialogs in the given domain. 
 
         :param domain: a domain specification dictionary
         :param complexity: an implmenetaiton of Complexity
         :param num_sess: how dialogs to generate
+        :param num_workers: the number of processes, more than 1 shards the dialogs over a pool
+        :param seed: the master seed, dialog i draws from its own stream derived from it (see
+        seed_dialog) so the output does not depend on num_workers. None draws every dialog from the
+        global random state, or draws the master seed from it when num_workers > 1
         :return: a list of dialogs. Each dialog is a list of turns.
         """
         dialogs = []
         usr_goals = []
+        for dialog, usr_goal in self.iter_dialogs(domain, complexity, num_sess, advice_prob, num_workers, seed):
+            dialogs.append(dialog)
+            usr_goals.append(usr_goal)
+        return dialogs, usr_goals
+
+    def iter_dialogs(self, domain, complexity, num_sess=1, advice_prob=1.0, num_workers=1, seed=None):
+        """
+        Generate the dialogs of gen one at a time, in the same order.
+
+        :return: iterator of (dialog, user goal)
+        """
+        for shard in self._iter_shards(domain, complexity, num_sess, advice_prob, num_workers, seed):
+            for result in shard:
+                yield result
+
+    def _iter_shards(self, domain, complexity, num_sess, advice_prob, num_workers, seed, writer_cls=None,
+                     compression=None):
+        """
+        Generate the dialogs SHARD_SIZE at a time. With a pool at most MAX_PENDING_SHARDS shards
+        per worker are in flight, so the memory use does not grow with num_sess even when the
+        consumer is slower than the workers.
+
+        :param writer_cls: None, or a CorpusWriter class to serialize the shards where they are generated
+        :param compression: the compression of the serialized shards
+        :return: iterator of the shards, see format_shard
+        """
+        if seed is None and num_workers > 1:
+            seed = int(np.random.randint(0, 2 ** 31 - 1))
+        shards = ((start, min(start + self.SHARD_SIZE, num_sess)) for start in range(0, num_sess, self.SHARD_SIZE))
+
+        if seed is None:
+            models = self._dialog_models(domain, complexity)
+            for start, stop in shards:
+                # draw the first goal of every user of the shard at once
+                goal_rows = domain.db.sample_unique_rows(stop - start)
+                results = [self.gen_dialog(domain, complexity, models, advice_prob, goal_row)
+                           for goal_row in goal_rows]
+                yield self.format_shard(start, results, writer_cls, compression, domain)
+        elif num_workers <= 1:
+            for start, stop in shards:
+                results = self.gen_seeded(domain, complexity, start, stop, seed, advice_prob)
+                yield self.format_shard(start, results, writer_cls, compression, domain)
+        else:
+            # the workers are forked with the domain and its KB, each shard is a range of dialog ids
+            pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                        initargs=(self, domain, complexity, advice_prob, seed, writer_cls, compression))
+            try:
+                pending = deque(pool.apply_async(_gen_shard, (shard,))
+                                for shard in itertools.islice(shards, self.MAX_PENDING_SHARDS * num_workers))
+                while pending:
+                    shard = pending.popleft().get()
+                    for bounds in itertools.islice(shards, 1):
+                        pending.append(pool.apply_async(_gen_shard, (bounds,)))
+                    yield shard
+            finally:
+                # also stops the workers when the consumer gives up early
+                pool.terminate()
+                pool.join()
+
+    @staticmethod
+    def format_shard(start, results, writer_cls=None, compression=None, domain=None):
+        """
+        :param start: the id of the first dialog of the shard
+        :param results: a list of (dialog, user goal)
+        :param writer_cls: None, or the CorpusWriter class whose encode_shard serializes the dialogs
+        :param compression: None, 'gzip' or 'xz'
+        :param domain: the Domain of the dialogs
+        :return: results if writer_cls is None, else the encoded dialogs (see CorpusWriter.encode_shard) and their CorpusStats
+        """
+        if writer_cls is None:
+            return results
+        stats = CorpusStats()
+        for dialog, _ in results:
+            stats.add(dialog)
+        return writer_cls.encode_shard(start, results, compression, domain), stats
+
+    def gen_seeded(self, domain, complexity, start, stop, seed, advice_prob=1.0):
+        """
+        Generate the dialogs with ids in [start, stop), each one from its own seed_dialog stream.
+
+        :return: a list of (dialog, user goal)
+        """
+        models = self._dialog_models(domain, complexity)
+        results = []
+        for dialog_id in range(start, stop):
+            seed_dialog(seed, dialog_id)
+            results.append(self.gen_dialog(domain, complexity, models, advice_prob))
+        return results
+
+    @staticmethod
+    def _dialog_models(domain, complexity):
+        """
+        :return: the channels and the natural language generators shared by the dialogs
+        """
         action_channel = ActionChannel(domain, complexity)
         word_channel = WordChannel(domain, complexity)
 
         # natural language generators
         sys_nlg = SysNlg(domain, complexity)
         usr_nlg = UserNlg(domain, complexity)
+        return action_channel, word_channel, sys_nlg, usr_nlg
 
-        #bar = progressbar.ProgressBar(max_value=num_sess)
-        for i in range(num_sess):
-#             print("Dial:{}".format(i))
-            #bar.update(i)
-            usr = User(domain, complexity, advice_prob)
-            sys = System(domain, complexity)
-            usr_goals.append(usr.usr_cons_readable)
-            
-            # begin conversation
-            noisy_usr_as = []
-            dialog = []
-            conf = 1.0
-            while True:
-                # make a decision
-                sys_r, sys_t, sys_as, sys_s, stat_query = sys.step(noisy_usr_as, conf)
-#                 print('sys: ', sys_as)
-                sys_utt, sys_str_as, suggestions = sys_nlg.generate_sent(sys_as, domain=domain, stat_query=stat_query)
-                dialog.append(self.pack_msg("SYS", sys_utt, actions=sys_str_as, domain=domain.name, state=sys_s, suggestions=suggestions))
-#                 print(suggestions)
-            
-                if sys_t:
-                    break
-
-                usr_r, usr_t, usr_as = usr.step(sys_as, suggestions)
-#                 print('usr: ', usr_as)
-
-                # passing through noise, nlg and noise!
-                noisy_usr_as, conf = action_channel.transmit2sys(usr_as)
-                usr_utt = usr_nlg.generate_sent(noisy_usr_as)
-                noisy_usr_utt = word_channel.transmit2sys(usr_utt)
-
-                dialog.append(self.pack_msg("USR", noisy_usr_utt, actions=noisy_usr_as, conf=conf, domain=domain.name))
+    def gen_dialog(self, domain, complexity, models, advice_prob=1.0, goal_row=None):
+        """
+        Simulate one dialog between a new user and a new system.
 
-            dialogs.append(dialog)
+        :param models: the output of _dialog_models
+        :param goal_row: the KB row of the first user goal, None to sample it
+        :return: the dialog as a list of turns, the readable user goal
+        """
+        action_channel, word_channel, sys_nlg, usr_nlg = models
+        usr = User(domain, complexity, advice_prob, goal_row)
+        sys = System(domain, complexity)
+        usr_goal = usr.usr_cons_readable
 
-        return dialogs, usr_goals
+        # begin conversation
+        noisy_usr_as = []
+        dialog = []
+        conf = 1.0
+        while True:
+            # make a decision
+            sys_r, sys_t, sys_as, sys_s, stat_query = sys.step(noisy_usr_as, conf)
+#             print('sys: ', sys_as)
+            sys_utt, sys_str_as, suggestions = sys_nlg.generate_sent(sys_as, domain=domain, stat_query=stat_query)
+            dialog.append(self.pack_msg("SYS", sys_utt, actions=sys_str_as, domain=domain.name, state=sys_s, suggestions=suggestions))
+#             print(suggestions)
+
+            if sys_t:
+                break
+
+            usr_r, usr_t, usr_as = usr.step(sys_as, suggestions)
+#             print('usr: ', usr_as)
+
+            # passing through noise, nlg and noise!
+            noisy_usr_as, conf = action_channel.transmit2sys(usr_as)
+            usr_utt = usr_nlg.generate_sent(noisy_usr_as)
+            noisy_usr_utt = word_channel.transmit2sys(usr_utt)
+
+            dialog.append(self.pack_msg("USR", noisy_usr_utt, actions=action_channel.recorded_actions(usr_as, noisy_usr_as),
+                                        conf=conf, domain=domain.name))
+
+        return dialog, usr_goal
+
+    def gen_corpus(self, name, domain_spec, complexity_spec, size, advice_prob=1.0, num_workers=1, seed=None,
+                   fmt='text', compression=None):
+        """
+        Generate a corpus into the directory name. Each shard of dialogs is serialized, compressed
+        and counted where it is generated, in the worker processes with num_workers > 1, and it is
+        written as soon as it arrives, so the corpus is never held in memory.
 
-    def gen_corpus(self, name, domain_spec, complexity_spec, size, advice_prob=1.0):
+        :param fmt: the corpus format, a key of simdial.writer.WRITERS
+        :param compression: None, 'gzip' or 'xz'
+        """
         if not os.path.exists(name):
             os.mkdir(name)
 
@@ -181,17 +292,106 @@ class Generator(object):
         domain = Domain(domain_spec)
         complex = Complexity(complexity_spec)
 
+        prefix = "{}-{}-{}".format(domain_spec.name, complexity_spec.__name__, size)
+
         # generate the corpus conditioned on domain & complexity
-        corpus, usr_goals = self.gen(domain, complex, num_sess=size, advice_prob=advice_prob)
+        stats = CorpusStats()
+        with get_writer(os.path.join(name, prefix), fmt=fmt, compression=compression, domain=domain) as writer:
+            shards = self._iter_shards(domain, complex, size, advice_prob, num_workers, seed,
+                                       writer_cls=type(writer), compression=compression)
+            for data, shard_stats in shards:
+                writer.write_encoded(data, shard_stats.num_dialogs)
+                stats.merge(shard_stats)
+        stats.print_act_ratios()
+        stats.print_stats(domain.db)
+
 
-        # txt_file = "{}-{}-{}.{}".format(domain_spec.name,
-        #                                complexity_spec.__name__,
-        #                                size, 'txt')
+class CorpusStats(object):
+    """
+    Statistics of a corpus updated one dialog at a time.
+
+    :ivar num_dialogs: the number of dialogs added
+    :ivar num_turns: the total number of turns
+    :ivar max_len: the number of turns of the longest dialog
+    :ivar act_counts: the number of turns with a QUERY, a request, an inform or anything else
+    :cvar REQUEST_SLOTS: a turn that mentions one of these slots, or returns a KB result, is a request
+    :cvar INFORM_SLOTS: otherwise a turn that mentions one of these slots is an inform
+    """
 
-        json_file = "{}-{}-{}.{}".format(domain_spec.name,
-                                         complexity_spec.__name__,
-                                         size, 'txt')
+    REQUEST_SLOTS = ('#open', '#parking')
+    INFORM_SLOTS = ('#food', '#area', '#pricerange')
 
-        json_file = os.path.join(name, json_file)
-        self.pprint(corpus, usr_goals, False, domain_spec, json_file)
-        self.print_stats(corpus)
+    def __init__(self):
+        self.num_dialogs = 0
+        self.num_turns = 0
+        self.max_len = 0
+        self.act_counts = OrderedDict([('inform', 0.), ('request', 0.), ('others', 0.), ('query', 0.)])
+
+    def add(self, dialog):
+        self.num_dialogs += 1
+        self.num_turns += len(dialog)
+        self.max_len = max(self.max_len, len(dialog))
+        query_slots = []
+        for turn in dialog:
+            acts = [a.act for a in turn["actions"]]
+            slots = []
+            for a in turn["actions"]:
+                slots.extend(self._slots(a.parameters))
+                if a.act == UserAct.KB_RETURN:
+                    query_slots = list(self._slots(a.parameters[0]))
+                elif a.act == SystemAct.INFORM and turn["speaker"] == "SYS":
+                    # the system informs the results of the last KB return, so it mentions its query
+                    slots.extend(query_slots)
+
+            if SystemAct.QUERY in acts:
+                self.act_counts['query'] += 1
+            elif UserAct.KB_RETURN in acts or any(s in slots for s in self.REQUEST_SLOTS):
+                self.act_counts['request'] += 1
+            elif any(s in slots for s in self.INFORM_SLOTS):
+                self.act_counts['inform'] += 1
+            else:
+                self.act_counts['others'] += 1
+
+    @classmethod
+    def _slots(cls, param):
+        """
+        :return: iterator of the slot names and the values in a (nested) action parameter
+        """
+        if isinstance(param, dict):
+            for key, value in param.items():
+                yield key
+                for s in cls._slots(value):
+                    yield s
+        elif isinstance(param, (list, tuple)):
+            for p in param:
+                for s in cls._slots(p):
+                    yield s
+        else:
+            yield param
+
+    def merge(self, other):
+        """
+        Add the dialogs counted by another CorpusStats.
+        """
+        self.num_dialogs += other.num_dialogs
+        self.num_turns += other.num_turns
+        self.max_len = max(self.max_len, other.max_len)
+        for key, count in other.act_counts.items():
+            self.act_counts[key] += count
+
+    def print_act_ratios(self):
+        """
+        Print the turns per dialog of each act category, as pprint does.
+        """
+        print(" ".join(str(c / max(self.num_dialogs, 1)) for c in self.act_counts.values()))
+
+    def print_stats(self, db=None):
+        """
+        :param db: the Database used for generation, to report its query cache
+        """
+        print("%d dialogs" % self.num_dialogs)
+        print("Avg len {} Max Len {}".format(float(self.num_turns) / max(self.num_dialogs, 1), self.max_len))
+        if db is not None and db.query_cache is not None:
+            cache = db.query_cache
+            print("Query cache hit rate {:.3f} ({} hits, {} misses, {} evictions)".format(
+                cache.hit_rate(), cache.hits, cache.misses, cache.evictions))
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+from simdial.agent.core import Action
+from simdial.agent.system import System
+from simdial.env import DialogEnv
+from simdial.writer import JsonlWriter
+import numpy as np
+import itertools
+import asyncio
+import logging
+import json
+import time
+
+
+def _dump_line(obj):
+    return (json.dumps(obj, default=JsonlWriter._to_json) + "\n").encode('utf-8')
+
+
+class UserServer(object):
+    """
+    Hosts simulated users for dialog systems in other processes or languages: an asyncio server
+    of newline-delimited JSON on a Unix socket or a localhost TCP port. Every session is a
+    DialogEnv of the one shared Domain, so a system turn is answered as in Generator.gen_dialog.
+
+    Each request is a JSON object on one line, answered by one line with the same "id", in order
+    on each connection:
+
+        {"id": 1, "op": "new"}
+            -> {"id": 1, "session": 7, "goal": {user slot -> value}}
+        {"id": 2, "op": "step", "session": 7, "actions": [{"act": "request", "parameters": [["#food", null]]}],
+         "suggestions": {"#food": 3}}
+            -> {"id": 2, "actions": [...], "conf": 0.95, "utt": "...", "reward": 0.0, "done": false}
+        {"id": 3, "op": "close", "session": 7}
+            -> {"id": 3}
+        {"id": 4, "op": "stats"}
+            -> {"id": 4, "sessions": 1, "requests": 3, "mean_us": 120.5, "max_us": 410.2}
+
+    The actions are {"act": act, "parameters": [...]} with the parameters of Action, "suggestions"
+    is optional. A session ends when its dialog is done, when it is closed and when the connection
+    that created it is closed. A failed request is answered with {"id": .., "error": message}.
+
+    :ivar sessions: {session id -> DialogEnv}
+    :ivar num_requests: the number of requests answered
+    :ivar total_time: the seconds spent answering them
+    :ivar max_time: the longest answer in seconds
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, domain, complexity, advice_prob=1.0):
+        self.domain = domain
+        self.complexity = complexity
+        self.advice_prob = advice_prob
+        self.sessions = {}
+        self.num_requests = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self._session_ids = itertools.count()
+
+    @staticmethod
+    def decode_actions(actions):
+        """
+        :param actions: a list of {"act": .., "parameters": [..]}
+        :return: a list of Action, a [slot, value] pair becomes a tuple
+        """
+        def param(p):
+            if isinstance(p, list) and len(p) == 2 and isinstance(p[0], str):
+                return tuple(p)
+            return p
+        return [Action(a['act'], [param(p) for p in a.get('parameters', [])]) for a in actions]
+
+    @staticmethod
+    def encode_actions(actions):
+        return [a.to_json() for a in actions]
+
+    def handle(self, request, owned=None):
+        """
+        :param request: a decoded request
+        :param owned: None, or the set of the sessions of the connection
+        :return: the response without its id
+        """
+        op = request.get('op')
+        if op == 'new':
+            session = next(self._session_ids)
+            env = DialogEnv(self.domain, self.complexity, self.advice_prob)
+            env.reset()
+            self.sessions[session] = env
+            if owned is not None:
+                owned.add(session)
+            return {'session': session, 'goal': env.usr.usr_cons_readable}
+
+        if op == 'step':
+            session = request.get('session')
+            env = self.sessions.get(session)
+            if env is None:
+                raise ValueError("Unknown session %s" % session)
+            reward, done, info = env.respond(self.decode_actions(request['actions']), request.get('suggestions'))
+            if done:
+                self._end(session, owned)
+            return {'actions': self.encode_actions(info['actions']), 'conf': info['conf'], 'utt': info['utt'],
+                    'reward': reward, 'done': done}
+
+        if op == 'close':
+            self._end(request.get('session'), owned)
+            return {}
+
+        if op == 'stats':
+            return {'sessions': len(self.sessions), 'requests': self.num_requests,
+                    'mean_us': self.total_time / max(self.num_requests, 1) * 1e6, 'max_us': self.max_time * 1e6}
+
+        raise ValueError("Unknown op %s" % op)
+
+    def _end(self, session, owned):
+        self.sessions.pop(session, None)
+        if owned is not None:
+            owned.discard(session)
+
+    def answer(self, line, owned=None):
+        """
+        :param line: a request line
+        :return: the response line
+        """
+        start = time.time()
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            response = self.handle(request, owned)
+        except Exception as e:
+            # a bad request must not take the connection and its sessions down
+            self.logger.warning("Request failed: %r" % e)
+            response = {'error': "%s: %s" % (type(e).__name__, e)}
+        response['id'] = request_id
+        data = _dump_line(response)
+        elapsed = time.time() - start
+        self.num_requests += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        return data
+
+    async def _serve_connection(self, reader, writer):
+        owned = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(self.answer(line, owned))
+                await writer.drain()
+        except ConnectionError as e:
+            self.logger.info("Connection lost: %r" % e)
+        finally:
+            for session in owned:
+                self.sessions.pop(session, None)
+            writer.close()
+
+    async def start(self, path=None, host='127.0.0.1', port=0):
+        """
+        :param path: the path of a Unix socket, None to listen on host:port (0 picks a free port)
+        :return: the asyncio Server
+        """
+        if path is not None:
+            return await asyncio.start_unix_server(self._serve_connection, path=path)
+        return await asyncio.start_server(self._serve_connection, host, port)
+
+    def run(self, path=None, host='127.0.0.1', port=0):
+        """
+        Serve until the process is stopped.
+        """
+        async def serve():
+            server = await self.start(path, host, port)
+            self.logger.info("Serving users on %s" % (path or server.sockets[0].getsockname(),))
+            async with server:
+                await server.serve_forever()
+        asyncio.run(serve())
+
+
+class UserClient(object):
+    """
+    A client of UserServer that pipelines the requests of many sessions on one connection: each
+    request gets an id and a future, that the response with that id resolves.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self._request_ids = itertools.count()
+        self._read_task = asyncio.ensure_future(self._read())
+
+    @classmethod
+    async def connect(cls, path=None, host='127.0.0.1', port=None):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def _read(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                self.pending.pop(response['id']).set_result(response)
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("The server closed the connection"))
+
+    async def request(self, op, **kwargs):
+        """
+        :return: the response, see UserServer
+        """
+        request_id = next(self._request_ids)
+        future = self.pending[request_id] = asyncio.get_event_loop().create_future()
+        self.writer.write(_dump_line(dict(kwargs, id=request_id, op=op)))
+        response = await future
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    async def close(self):
+        self.writer.close()
+        await self._read_task
+
+
+async def load_test(domain, complexity, num_turns=100000, num_sessions=1000, num_connections=4,
+                    path=None, host='127.0.0.1', port=None):
+    """
+    Drive num_sessions concurrent dialogs against a UserServer, with System as the dialog system
+    in this process, until num_turns user turns are answered. A session starts a new dialog when
+    one is done, and finishes the one it is in when num_turns is reached. The round trips include
+    the time the requests wait in this process, the server stats do not.
+
+    :return: {'turns', 'dialogs', 'seconds', 'latency': the round trip seconds of each turn,
+    'server': the stats of the server}
+    """
+    clients = [await UserClient.connect(path, host, port) for _ in range(num_connections)]
+    latency = []
+    counts = {'turns': 0, 'dialogs': 0}
+
+    async def session(client):
+        while counts['turns'] < num_turns:
+            session_id = (await client.request('new'))['session']
+            system = System(domain, complexity)
+            usr_as, conf = [], 1.0
+            while True:
+                _, _, sys_as, _, _ = system.step(usr_as, conf)
+                start = time.time()
+                response = await client.request('step', session=session_id,
+                                                actions=UserServer.encode_actions(sys_as))
+                latency.append(time.time() - start)
+                counts['turns'] += 1
+                if response['done']:
+                    counts['dialogs'] += 1
+                    break
+                usr_as, conf = UserServer.decode_actions(response['actions']), response['conf']
+
+    start = time.time()
+    await asyncio.gather(*[session(clients[i % num_connections]) for i in range(num_sessions)])
+    seconds = time.time() - start
+    server = await clients[0].request('stats')
+    for client in clients:
+        await client.close()
+    return dict(counts, seconds=seconds, latency=np.array(latency), server=server)
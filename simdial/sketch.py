@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import itertools
+import math
+from simdial.cube import group_rows
+
+
+class CountMinSketch(object):
+    """
+    Approximate counts of int rows in a depth x width table of counters. An estimate never
+    undercounts, and overcounts by more than eps * total with probability at most delta.
+
+    :ivar width: the number of counters per hash, the smallest power of 2 >= e / eps
+    :ivar depth: the number of hashes, ceil(ln(1 / delta))
+    :ivar table: 2D int array [depth x width]
+    :ivar total: the sum of all the counts added
+    """
+
+    def __init__(self, num_cols, eps, delta, seed=0):
+        bits = max(1, int(math.ceil(math.log(math.e / eps, 2))))
+        self.width = 1 << bits
+        self.depth = max(1, int(math.ceil(math.log(1.0 / delta))))
+        self.table = np.zeros((self.depth, self.width), dtype=np.int64)
+        self.total = 0
+        # vector multiply-shift hashing: (sum(a_j * x_j) + b) mod 2^64, top bits
+        rng = np.random.RandomState(seed)
+        self._mult = rng.randint(0, 1 << 62, size=(self.depth, num_cols, 1), dtype=np.int64).astype(np.uint64)
+        self._mult = self._mult * np.uint64(2) + np.uint64(1)
+        self._add = rng.randint(0, 1 << 62, size=(self.depth, 1), dtype=np.int64).astype(np.uint64)
+        self._shift = np.uint64(64 - bits)
+
+    def _hash(self, rows):
+        rows = np.asarray(rows, dtype=np.int64).astype(np.uint64)
+        h = np.repeat(self._add, len(rows), axis=1)
+        for col_id in range(rows.shape[1]):
+            h += self._mult[:, col_id] * rows[:, col_id]
+        return (h >> self._shift).astype(np.intp)
+
+    def add(self, rows, counts):
+        """
+        :param rows: 2D int array [n x num_cols]
+        :param counts: 1D int array [n], may be negative to remove rows
+        """
+        if len(rows) == 0:
+            return
+        for d, h in enumerate(self._hash(rows)):
+            self.table[d] += np.bincount(h, weights=counts, minlength=self.width).astype(np.int64)
+        self.total += int(np.sum(counts))
+
+    def query(self, rows):
+        """
+        :return: 1D int array, the estimated count of each row
+        """
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        h = self._hash(rows)
+        return np.min([self.table[d][h[d]] for d in range(self.depth)], axis=0)
+
+
+class HeavyHitters(object):
+    """
+    A mergeable Misra-Gries summary of int rows that keeps at most capacity rows. A kept count
+    undercounts the true one by at most error <= total / (capacity + 1), so every row whose
+    count exceeds that bound is kept.
+
+    :ivar capacity: the max number of rows kept
+    :ivar rows: 2D int array, the kept rows in lexicographic order
+    :ivar counts: 1D int array, their counts minus the decrements
+    :ivar error: the sum of the decrements
+    :ivar total: the sum of all the counts added
+    """
+
+    def __init__(self, num_cols, capacity):
+        self.capacity = capacity
+        self.rows = np.zeros((0, num_cols), dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.error = 0
+        self.total = 0
+
+    def add(self, rows, counts):
+        """
+        :param rows: 2D int array [n x num_cols]
+        :param counts: 1D int array [n]; a negative count only lowers a kept row
+        """
+        if len(rows) == 0:
+            return
+        self.total += int(np.sum(counts))
+        rows, counts = group_rows(np.concatenate([self.rows, rows]), np.concatenate([self.counts, counts]))
+        keep = counts > 0
+        rows, counts = rows[keep], counts[keep]
+        if len(counts) > self.capacity:
+            # subtract the (capacity + 1)-th largest count from every row and drop the non positive ones
+            cut = np.partition(counts, len(counts) - self.capacity - 1)[len(counts) - self.capacity - 1]
+            keep = counts > cut
+            rows, counts = rows[keep], counts[keep] - cut
+            self.error += int(cut)
+        self.rows, self.counts = rows, counts
+
+
+class SketchAdvice(object):
+    """
+    Approximate advice with the same interface and semantics as AdviceIndex, answered from
+    summaries whose size depends on eps and not on the KB size. They are built in one streaming
+    pass over the KB rows.
+
+    Without constraint: a HeavyHitters summary per set of at most max_order attributes, and per
+    the set of all of them, keeps every cell whose count exceeds eps * num_rows. A CountMinSketch
+    per set estimates their counts, overcounting by at most eps * num_rows with probability
+    1 - delta. Finer sets rarely reach the top_k, as a cell never counts more than its coarser cells.
+
+    With constraints: a HeavyHitters summary of the full cells of each attribute value keeps
+    every cell whose count exceeds eps * the rows with that value. The summary of the least
+    frequent given value is filtered by the other given values, and the counts are estimated
+    with the sketch of the full cells. So the advice may leave out, or be empty for, cells that
+    are rare within the given value.
+
+    :ivar num_slots: the number of searchable attributes
+    :ivar eps: the error bound relative to the number of counted rows
+    :ivar delta: the probability that a count estimate exceeds its error bound
+    :ivar top_k: the max number of advice rows
+    :ivar slot_sets: the attribute sets of the summaries, in DataCube.slot_sets order
+    :ivar summaries: {slots -> HeavyHitters}
+    :ivar sketches: {slots -> CountMinSketch}
+    :ivar value_summaries: [{value -> HeavyHitters of the full cells with this value}] one per attribute
+    :ivar memo: {constraint tuple -> advice rows}
+    """
+
+    MAX_ORDER = 2
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, num_slots, eps, delta, max_order=MAX_ORDER, top_k=6):
+        self.num_slots = num_slots
+        self.eps = eps
+        self.delta = delta
+        self.top_k = top_k
+        self.capacity = int(math.ceil(1.0 / eps))
+        self.slot_sets = [slots for size in range(1, num_slots + 1)
+                          for slots in itertools.combinations(range(num_slots), size)
+                          if size <= max_order or size == num_slots]
+        self.summaries = {}
+        self.sketches = {}
+        for seed, slots in enumerate(self.slot_sets):
+            self.summaries[slots] = HeavyHitters(len(slots), self.capacity)
+            self.sketches[slots] = CountMinSketch(len(slots), eps, delta, seed=seed)
+        self.value_summaries = [{} for _ in range(num_slots)]
+        self.memo = {}
+
+    @property
+    def nbytes(self):
+        summaries = list(self.summaries.values()) + [s for d in self.value_summaries for s in d.values()]
+        return sum(s.rows.nbytes + s.counts.nbytes for s in summaries) + \
+            sum(s.table.nbytes for s in self.sketches.values())
+
+    @classmethod
+    def build(cls, chunks, num_slots, eps, delta, max_order=MAX_ORDER, top_k=6):
+        """
+        :param chunks: iterable of 2D int arrays [n x num_slots], the KB rows
+        """
+        advice = cls(num_slots, eps, delta, max_order=max_order, top_k=top_k)
+        for chunk in chunks:
+            advice.add(chunk)
+        return advice
+
+    def add(self, rows, counts=None):
+        """
+        Count a chunk of KB rows.
+
+        :param rows: 2D int array [n x num_slots]
+        :param counts: 1D int array [n], the count of each row (may be negative), 1 if None
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if counts is None:
+            counts = np.ones(len(rows), dtype=np.int64)
+        rows, counts = group_rows(rows, counts)
+        for slots in self.slot_sets:
+            cells, cell_counts = group_rows(rows[:, list(slots)], counts)
+            self.summaries[slots].add(cells, cell_counts)
+            self.sketches[slots].add(cells, cell_counts)
+        for slot_id, summaries in enumerate(self.value_summaries):
+            order = np.argsort(rows[:, slot_id], kind='mergesort')
+            values, starts = np.unique(rows[order, slot_id], return_index=True)
+            for value, ids in zip(values.tolist(), np.split(order, starts[1:])):
+                if value not in summaries:
+                    summaries[value] = HeavyHitters(self.num_slots, self.capacity)
+                summaries[value].add(rows[ids], counts[ids])
+        self.memo.clear()
+
+    def update(self, row, delta):
+        """
+        :param row: one value id per attribute of a KB row
+        :param delta: the change of its count, +1 for an insert and -1 for a delete
+        """
+        self.add(np.array([row], dtype=np.int64), np.array([delta], dtype=np.int64))
+
+    def lookup(self, constraints):
+        """
+        :param constraints: one value id per attribute, None means not given
+        :return: a list of advice rows (shared, do not modify), [] if nothing matches
+        """
+        key = tuple(constraints)
+        if len(key) < self.num_slots:
+            key += (None,) * (self.num_slots - len(key))
+        advice = self.memo.get(key)
+        if advice is None:
+            given = [(i, int(v)) for i, v in enumerate(key) if v is not None]
+            advice = self.memo[key] = self._group_advice(given) if given else self._top_advice()
+        return advice
+
+    def _top_advice(self):
+        blocks, estimates = [], []
+        for slots in self.slot_sets:
+            summary = self.summaries[slots]
+            estimate = np.minimum(self.sketches[slots].query(summary.rows), summary.counts + summary.error)
+            order = np.argsort(-estimate, kind='mergesort')[0:self.top_k]
+            block = np.full((len(order), self.num_slots), -1, dtype=np.int64)
+            block[:, list(slots)] = summary.rows[order]
+            blocks.append(block)
+            estimates.append(estimate[order])
+        rows, estimate = np.concatenate(blocks), np.concatenate(estimates)
+        order = np.argsort(-estimate, kind='mergesort')[0:self.top_k]
+        return [[v if v >= 0 else '' for v in row] + [count]
+                for row, count in zip(rows[order].tolist(), estimate[order].tolist())]
+
+    def _group_advice(self, given):
+        summaries = [self.value_summaries[i].get(v) for i, v in given]
+        if any(s is None for s in summaries):
+            return []
+        summary = min(summaries, key=lambda s: s.total)
+        match = np.ones(len(summary.counts), dtype=bool)
+        for i, v in given:
+            match &= summary.rows[:, i] == v
+        rows = summary.rows[match]
+        full = self.slot_sets[-1]
+        estimate = np.minimum(self.sketches[full].query(rows), summary.counts[match] + summary.error)
+        order = np.argsort(-estimate, kind='mergesort')[0:self.top_k]
+        return [row + [count] for row, count in zip(rows[order].tolist(), estimate[order].tolist())]
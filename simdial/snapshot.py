@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import hashlib
+import logging
+import json
+import os
+
+
+class KBSnapshot(object):
+    """
+    A compiled knowledge base: the integer coded searchable columns, the vocabularies used for the
+    coding and the posting lists. It is stored as an uncompressed .npz file
+    whose name contains a hash of the KB file and of the user slots, so a change to either one
+    makes the old snapshot unreachable.
+
+    :ivar vocab: {slot -> [value, ...]} values in id order
+    :ivar table: 2D int array [num_rows x num_usr_slots]
+    :ivar indexes: [{attribute_word -> sorted array of corresponding rows}]
+    """
+
+    logger = logging.getLogger(__name__)
+    FORMAT_VERSION = 2
+
+    def __init__(self, vocab, table, indexes):
+        self.vocab = vocab
+        self.table = table
+        self.indexes = indexes
+
+    @classmethod
+    def get_path(cls, cache_dir, kb_path, usr_slots):
+        """
+        :param cache_dir: the directory that holds the snapshots
+        :param kb_path: the raw KB file, e.g. db.json
+        :param usr_slots: the usr_slots of the DomainSpec
+        :return: the snapshot path for this KB and slots
+        """
+        digest = hashlib.sha1()
+        digest.update(("v%d" % cls.FORMAT_VERSION).encode('utf-8'))
+        with open(kb_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        digest.update(json.dumps(usr_slots, sort_keys=True).encode('utf-8'))
+        return os.path.join(cache_dir, "kb-%s.npz" % digest.hexdigest())
+
+    def save(self, path):
+        arrays = {'vocab': np.array(json.dumps(self.vocab)),
+                  'table': self.table}
+        for slot_id, index in enumerate(self.indexes):
+            postings = [index[m_id] for m_id in range(len(index))]
+            arrays['postings_%d' % slot_id] = np.concatenate(postings)
+            arrays['bounds_%d' % slot_id] = np.cumsum([len(p) for p in postings])[:-1]
+
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # write aside and rename, so a reader never sees a partial file
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmp_path, path)
+        self.logger.info("Saved KB snapshot to %s" % path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :return: a KBSnapshot or None if there is no snapshot at this path
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            vocab = json.loads(str(data['vocab']))
+            # each access to a member reads it again from the archive
+            table = data['table']
+            num_slots = table.shape[1]
+            indexes = []
+            for slot_id in range(num_slots):
+                postings = data['postings_%d' % slot_id]
+                postings.setflags(write=False)
+                indexes.append({m_id: p for m_id, p in enumerate(np.split(postings, data['bounds_%d' % slot_id]))})
+            snapshot = cls(vocab, table, indexes)
+        cls.logger.info("Loaded KB snapshot from %s" % path)
+        return snapshot
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+from simdial.table import ColumnTable
+from simdial.cube import DataCube, group_rows
+from simdial.database import Database
+import numpy as np
+import logging
+import json
+import os
+
+
+class SyntheticKB(object):
+    """
+    Generates KBs of any size from Dirichlet priors, for scale testing. Each attribute of each
+    entry is drawn independently from an attribute PDF sampled once from its prior, as
+    Database does for the non-searchable attributes.
+
+    The rows are produced in chunks and written straight to the export_shared layout, so a KB
+    far larger than memory never exists as Python objects; open it with Database.attach.
+
+    :ivar usr_dirichlet_priors: the prior of each searchable attribute : 2D list [[]*modality]
+    :ivar sys_dirichlet_priors: the prior of each non-searchable attribute : 2D list
+    :ivar usr_pdf: the PDF of each searchable attribute : 2D list
+    :ivar sys_pdf: the PDF of each non-searchable attribute : 2D list
+    :ivar usr_slot_names: the name of each searchable attribute
+    """
+
+    logger = logging.getLogger(__name__)
+
+    CHUNK_SIZE = 1 << 20
+    NUM_GOALS = 5000
+
+    def __init__(self, usr_dirichlet_priors, sys_dirichlet_priors, usr_slot_names=None, seed=None):
+        """
+        :param usr_slot_names: None to name them slot0, slot1 ...
+        :param seed: the seed of the generator, None to use the global numpy random state
+        """
+        self.rng = np.random if seed is None else np.random.RandomState(seed)
+        self.usr_dirichlet_priors = [np.asarray(p, dtype=np.float64) for p in usr_dirichlet_priors]
+        self.sys_dirichlet_priors = [np.asarray(p, dtype=np.float64) for p in sys_dirichlet_priors]
+        self.usr_modalities = [len(p) for p in self.usr_dirichlet_priors]
+        self.sys_modalities = [len(p) for p in self.sys_dirichlet_priors]
+        self.usr_pdf = [self.rng.dirichlet(p) for p in self.usr_dirichlet_priors]
+        self.sys_pdf = [self.rng.dirichlet(p) for p in self.sys_dirichlet_priors]
+        if usr_slot_names is None:
+            usr_slot_names = ["slot%d" % i for i in range(len(self.usr_modalities))]
+        self.usr_slot_names = list(usr_slot_names)
+
+    @classmethod
+    def from_spec(cls, domain_spec, seed=None):
+        """
+        The uniform priors that Domain gives the slots of a DomainSpec.
+        """
+        return cls([np.ones(len(vocab)) for _, _, vocab in domain_spec.usr_slots],
+                   [np.ones(len(vocab)) for _, _, vocab in domain_spec.sys_slots],
+                   usr_slot_names=[name for name, _, _ in domain_spec.usr_slots], seed=seed)
+
+    @classmethod
+    def from_modalities(cls, usr_modalities, sys_modalities, concentration=1.0, seed=None):
+        """
+        Symmetric priors, a concentration below 1 gives skewed attribute PDFs.
+
+        :param usr_modalities: the vocab size of each searchable attribute
+        :param sys_modalities: the vocab size of each non-searchable attribute
+        """
+        return cls([np.ones(m) * concentration for m in usr_modalities],
+                   [np.ones(m) * concentration for m in sys_modalities], seed=seed)
+
+    def _draw(self, pdf, num_rows):
+        return np.stack([self.rng.choice(len(p), p=p, size=num_rows) for p in pdf], axis=1)
+
+    def iter_chunks(self, num_rows, chunk_size=CHUNK_SIZE):
+        """
+        :return: iterator of (usr_block [n x num_usr_slots], sys_block [n x num_sys_slots]) in UID
+        order, e.g. for SQLiteBackend.build
+        """
+        for start in range(0, num_rows, chunk_size):
+            size = min(chunk_size, num_rows - start)
+            yield self._draw(self.usr_pdf, size), self._draw(self.sys_pdf, size)
+
+    def sample_goals(self, num_goals=NUM_GOALS):
+        """
+        :return: 2D int array [num_goals x num_usr_slots] of user goals
+        """
+        return self._draw(self.usr_pdf, num_goals)
+
+    def write(self, path, num_rows, num_goals=NUM_GOALS, chunk_size=CHUNK_SIZE):
+        """
+        Write a KB of num_rows entries in the export_shared layout. The columns are written
+        chunk by chunk, then the posting lists are filled by a counting sort over the columns
+        that were just written, so the memory use depends on chunk_size and not on num_rows.
+
+        :param path: a directory, created if needed
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        def create(name, dtype, size):
+            return np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+', dtype=dtype, shape=(size,))
+
+        id_dtype = ColumnTable.narrowest_dtype(num_rows)
+        usr_cols = [create('table_%d' % i, ColumnTable.narrowest_dtype(m), num_rows)
+                    for i, m in enumerate(self.usr_modalities)]
+        sys_cols = [create('sys_0', id_dtype, num_rows)]
+        sys_cols += [create('sys_%d' % (i + 1), ColumnTable.narrowest_dtype(m), num_rows)
+                     for i, m in enumerate(self.sys_modalities)]
+        all_rows = create('all_rows', id_dtype, num_rows)
+        value_counts = [np.zeros(m, dtype=np.int64) for m in self.usr_modalities]
+        cube_rows = np.zeros((0, len(self.usr_modalities)), dtype=np.int64)
+        cube_counts = np.zeros(0, dtype=np.int64)
+
+        start = 0
+        for usr_block, sys_block in self.iter_chunks(num_rows, chunk_size):
+            rows = slice(start, start + len(usr_block))
+            uids = np.arange(rows.start, rows.stop)
+            all_rows[rows] = uids
+            sys_cols[0][rows] = uids
+            for i, col in enumerate(usr_cols):
+                col[rows] = usr_block[:, i]
+                value_counts[i] += np.bincount(usr_block[:, i], minlength=len(value_counts[i]))
+            for i, col in enumerate(sys_cols[1:]):
+                col[rows] = sys_block[:, i]
+            # the full cuboid of the advice statistics, as big as the distinct rows and not as the KB
+            cube_rows, cube_counts = group_rows(np.concatenate([cube_rows, usr_block]),
+                                                np.concatenate([cube_counts, np.ones(len(usr_block), dtype=np.int64)]))
+            start = rows.stop
+
+        for slot_id, (col, counts) in enumerate(zip(usr_cols, value_counts)):
+            postings = create('postings_%d' % slot_id, id_dtype, num_rows)
+            # the next free position of each value, chunks come in UID order so each posting list stays sorted
+            cursor = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            for start in range(0, num_rows, chunk_size):
+                values = np.asarray(col[start:start + chunk_size], dtype=np.int64)
+                order = np.argsort(values, kind='mergesort')
+                chunk_counts = np.bincount(values, minlength=len(counts))
+                chunk_starts = np.concatenate([[0], np.cumsum(chunk_counts)[:-1]])
+                sorted_values = values[order]
+                postings[cursor[sorted_values] + np.arange(len(order)) - chunk_starts[sorted_values]] = start + order
+                cursor += chunk_counts
+            np.save(os.path.join(path, 'bounds_%d.npy' % slot_id), np.cumsum(counts)[:-1])
+            postings.flush()
+            del postings
+
+        goals = self.sample_goals(num_goals)
+        for i, m in enumerate(self.usr_modalities):
+            np.save(os.path.join(path, 'cons_%d.npy' % i), goals[:, i].astype(ColumnTable.narrowest_dtype(m)))
+        Database._save_search(path, DataCube(cube_rows, cube_counts), ColumnTable.from_array(goals, self.usr_modalities),
+                              self.usr_modalities)
+        for col in usr_cols + sys_cols + [all_rows]:
+            col.flush()
+
+        meta = {'num_rows': num_rows,
+                'usr_slot_names': self.usr_slot_names,
+                'usr_dirichlet_priors': [p.tolist() for p in self.usr_dirichlet_priors],
+                'sys_dirichlet_priors': [p.tolist() for p in self.sys_dirichlet_priors],
+                'usr_pdf': [p.tolist() for p in self.usr_pdf],
+                'sys_pdf': [p.tolist() for p in self.sys_pdf]}
+        # written last, an export without meta.json is incomplete
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        self.logger.info("Wrote a synthetic KB of %d rows to %s" % (num_rows, path))
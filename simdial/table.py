@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import numbers
+
+
+class ColumnTable(object):
+    """
+    An integer table stored column by column. Each column is a contiguous 1D array with the
+    narrowest unsigned dtype that holds its vocabulary.
+
+    Indexing follows the 2D array patterns used on the database tables:
+    table[i, :] is a 1D row, table[i, j] a value, table[:, j] a column and
+    table[rows] / table[rows, cols] a ColumnTable with the selected rows and columns.
+
+    Rows can be appended and overwritten in place. Appends go to buffers that grow geometrically,
+    and a column is widened when it is given a value its dtype cannot hold.
+
+    :ivar columns: a list of 1D arrays of equal length
+    """
+
+    def __init__(self, columns, modalities=None):
+        """
+        :param columns: a list of 1D int arrays
+        :param modalities: the vocab size of each column, the column max is used if None
+        """
+        if modalities is None:
+            modalities = [int(np.max(col)) + 1 if len(col) > 0 else 1 for col in columns]
+        self.columns = [np.ascontiguousarray(col, dtype=self.narrowest_dtype(m)) for col, m in zip(columns, modalities)]
+        self._buffers = None
+
+    @classmethod
+    def from_array(cls, array, modalities=None):
+        """
+        :param array: 2D int array [num_rows x num_cols]
+        """
+        array = np.asarray(array)
+        return cls([array[:, i] for i in range(array.shape[1])], modalities)
+
+    @classmethod
+    def wrap(cls, columns):
+        """
+        :param columns: a list of 1D arrays, used as they are without copy or dtype change
+        """
+        table = cls.__new__(cls)
+        table.columns = columns
+        table._buffers = None
+        return table
+
+    @staticmethod
+    def narrowest_dtype(modality):
+        return np.min_scalar_type(max(int(modality) - 1, 0))
+
+    @property
+    def shape(self):
+        return len(self), len(self.columns)
+
+    @property
+    def nbytes(self):
+        return sum(col.nbytes for col in self.columns)
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        if isinstance(cols, numbers.Integral):
+            return self.columns[cols][rows]
+
+        columns = self.columns[cols] if isinstance(cols, slice) else [self.columns[c] for c in cols]
+        if isinstance(rows, numbers.Integral):
+            return np.array([col[rows] for col in columns])
+        return self.wrap([col[rows] for col in columns])
+
+    def __array__(self, dtype=None, copy=None):
+        if not self.columns:
+            return np.zeros((0, 0), dtype=dtype or np.int64)
+        return np.stack([col if dtype is None else col.astype(dtype) for col in self.columns], axis=1)
+
+    def append(self, row):
+        """
+        Add a row at the end, in amortized O(num_cols).
+
+        :param row: one int value per column
+        """
+        size = len(self)
+        if self._buffers is None or size == len(self._buffers[0]):
+            capacity = max(16, 2 * size)
+            self._buffers = []
+            for col in self.columns:
+                buf = np.zeros(capacity, dtype=col.dtype)
+                buf[0:size] = col
+                self._buffers.append(buf)
+        self.columns = [buf[0:size + 1] for buf in self._buffers]
+        self.set_row(size, row)
+
+    def set_row(self, i, row):
+        """
+        Overwrite row i, widening the columns whose dtype is too narrow for the new values.
+        """
+        for col_id, value in enumerate(row):
+            if value > np.iinfo(self.columns[col_id].dtype).max:
+                self._widen(col_id, self.narrowest_dtype(value + 1))
+            self.columns[col_id][i] = value
+
+    def _widen(self, col_id, dtype):
+        if self._buffers is None:
+            self.columns[col_id] = self.columns[col_id].astype(dtype)
+        else:
+            self._buffers[col_id] = self._buffers[col_id].astype(dtype)
+            self.columns[col_id] = self._buffers[col_id][0:len(self.columns[col_id])]
+
+    def setflags(self, write):
+        for col in self.columns:
+            col.setflags(write=write)
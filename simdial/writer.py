@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+from simdial.agent.core import Action, BaseSysSlot, BaseUsrSlot
+import numpy as np
+import json
+import gzip
+import io
+import os
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+class CorpusWriter(object):
+    """
+    Writes the dialogs of a corpus one at a time. The serialized dialogs are buffered and written
+    BATCH_SIZE at a time in one call, to a file opened with a large buffer, so the writer never
+    slows down a generation run. Use it as a context manager or call close.
+
+    A compressed file is a sequence of complete gzip or xz members, one per batch, which the
+    gzip and xz readers read as one stream. So batches can also be serialized and compressed in
+    other processes and handed over with write_encoded.
+
+    :ivar path: the output file
+    :ivar compression: None, 'gzip' or 'xz'
+    :ivar domain: the Domain of the dialogs, only needed by the formats that encode its vocabulary
+    :ivar num_dialogs: the number of dialogs flushed so far
+    """
+
+    EXTENSION = None
+    BATCH_SIZE = 256
+    BUFFER_SIZE = 1 << 20
+    COMPRESSIONS = {None: '', 'gzip': '.gz', 'xz': '.xz'}
+
+    def __init__(self, path, compression=None, domain=None):
+        if compression not in self.COMPRESSIONS:
+            raise ValueError("Unknown compression %s" % compression)
+        self.path = path
+        self.compression = compression
+        self.domain = domain
+        self.num_dialogs = 0
+        self._batch = []
+        if compression == 'xz' and lzma is None:
+            raise ValueError("xz compression needs the lzma module")
+        self.f = self._open()
+
+    def _open(self):
+        return io.open(self.path, 'wb', buffering=self.BUFFER_SIZE)
+
+    @classmethod
+    def file_name(cls, prefix, compression=None):
+        """
+        :return: prefix with the extension of the format and of the compression
+        """
+        return "%s.%s%s" % (prefix, cls.EXTENSION, cls.COMPRESSIONS[compression])
+
+    @staticmethod
+    def format_dialog(idx, dialog, usr_goal):
+        """
+        :param idx: the dialog number
+        :param dialog: a list of turns, see Generator.gen_dialog
+        :param usr_goal: the readable user goal
+        :return: the dialog as a string
+        """
+        raise NotImplementedError("Implement format_dialog function is required")
+
+    @classmethod
+    def encode_shard(cls, start, results, compression=None, domain=None):
+        """
+        :param start: the number of the first dialog
+        :param results: a list of (dialog, user goal)
+        :return: the dialogs serialized by format_dialog, see encode
+        """
+        return cls.encode("".join([cls.format_dialog(idx, dialog, usr_goal)
+                                   for idx, (dialog, usr_goal) in enumerate(results, start)]), compression)
+
+    def write(self, dialog, usr_goal):
+        self._batch.append((dialog, usr_goal))
+        if len(self._batch) >= self.BATCH_SIZE:
+            self.flush()
+
+    @staticmethod
+    def encode(text, compression=None):
+        """
+        :return: text as UTF-8 bytes, compressed as one complete member if compression is set
+        """
+        data = text.encode('utf-8')
+        if compression == 'gzip':
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+                f.write(data)
+            return buf.getvalue()
+        elif compression == 'xz':
+            return lzma.compress(data)
+        return data
+
+    def write_encoded(self, data, num_dialogs):
+        """
+        :param data: the output of encode_shard for num_dialogs dialogs, numbered from the
+        number of dialogs written so far
+        """
+        self.flush()
+        self.f.write(data)
+        self.num_dialogs += num_dialogs
+
+    def flush(self):
+        if self._batch:
+            batch, self._batch = self._batch, []
+            self.write_encoded(self.encode_shard(self.num_dialogs, batch, self.compression, self.domain), len(batch))
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TextWriter(CorpusWriter):
+    """
+    The human readable format of Generator.pprint: a header with the user goal, then one line
+    per turn without the KB queries and returns.
+    """
+
+    EXTENSION = 'txt'
+
+    @staticmethod
+    def format_dialog(idx, dialog, usr_goal):
+        lines = ["## DIALOG %d ##\n" % idx, "User goal: " + str(usr_goal) + '\n']
+        for turn in dialog:
+            speaker, utt, actions = turn["speaker"], turn["utt"], turn["actions"]
+            if utt:
+                str_actions = utt
+            else:
+                str_actions = " ".join([a.dump_string() for a in actions])
+
+            if '{"QUERY"' not in str_actions and '{"RET"' not in str_actions:
+                lines.append("%s -> %s\n" % (speaker, str_actions))
+        lines.append("\n")
+        return "".join(lines)
+
+
+class JsonlWriter(CorpusWriter):
+    """
+    One JSON object per line: {"id": dialog number, "goal": user goal, "turns": [turn, ...]},
+    with every field of the turns.
+    """
+
+    EXTENSION = 'jsonl'
+
+    @staticmethod
+    def _to_json(obj):
+        if isinstance(obj, Action):
+            return obj.to_json()
+        # numpy scalars drawn by the simulator
+        if isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError("%r is not JSON serializable" % (obj,))
+
+    @staticmethod
+    def format_dialog(idx, dialog, usr_goal):
+        return json.dumps({'id': idx, 'goal': usr_goal, 'turns': dialog}, default=JsonlWriter._to_json) + "\n"
+
+
+class ActVocab(object):
+    """
+    The integer ids of the acts, slots and values of a domain. The ids only depend on the
+    domain spec, so shards encoded in different processes share them.
+
+    :ivar act_names: the acts of SystemAct and UserAct, sorted, so an act id is its Action.act_id
+    :ivar slot_names: the special slots, then the user slots and the system slots of the domain
+    :ivar value_names: {slot name -> vocabulary} of the user and system slots
+    """
+
+    NONE = -1
+    DONT_CARE = -2
+    UNKNOWN = -3
+
+    def __init__(self, domain):
+        self.act_names = list(Action.ACTS)
+        self.slot_names = [BaseSysSlot.DEFAULT, BaseSysSlot.PURPOSE, BaseUsrSlot.NEED, BaseUsrSlot.HAPPY,
+                           BaseUsrSlot.AGAIN, BaseUsrSlot.SELF_CORRECT]
+        self.value_names = {}
+        for slot in domain.usr_slots + domain.sys_slots:
+            if slot.name not in self.slot_names:
+                self.slot_names.append(slot.name)
+            if slot.name != BaseSysSlot.DEFAULT:
+                self.value_names[slot.name] = slot.vocabulary
+        self.act_ids = dict((name, i) for i, name in enumerate(self.act_names))
+        self.slot_ids = dict((name, i) for i, name in enumerate(self.slot_names))
+        self.value_ids = dict((name, dict((v, i) for i, v in enumerate(vocab)))
+                              for name, vocab in self.value_names.items())
+
+    def value_id(self, slot, value):
+        """
+        :return: the index of value in the vocabulary of slot, NONE, DONT_CARE or UNKNOWN
+        """
+        if value is None:
+            return self.NONE
+        if isinstance(value, (bool, int, np.integer)):
+            return int(value)
+        if value == 'dont_care':
+            return self.DONT_CARE
+        if slot == BaseSysSlot.DEFAULT:
+            # the vocabulary of the KB key is the row ids
+            return int(value)
+        return self.value_ids.get(slot, {}).get(value, self.UNKNOWN)
+
+    @staticmethod
+    def iter_params(parameters):
+        """
+        Flatten the parameters of an action into (slot, value): a dict gives its items, a
+        (slot, value) tuple itself, a list its flattened items and a bare slot name (slot, None).
+        """
+        for p in parameters:
+            if isinstance(p, dict):
+                for item in p.items():
+                    yield item
+            elif isinstance(p, tuple) and len(p) == 2 and isinstance(p[0], str):
+                yield p
+            elif isinstance(p, (list, tuple)):
+                for item in ActVocab.iter_params(p):
+                    yield item
+            else:
+                yield p, None
+
+    def to_dict(self):
+        return {'act_names': self.act_names, 'slot_names': self.slot_names, 'value_names': self.value_names}
+
+
+class ActCorpusWriter(CorpusWriter):
+    """
+    A columnar binary format of the dialog acts for training pipelines, in a directory of raw
+    little-endian arrays, one file per column, that ActCorpus memory maps:
+
+        dialog_turns  int64 [num_dialogs + 1] the offset of the first turn of each dialog
+        speaker       uint8 [num_turns] 0 for SYS, 1 for USR
+        conf          float32 [num_turns] the confidence of the channel, NaN for SYS
+        turn_acts     int64 [num_turns + 1] the offset of the first act of each turn
+        act           uint8 [num_acts] an index of ActVocab.act_names
+        act_params    int64 [num_acts + 1] the offset of the first parameter of each act
+        slot          int16 [num_params] an index of ActVocab.slot_names
+        value         int32 [num_params] see ActVocab.value_id
+
+    meta.json holds the vocabularies and the lengths; it is written by close, a directory
+    without it is incomplete. The domain is required and compression is not supported.
+    """
+
+    EXTENSION = 'acts'
+    SPEAKERS = ['SYS', 'USR']
+    COLUMNS = [('speaker', '<u1'), ('conf', '<f4'), ('act', '<u1'), ('slot', '<i2'), ('value', '<i4')]
+    OFFSETS = [('dialog_turns', 'num_turns'), ('turn_acts', 'num_acts'), ('act_params', 'num_params')]
+
+    def __init__(self, path, compression=None, domain=None):
+        if compression is not None:
+            raise ValueError("The %s format is not compressed" % self.EXTENSION)
+        if domain is None:
+            raise ValueError("The %s format needs the domain of the dialogs" % self.EXTENSION)
+        self.sizes = {'num_turns': 0, 'num_acts': 0, 'num_params': 0}
+        super(ActCorpusWriter, self).__init__(path, compression=compression, domain=domain)
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        files = {}
+        for name, _ in self.COLUMNS:
+            files[name] = io.open(os.path.join(self.path, name + '.bin'), 'wb', buffering=self.BUFFER_SIZE)
+        for name, _ in self.OFFSETS:
+            files[name] = io.open(os.path.join(self.path, name + '.bin'), 'wb', buffering=self.BUFFER_SIZE)
+            files[name].write(np.zeros(1, dtype='<i8').tobytes())
+        return files
+
+    @classmethod
+    def vocab(cls, domain):
+        # built once per domain and kept on it, the slot vocabularies can be large
+        vocab = getattr(domain, '_act_vocab', None)
+        if vocab is None:
+            vocab = domain._act_vocab = ActVocab(domain)
+        return vocab
+
+    @classmethod
+    def encode_shard(cls, start, results, compression=None, domain=None):
+        """
+        :return: {column name -> array}, with the offsets counted from the start of the shard
+        and without their leading 0
+        """
+        vocab = cls.vocab(domain)
+        speakers, confs, acts, slots, values = [], [], [], [], []
+        dialog_turns, turn_acts, act_params = [], [], []
+        for dialog, _ in results:
+            for turn in dialog:
+                speakers.append(cls.SPEAKERS.index(turn['speaker']))
+                confs.append(turn.get('conf', np.nan))
+                for action in turn['actions']:
+                    acts.append(action.act_id)
+                    for slot, value in vocab.iter_params(action.parameters):
+                        slots.append(vocab.slot_ids.get(slot, vocab.UNKNOWN))
+                        values.append(vocab.value_id(slot, value))
+                    act_params.append(len(slots))
+                turn_acts.append(len(acts))
+            dialog_turns.append(len(speakers))
+        data = {'dialog_turns': dialog_turns, 'turn_acts': turn_acts, 'act_params': act_params,
+                'speaker': speakers, 'conf': confs, 'act': acts, 'slot': slots, 'value': values}
+        dtypes = dict(cls.COLUMNS + [(name, '<i8') for name, _ in cls.OFFSETS])
+        return dict((name, np.array(column, dtype=dtypes[name])) for name, column in data.items())
+
+    def write_encoded(self, data, num_dialogs):
+        self.flush()
+        for name, size in self.OFFSETS:
+            self.f[name].write((data[name] + self.sizes[size]).tobytes())
+        for name, _ in self.COLUMNS:
+            self.f[name].write(data[name].tobytes())
+        self.sizes['num_turns'] += len(data['speaker'])
+        self.sizes['num_acts'] += len(data['act'])
+        self.sizes['num_params'] += len(data['slot'])
+        self.num_dialogs += num_dialogs
+
+    def close(self):
+        self.flush()
+        for f in self.f.values():
+            f.close()
+        meta = dict(self.sizes, num_dialogs=self.num_dialogs, speakers=self.SPEAKERS,
+                    columns=dict(self.COLUMNS + [(name, '<i8') for name, _ in self.OFFSETS]))
+        meta.update(self.vocab(self.domain).to_dict())
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+
+class ActCorpus(object):
+    """
+    Read only access to a corpus written by ActCorpusWriter. The columns are memory mapped,
+    so opening a corpus of any size takes constant time and dialog returns views.
+
+    :ivar meta: the content of meta.json
+    :ivar columns: {column name -> read only memory mapped array}
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.columns = {}
+        for name, dtype in self.meta['columns'].items():
+            file_name = os.path.join(path, name + '.bin')
+            if os.path.getsize(file_name) == 0:
+                # mmap can not map an empty file
+                self.columns[name] = np.zeros(0, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(file_name, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return self.meta['num_dialogs']
+
+    def dialog(self, idx):
+        """
+        :return: {column name -> view} of dialog idx. The offsets keep the positions of the whole
+        corpus, e.g. the acts of turn t of the dialog are act[turn_acts[t] - turn_acts[0]:turn_acts[t + 1] - turn_acts[0]]
+        """
+        c = self.columns
+        t0, t1 = c['dialog_turns'][idx], c['dialog_turns'][idx + 1]
+        a0, a1 = c['turn_acts'][t0], c['turn_acts'][t1]
+        p0, p1 = c['act_params'][a0], c['act_params'][a1]
+        return {'speaker': c['speaker'][t0:t1], 'conf': c['conf'][t0:t1],
+                'turn_acts': c['turn_acts'][t0:t1 + 1], 'act': c['act'][a0:a1],
+                'act_params': c['act_params'][a0:a1 + 1], 'slot': c['slot'][p0:p1], 'value': c['value'][p0:p1]}
+
+    def turns(self, idx):
+        """
+        :return: the turns of dialog idx as a list of (speaker, conf, [(act, [(slot, value id)])]) with names
+        """
+        d = self.dialog(idx)
+        act_names, slot_names = self.meta['act_names'], self.meta['slot_names']
+        turns = []
+        a0, p0 = d['turn_acts'][0], d['act_params'][0]
+        for t in range(len(d['speaker'])):
+            actions = []
+            for a in range(d['turn_acts'][t] - a0, d['turn_acts'][t + 1] - a0):
+                params = [(slot_names[s], int(v)) for s, v in
+                          zip(d['slot'][d['act_params'][a] - p0:d['act_params'][a + 1] - p0],
+                              d['value'][d['act_params'][a] - p0:d['act_params'][a + 1] - p0])]
+                actions.append((act_names[d['act'][a]], params))
+            turns.append((self.meta['speakers'][d['speaker'][t]], float(d['conf'][t]), actions))
+        return turns
+
+
+WRITERS = {'text': TextWriter, 'jsonl': JsonlWriter, 'acts': ActCorpusWriter}
+
+
+def get_writer(prefix, fmt='text', compression=None, domain=None):
+    """
+    :param prefix: the output path without extension
+    :param fmt: a key of WRITERS
+    :param compression: None, 'gzip' or 'xz'
+    :param domain: the Domain of the dialogs, required by the 'acts' format
+    :return: a CorpusWriter on prefix + the extension of fmt and compression
+    """
+    if fmt not in WRITERS:
+        raise ValueError("Unknown corpus format %s" % fmt)
+    writer_cls = WRITERS[fmt]
+    return writer_cls(writer_cls.file_name(prefix, compression), compression=compression, domain=domain)